@@ -8,23 +8,29 @@ Created on Mon Jan 10 10:15:00 2022
 """
 
 # import python modules
+import time
+import logging
+from collections import OrderedDict
 import numpy as np
 from scipy.optimize import curve_fit
 import scipy.interpolate as scp_interpolate
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
 
 # Definition
 #--auxilliary data
+# slice IDs on detector (in detector column order), per channel
+mrs_sliceids = {'1':[111,121,110,120,109,119,108,118,107,117,106,116,105,115,104,114,103,113,102,112,101],
+                '2':[201,210,202,211,203,212,204,213,205,214,206,215,207,216,208,217,209],
+                '3':[316,308,315,307,314,306,313,305,312,304,311,303,310,302,309,301],
+                '4':[412,406,411,405,410,404,409,403,408,402,407,401]}
+
 def mrs_aux(band):
     allbands = ['1A','1B','1C','2A','2B','2C','3A','3B','3C','4A','4B','4C']
     allchannels = ['1','2','3','4']
     allsubchannels = ['A','B','C']
 
-    # slice IDs on detector
-    sliceid1=[111,121,110,120,109,119,108,118,107,117,106,116,105,115,104,114,103,113,102,112,101]
-    sliceid2=[201,210,202,211,203,212,204,213,205,214,206,215,207,216,208,217,209]
-    sliceid3=[316,308,315,307,314,306,313,305,312,304,311,303,310,302,309,301]
-    sliceid4=[412,406,411,405,410,404,409,403,408,402,407,401]
-
     MRS_bands = {'1A':[4.885,5.751],
         '1B':[5.634,6.632],
         '1C':[6.408,7.524],
@@ -89,73 +95,483 @@ def gauss2d(xy, amp, x0, y0, sigma_x, sigma_y, base):
     inner += b * (y - y0)**2
     return amp * np.exp(-inner) + base
 
-def point_source_centroiding(band,sci_img,d2cMaps,spec_grid=None,fit='2D',center=None,offset_slice=0,verbose=True):
+def _inband_pixels(sliceMap,channel):
+    # flat indices of the pixels of channel (slice map values 100*channel+slice number); shared by
+    # PixelIndex and SliceStatistics so both see the same pixels
+    return np.flatnonzero((sliceMap >= 100*channel) & (sliceMap < 100*(channel+1)))
+
+class PixelIndex(object):
+    """In-band detector pixels grouped by slice and sorted by wavelength, built once per d2cMaps.
+
+    Selecting the pixels of a slice (or of all slices) within a wavelength bin is then a searchsorted on
+    the sorted wavelengths, rather than a comparison over the full detector. Selections are returned as
+    flat detector indices, in the same (row-major) order np.where would give.
+    """
+    def __init__(self,d2cMaps,band):
+        channel   = int(band[0])
+        sliceMap  = np.ravel(d2cMaps['sliceMap'])
+        lambdaMap = np.ravel(d2cMaps['lambdaMap'])
+        inband = _inband_pixels(sliceMap,channel)
+        slices,lambdas = sliceMap[inband],lambdaMap[inband]
+
+        #> pixels sorted by slice, then by wavelength
+        order = np.lexsort((lambdas,slices))
+        self.flat_idx = inband[order]
+        self.lambdas  = lambdas[order]
+        slice_numbers,starts = np.unique(slices[order],return_index=True)
+        ends = np.append(starts[1:],len(order))
+        self.slice_bounds = {int(sn):(start,end) for sn,start,end in zip(slice_numbers,starts,ends)}
+
+        #> all in-band pixels sorted by wavelength
+        order_all = np.argsort(lambdas,kind='stable')
+        self.flat_idx_all = inband[order_all]
+        self.lambdas_all  = lambdas[order_all]
+
+    @staticmethod
+    def _select(flat_idx,lambdas,lamcen,halfwidth,strict):
+        #> candidates from a slightly widened searchsorted range, then the exact selection criterion,
+        # so rounding in lamcen-halfwidth / lamcen+halfwidth never changes the selected pixels
+        margin = 4*np.finfo(float).eps*(abs(lamcen)+abs(halfwidth))
+        start = np.searchsorted(lambdas,lamcen-halfwidth-margin,side='left')
+        end   = np.searchsorted(lambdas,lamcen+halfwidth+margin,side='right')
+        dist  = np.abs(lambdas[start:end]-lamcen)
+        keep  = dist < halfwidth if strict else dist <= halfwidth
+        return np.sort(flat_idx[start:end][keep])
+
+    def select(self,slice_number,lamcen,halfwidth,strict=False):
+        # flat indices of the pixels of slice slice_number with |lambda-lamcen| <= halfwidth (< if strict)
+        if slice_number not in self.slice_bounds:
+            return np.array([],dtype=self.flat_idx.dtype)
+        start,end = self.slice_bounds[slice_number]
+        return self._select(self.flat_idx[start:end],self.lambdas[start:end],lamcen,halfwidth,strict)
+
+    def select_all(self,lamcen,halfwidth,strict=False):
+        # flat indices of the pixels of all slices with |lambda-lamcen| <= halfwidth (< if strict)
+        return self._select(self.flat_idx_all,self.lambdas_all,lamcen,halfwidth,strict)
+
+class SliceStatistics(object):
+    """Per-slice reductions of detector images, for one band.
+
+    The in-band pixels are sorted once by slice and detector row, so that per-slice sums and per-row
+    maxima within the slices are single bincount/reduceat passes over the image, rather than one masked
+    operation per slice or per detector row. The alpha/beta extents of the slices (alpha_min, alpha_max,
+    beta_min, beta_max; NaN for slices without pixels) are computed at construction.
+    """
+    def __init__(self,d2cMaps,band):
+        channel = int(band[0])
+        self.nslices = d2cMaps['nslices']
+        self.shape   = d2cMaps['sliceMap'].shape
+        sliceMap = np.ravel(d2cMaps['sliceMap'])
+        inband = _inband_pixels(sliceMap,channel)
+
+        #> pixels sorted by slice, then by detector row (and column)
+        order = np.argsort(sliceMap[inband],kind='stable')
+        self.flat_idx  = inband[order]
+        self.slice_idx = (sliceMap[self.flat_idx]-100*channel-1).astype(int)
+        if len(self.slice_idx) and (self.slice_idx[0] < 0 or self.slice_idx[-1] >= self.nslices):
+            raise ValueError('sliceMap of channel {} has slice numbers outside 1..{} (nslices)'.format(channel,self.nslices))
+        rows = self.flat_idx//self.shape[1]
+
+        #> start of every slice present, and of every run of pixels sharing slice and row
+        self.slices_present,self.slice_starts = np.unique(self.slice_idx,return_index=True)
+        key = self.slice_idx*self.shape[0]+rows
+        self.segment_starts = np.flatnonzero(np.r_[True,key[1:] != key[:-1]])
+        self.segment_slice  = self.slice_idx[self.segment_starts]
+        self.segment_row    = rows[self.segment_starts]
+        self.segment_id     = np.cumsum(np.r_[True,key[1:] != key[:-1]])-1
+
+        alphas = np.ravel(d2cMaps['alphaMap'])[self.flat_idx]
+        betas  = np.ravel(d2cMaps['betaMap'])[self.flat_idx]
+        self.alpha_min,self.alpha_max = self._reduce_slices(np.minimum,alphas),self._reduce_slices(np.maximum,alphas)
+        self.beta_min,self.beta_max   = self._reduce_slices(np.minimum,betas),self._reduce_slices(np.maximum,betas)
+
+    def _reduce_slices(self,ufunc,values):
+        out = np.full(self.nslices,np.nan)
+        if len(values):
+            out[self.slices_present] = ufunc.reduceat(values,self.slice_starts)
+        return out
+
+    def _values(self,sci_img):
+        return np.ravel(sci_img)[self.flat_idx].astype(float)
+
+    def slice_sums(self,sci_img):
+        # summed signal of every slice (index 0 is slice 1), ignoring NaN pixels
+        values = self._values(sci_img)
+        return np.bincount(self.slice_idx,weights=np.where(np.isnan(values),0.,values),minlength=self.nslices)
+
+    def row_argmax(self,sci_img):
+        # flat detector index of the brightest valid pixel in every detector row of every slice, as a
+        # (nslices,nrows) array; -1 for rows of a slice without valid pixels
+        out = np.full((self.nslices,self.shape[0]),-1,dtype=int)
+        values = self._values(sci_img)
+        if len(values) == 0:
+            return out
+        values[np.isnan(values)] = -np.inf
+        segment_max = np.maximum.reduceat(values,self.segment_starts)
+        #> first pixel of each run reaching the maximum of the run
+        position = np.where(values == segment_max[self.segment_id],np.arange(len(values)),len(values))
+        first = np.minimum.reduceat(position,self.segment_starts)
+        valid = segment_max > -np.inf
+        out[self.segment_slice[valid],self.segment_row[valid]] = self.flat_idx[first[valid]]
+        return out
+
+class _CountingModel(object):
+    # model function that counts its evaluations (picklable, so it can be sent to worker processes)
+    def __init__(self,func):
+        self.func,self.nfev = func,0
+    def __call__(self,*args):
+        self.nfev += 1
+        return self.func(*args)
+
+def _fit_status(error):
+    # failure reason of a curve_fit call that raised error
+    if isinstance(error,RuntimeError):
+        return 'no_convergence'
+    if isinstance(error,TypeError):
+        return 'too_few_pixels' # fewer data points than parameters
+    if 'infeasible' in str(error):
+        return 'bounds'         # initial guess outside the bounds
+    return 'invalid_data'
+
+#--per wavelength bin fits (module level, so they can run in worker processes)
+#  each returns (popt, number of model evaluations, status); popt is None if the fit failed
+def _fit_along_slice_bin(profiles,alpha0,sigma0):
+    # profiles: (alphas,signals) in the source slice and in the slices at offset -1 and +1
+    if any([len(signals) == 0 for alphas,signals in profiles]):
+        return None,0,'no_pixels'
+    model = _CountingModel(gauss1d_wBaseline)
+    try:
+        return [curve_fit(model, alphas, signals, p0=[signals.max(),alpha0,sigma0,0],method='lm')[0] for alphas,signals in profiles],model.nfev,'ok'
+    except Exception as error:
+        return None,model.nfev,_fit_status(error)
+
+def _fit_across_slice_bin(betas,signals,beta0,sigma0):
+    model = _CountingModel(gauss1d_wBaseline)
+    try:
+        return curve_fit(model, betas, signals, p0=[signals.max(),beta0,sigma0,0],method='lm')[0],model.nfev,'ok'
+    except Exception as error:
+        return None,model.nfev,_fit_status(error)
+
+def _fit_2D_bin(alphabetas,zobs,guess,bounds):
+    model = _CountingModel(gauss2d)
+    try:
+        return curve_fit(model, alphabetas, zobs, p0=guess,bounds=bounds)[0],model.nfev,'ok'
+    except Exception as error:
+        return None,model.nfev,_fit_status(error)
+
+def _map_bins(func,tasks,n_workers=None,pool='process'):
+    # run func(*task) for every task, in a pool of n_workers processes or threads (serially if n_workers
+    # is None or 1); bins are sent to the workers in chunks, results come back in task order
+    if n_workers is None or n_workers == 1 or len(tasks) == 0:
+        return [func(*task) for task in tasks]
+    if pool not in ('process','thread'):
+        raise ValueError("pool has to be either 'process' or 'thread'")
+    Executor = ProcessPoolExecutor if pool == 'process' else ThreadPoolExecutor
+    chunksize = max(1,len(tasks)//(4*n_workers))
+    with Executor(max_workers=n_workers) as executor:
+        return list(executor.map(func,*zip(*tasks),chunksize=chunksize))
+
+#--batched Levenberg-Marquardt: many small independent fits of the same model, solved together
+def _gauss1d_wBaseline_jac(x, A, mu, sigma, baseline):
+    # derivatives of gauss1d_wBaseline w.r.t. (A,mu,sigma,baseline), stacked on the last axis
+    e = np.exp(-(x-mu)**2/(2*sigma)**2)
+    return np.stack([e, A*e*(x-mu)/(2*sigma**2), A*e*(x-mu)**2/(2*sigma**3), np.ones_like(e)],axis=-1)
+
+def _gauss2d_batch(xy, amp, x0, y0, sigma_x, sigma_y, base):
+    # gauss2d for a batch of problems: xy (nproblems,2,npoints), parameters (nproblems,1)
+    x, y = xy[:,0], xy[:,1]
+    return amp * np.exp(-((x-x0)**2/(2*sigma_x**2) + (y-y0)**2/(2*sigma_y**2))) + base
+
+def _gauss2d_batch_jac(xy, amp, x0, y0, sigma_x, sigma_y, base):
+    # derivatives of _gauss2d_batch w.r.t. (amp,x0,y0,sigma_x,sigma_y,base), stacked on the last axis
+    x, y = xy[:,0], xy[:,1]
+    e = np.exp(-((x-x0)**2/(2*sigma_x**2) + (y-y0)**2/(2*sigma_y**2)))
+    return np.stack([e, amp*e*(x-x0)/sigma_x**2, amp*e*(y-y0)/sigma_y**2,
+                     amp*e*(x-x0)**2/sigma_x**3, amp*e*(y-y0)**2/sigma_y**3, np.ones_like(e)],axis=-1)
+
+def _pad_ragged(arrays):
+    # stack arrays of different lengths (along their last axis) into one zero-padded array, plus the mask of the valid entries
+    arrays = [np.asarray(a,dtype=float) for a in arrays]
+    nmax = max([a.shape[-1] for a in arrays]+[1])
+    padded = np.zeros((len(arrays),)+(arrays[0].shape[:-1] if arrays else ())+(nmax,))
+    mask = np.zeros((len(arrays),nmax),dtype=bool)
+    for i,a in enumerate(arrays):
+        padded[i,...,:a.shape[-1]] = a
+        mask[i,:a.shape[-1]] = True
+    return padded,mask
+
+def batch_levenberg_marquardt(func,jac,x,y,p0,mask=None,bounds=None,max_iter=200,ftol=1e-10,xtol=1e-10):
+    """Levenberg-Marquardt fit of B independent problems of the same model, all iterated together.
+
+    func(x,*p) and jac(x,*p) evaluate the model and its analytic derivatives (stacked on the last axis)
+    for a batch of problems, with x (B,...,N) and every parameter of shape (B,1). y and mask are (B,N),
+    p0 is (B,P). Problems with fewer valid points than parameters, or with non-finite data or initial
+    guess, are not fitted. bounds=(lower,upper) are enforced by clipping every step.
+
+    Returns popt (B,P), a convergence flag per problem (B,) and the number of model evaluations (B,).
+    """
+    y = np.asarray(y,dtype=float)
+    p = np.array(p0,dtype=float)
+    B,P = p.shape
+    if mask is None:
+        mask = np.ones(y.shape,dtype=bool)
+    w = mask.astype(float)
+    y = np.where(mask,y,0.)
+
+    def residuals(idx,params):
+        return (y[idx]-func(x[idx],*params[:,:,None].transpose(1,0,2)))*w[idx]
+
+    converged = np.zeros(B,dtype=bool)
+    nfev   = np.zeros(B,dtype=int)
+    lam    = np.full(B,1e-3)
+    chi2   = np.full(B,np.inf)
+    resid  = np.zeros(y.shape)
+    active = (mask.sum(axis=1) >= P) & np.all(np.isfinite(p),axis=1) & np.all(np.isfinite(y),axis=1)
+
+    idx = np.flatnonzero(active)
+    with np.errstate(all='ignore'):
+        resid[idx] = residuals(idx,p[idx])
+    chi2[idx]  = np.sum(resid[idx]**2,axis=1)
+    nfev[idx] += 1
+    active &= np.isfinite(chi2)
+
+    for it in range(max_iter):
+        idx = np.flatnonzero(active)
+        if len(idx) == 0:
+            break
+        with np.errstate(all='ignore'):
+            J = jac(x[idx],*p[idx][:,:,None].transpose(1,0,2))*w[idx][:,:,None]
+        #> damped normal equations (J^T J + lam*diag(J^T J)) step = J^T r, solved for all problems at once
+        JTJ  = np.einsum('bnk,bnl->bkl',J,J)
+        JTr  = np.einsum('bnk,bn->bk',J,resid[idx])
+        diag = np.maximum(np.einsum('bkk->bk',JTJ),1e-30)
+        A    = JTJ + (lam[idx,None]*diag)[:,:,None]*np.eye(P)
+        A[~np.isfinite(A)] = 0.
+        try:
+            step = np.linalg.solve(A,JTr[:,:,None])[:,:,0]
+        except np.linalg.LinAlgError:
+            step = np.array([np.linalg.lstsq(a,b,rcond=None)[0] for a,b in zip(A,JTr)])
+
+        p_new = p[idx]+step
+        if bounds is not None:
+            p_new = np.clip(p_new,bounds[0],bounds[1])
+        with np.errstate(all='ignore'):
+            resid_new = residuals(idx,p_new)
+        chi2_new = np.sum(resid_new**2,axis=1)
+        nfev[idx] += 1
+
+        better     = np.isfinite(chi2_new) & (chi2_new <= chi2[idx])
+        small_gain = better & (chi2[idx]-chi2_new <= ftol*chi2[idx])
+        small_step = np.all(np.abs(p_new-p[idx]) <= xtol*(np.abs(p[idx])+xtol),axis=1)
+
+        accepted = idx[better]
+        p[accepted],resid[accepted],chi2[accepted] = p_new[better],resid_new[better],chi2_new[better]
+        lam[accepted] = np.maximum(lam[accepted]/10.,1e-12)
+        lam[idx[~better]] *= 10.
+
+        done = small_gain | small_step
+        converged[idx[done]] = True
+        # give up on problems whose damping keeps growing without improving the fit
+        active[idx[done | (lam[idx] > 1e16)]] = False
+
+    return p,converged,nfev
+
+def batch_fit_gauss1d(xs,ys,p0,**kwargs):
+    # fit gauss1d_wBaseline to every (x,y) pair of 1D arrays (the lengths may differ), see batch_levenberg_marquardt
+    x,mask = _pad_ragged(xs)
+    y,_    = _pad_ragged(ys)
+    return batch_levenberg_marquardt(gauss1d_wBaseline,_gauss1d_wBaseline_jac,x,y,p0,mask=mask,**kwargs)
+
+def batch_fit_gauss2d(xys,zs,p0,**kwargs):
+    # fit gauss2d to every (xy,z) pair, with xy of shape (2,N) (N may differ), see batch_levenberg_marquardt
+    xy,mask = _pad_ragged(xys)
+    z,_     = _pad_ragged(zs)
+    return batch_levenberg_marquardt(_gauss2d_batch,_gauss2d_batch_jac,xy,z,p0,mask=mask,**kwargs)
+
+def _batch_status(npoints,nparams,p0,data,converged):
+    # status of every problem of a batch fit, with the same failure reasons as the curve_fit path
+    status = np.where(converged,'ok','no_convergence').astype('U16')
+    status[[not np.all(np.isfinite(d)) for d in data] | ~np.all(np.isfinite(p0),axis=1)] = 'invalid_data'
+    status[np.asarray(npoints) < nparams] = 'too_few_pixels'
+    return status
+
+def _batch_along_slice_bins(tasks):
+    # batched counterpart of _map_bins(_fit_along_slice_bin,tasks)
+    empty = np.array([any([len(signals) == 0 for alphas,signals in task[0]]) for task in tasks],dtype=bool)
+    profiles = [profile for task in tasks for profile in task[0]]
+    p0 = [[signals.max() if len(signals) else np.nan,alpha0,sigma0,0] for (profs,alpha0,sigma0) in tasks for (alphas,signals) in profs]
+    p0 = np.reshape(p0,(-1,4))
+    signals = [signals for alphas,signals in profiles]
+    popt,converged,nfev = batch_fit_gauss1d([alphas for alphas,signals in profiles],signals,p0)
+    status = _batch_status([len(s) for s in signals],4,p0,signals,converged).reshape(len(tasks),3)
+    popt,nfev = popt.reshape(len(tasks),3,4),nfev.reshape(len(tasks),3).sum(axis=1)
+    results = []
+    for itask in range(len(tasks)):
+        if empty[itask]:
+            results.append((None,0,'no_pixels'))
+        elif np.all(status[itask] == 'ok'):
+            results.append((list(popt[itask]),nfev[itask],'ok'))
+        else:
+            results.append((None,nfev[itask],status[itask][status[itask] != 'ok'][0]))
+    return results
+
+def _batch_across_slice_bins(tasks):
+    # batched counterpart of _map_bins(_fit_across_slice_bin,tasks)
+    p0 = np.reshape([[signals.max(),beta0,sigma0,0] for (betas,signals,beta0,sigma0) in tasks],(-1,4))
+    signals = [task[1] for task in tasks]
+    popt,converged,nfev = batch_fit_gauss1d([task[0] for task in tasks],signals,p0)
+    status = _batch_status([len(s) for s in signals],4,p0,signals,converged)
+    return [(popt[i] if status[i] == 'ok' else None,nfev[i],status[i]) for i in range(len(tasks))]
+
+def _batch_2D_bins(tasks):
+    # batched counterpart of _map_bins(_fit_2D_bin,tasks); all bins share the same bounds, and (like
+    # curve_fit) initial guesses outside the bounds are not fitted
+    if len(tasks) == 0:
+        return []
+    lower,upper = tasks[0][3]
+    p0 = np.reshape([task[2] for task in tasks],(-1,6))
+    feasible = np.all((p0 >= lower) & (p0 <= upper),axis=1)
+    zs = [task[1] for task in tasks]
+    popt,converged,nfev = batch_fit_gauss2d([task[0] for task in tasks],zs,np.where(feasible[:,None],p0,np.nan),bounds=(lower,upper))
+    status = _batch_status([len(z) for z in zs],6,p0,zs,converged)
+    status[~feasible & (status != 'invalid_data')] = 'bounds'
+    return [(popt[i] if status[i] == 'ok' else None,nfev[i],status[i]) for i in range(len(tasks))]
+
+class CentroidingDiagnostics(object):
+    """Instrumentation of one point_source_centroiding call.
+
+    stage_times holds the wall time (s) of every stage that ran, outliers the number of bins rejected as
+    outliers after the along-slice fit, and bins is a table (structured array) with one row per wavelength
+    bin: its wavelength and, for each fitting stage, the number of model evaluations (nfev_<stage>) and
+    the fit status (status_<stage>): 'ok', 'no_pixels', 'too_few_pixels', 'invalid_data', 'bounds',
+    'no_convergence', 'outlier', 'skipped' (failed in an earlier stage), or '' if the stage did not run.
+    """
+    stages = ['along_slice','across_slice','2D']
+
+    def __init__(self,lambcens):
+        self.stage_times = OrderedDict()
+        self.outliers = 0
+        dtype = [('lambda',float)]+[('nfev_'+stage,int) for stage in self.stages]+[('status_'+stage,'U16') for stage in self.stages]
+        self.bins = np.zeros(len(lambcens),dtype=dtype)
+        self.bins['lambda'] = lambcens
+
+    def record(self,stage,ibin,nfev,status):
+        self.bins['nfev_'+stage][ibin]   = nfev
+        self.bins['status_'+stage][ibin] = status
+
+    def failed_bins(self,stage):
+        # indices of the bins that did not give a fit result in stage
+        status = self.bins['status_'+stage]
+        return np.flatnonzero((status != 'ok') & (status != '')).tolist()
+
+    def failure_counts(self,stage):
+        # number of bins per failure reason in stage
+        status = self.bins['status_'+stage]
+        reasons,counts = np.unique(status[(status != 'ok') & (status != '')],return_counts=True)
+        return dict(zip(reasons.tolist(),counts.tolist()))
+
+    def log_summary(self,level=logging.INFO):
+        for stage,seconds in self.stage_times.items():
+            logger.log(level,'[{}] {:.3f} s'.format(stage,seconds))
+        for stage in self.stages:
+            if np.any(self.bins['status_'+stage] != ''):
+                logger.log(level,'[{}] {} model evaluations, failures: {}'.format(stage,self.bins['nfev_'+stage].sum(),self.failure_counts(stage)))
+        logger.log(level,'{} bins rejected as outliers after the along-slice fit'.format(self.outliers))
+
+def point_source_centroiding(band,sci_img,d2cMaps,spec_grid=None,fit='2D',center=None,offset_slice=0,verbose=True,pixel_index=None,n_workers=None,pool='process',solver='curve_fit',slice_stats=None,return_diagnostics=False):
+    # pixel_index, slice_stats: PixelIndex and SliceStatistics of d2cMaps; pass them in to reuse them over
+    #                           several calls with the same d2cMaps
+    # n_workers, pool: fit the wavelength bins of each stage in parallel, in a pool of n_workers
+    #                  processes ('process') or threads ('thread'); None or 1 fits them serially
+    # solver: 'curve_fit' fits every bin separately with scipy; 'batch' fits all bins of a stage at once
+    #         with batch_levenberg_marquardt (n_workers and pool are then not used)
+    # progress is logged (at INFO level if verbose, else DEBUG) rather than printed; with
+    # return_diagnostics, a CentroidingDiagnostics is appended to the returned values
     # distortion maps
     sliceMap  = d2cMaps['sliceMap']
     lambdaMap = d2cMaps['lambdaMap']
     alphaMap  = d2cMaps['alphaMap']
     betaMap   = d2cMaps['betaMap']
     nslices   = d2cMaps['nslices']
+    if pixel_index is None:
+        pixel_index = PixelIndex(d2cMaps,band)
+    if slice_stats is None:
+        slice_stats = SliceStatistics(d2cMaps,band)
+    sci_flat    = np.ravel(sci_img)
+    alpha_flat  = np.ravel(alphaMap)
+    beta_flat   = np.ravel(betaMap)
+
+    def select_valid(slice_number,ibin):
+        # in-slice pixels of wavelength bin ibin with valid signal
+        idx = pixel_index.select(slice_number,lambcens[ibin],lambfwhms[ibin]/2.)
+        return idx[~np.isnan(sci_flat[idx])]
+
     MRS_alphapix = {'1':0.196,'2':0.196,'3':0.245,'4':0.273} # arcseconds
     MRS_FWHM = {'1':2.16*MRS_alphapix['1'],'2':3.30*MRS_alphapix['2'],
                 '3':4.04*MRS_alphapix['3'],'4':5.56*MRS_alphapix['4']} # MRS PSF
     mrs_fwhm  = MRS_FWHM[band[0]]
     lambcens,lambfwhms = spec_grid[0],spec_grid[1]
-    unique_betas = np.sort(np.unique(betaMap[(sliceMap>100*int(band[0])) & (sliceMap<100*(int(band[0])+1))]))
-    fov_lims  = [alphaMap[np.nonzero(lambdaMap)].min(),alphaMap[np.nonzero(lambdaMap)].max()]
-
-    if verbose:
-        print('STEP 1: Rough centroiding')
+    if solver not in ('curve_fit','batch'):
+        raise ValueError("solver has to be either 'curve_fit' or 'batch'")
+    def fit_bins(func,batch_func,tasks):
+        return batch_func(tasks) if solver == 'batch' else _map_bins(func,tasks,n_workers,pool)
+    unique_betas = np.unique(beta_flat[slice_stats.flat_idx])
+    fov_lims  = [np.nanmin(slice_stats.alpha_min),np.nanmax(slice_stats.alpha_max)]
+
+    level = logging.INFO if verbose else logging.DEBUG
+    diagnostics = CentroidingDiagnostics(lambcens)
+    def finish(*results):
+        diagnostics.log_summary(level)
+        return results+(diagnostics,) if return_diagnostics else results
+
+    logger.log(level,'STEP 1: Rough centroiding')
+    start = time.perf_counter()
     if center is None:
         # premise> center of point source is located in slice with largest signal
         # across-slice center:
-        sum_signals = np.zeros(nslices)
-        for islice in range(1,1+nslices):
-            sum_signals[islice-1] = sci_img[(sliceMap == 100*int(band[0])+islice) & (~np.isnan(sci_img))].sum()
+        sum_signals = slice_stats.slice_sums(sci_img)
         source_center_slice = np.argmax(sum_signals)+1
         source_center_slice+=offset_slice
+        if not 1 <= source_center_slice <= nslices:
+            raise ValueError('offset_slice={} moves the source center to slice {}, outside slices 1..{}'.format(
+                offset_slice,source_center_slice,nslices))
 
-        # along-slice center:
-        det_dims = (1024,1032)
-        img = np.full(det_dims,0.)
-        sel = (sliceMap == 100*int(band[0])+source_center_slice)
-        img[sel]  = sci_img[sel]
-
-        source_center_alphas = []
-        for row in range(det_dims[0]):
-            source_center_alphas.append(alphaMap[row,img[row,:].argmax()])
-        source_center_alphas = np.array(source_center_alphas)
+        # along-slice center: average alpha of the brightest pixel in each detector row of the slice
+        row_peaks = slice_stats.row_argmax(sci_img)[source_center_slice-1]
+        source_center_alphas = alpha_flat[row_peaks[row_peaks >= 0]]
         source_center_alpha  = np.average(source_center_alphas[~np.isnan(source_center_alphas)])
     else:
         source_center_slice,source_center_alpha = center[0],center[1]
-    if verbose:
-        # summary:
-        print( 'Slice {} has the largest summed flux'.format(source_center_slice))
-        print( 'Source position: beta = {}arcsec, alpha = {}arcsec \n'.format(round(unique_betas[source_center_slice-1],2),round(source_center_alpha,2)))
+    diagnostics.stage_times['rough'] = time.perf_counter()-start
+    # summary:
+    logger.log(level,'Slice {} has the largest summed flux'.format(source_center_slice))
+    logger.log(level,'Source position: beta = {}arcsec, alpha = {}arcsec'.format(round(unique_betas[source_center_slice-1],2),round(source_center_alpha,2)))
 
     if fit == '0D':
-        return source_center_slice,unique_betas[source_center_slice-1],source_center_alpha
+        return finish(source_center_slice,unique_betas[source_center_slice-1],source_center_alpha)
 
-    if verbose:
-        print( 'STEP 2: 1D Gaussian fit')
+    logger.log(level,'STEP 2: 1D Gaussian fit')
+    start = time.perf_counter()
 
     # Fit Gaussian distribution to along-slice signal profile
     sign_amp,alpha_centers,alpha_fwhms,bkg_signal = [np.full((len(lambcens)),np.nan) for j in range(4)]
     sign_amp_sliceoffsetminus1,alpha_centers_sliceoffsetminus1,alpha_fwhms_sliceoffsetminus1,bkg_signal_sliceoffsetminus1 = [np.full((len(lambcens)),np.nan) for j in range(4)]
     sign_amp_sliceoffsetplus1,alpha_centers_sliceoffsetplus1,alpha_fwhms_sliceoffsetplus1,bkg_signal_sliceoffsetplus1 = [np.full((len(lambcens)),np.nan) for j in range(4)]
-    failed_fits = []
+    tasks,task_bins = [],[]
     for ibin in range(len(lambcens)):
-        coords = np.where((sliceMap == 100*int(band[0])+source_center_slice) & (np.abs(lambdaMap-lambcens[ibin])<=lambfwhms[ibin]/2.) & (~np.isnan(sci_img)))
-        coords_sliceoffsetminus1 = np.where((sliceMap == 100*int(band[0])+source_center_slice-1) & (np.abs(lambdaMap-lambcens[ibin])<=lambfwhms[ibin]/2.) & (~np.isnan(sci_img)))
-        coords_sliceoffsetplus1 = np.where((sliceMap == 100*int(band[0])+source_center_slice+1) & (np.abs(lambdaMap-lambcens[ibin])<=lambfwhms[ibin]/2.) & (~np.isnan(sci_img)))
-        if len(coords[0]) == 0:
-            failed_fits.append(ibin); continue
-        try:
-            popt,pcov = curve_fit(gauss1d_wBaseline, alphaMap[coords], sci_img[coords], p0=[sci_img[coords].max(),source_center_alpha,mrs_fwhm/2.355,0],method='lm')
-            popt_sliceoffsetminus1,pcov = curve_fit(gauss1d_wBaseline, alphaMap[coords_sliceoffsetminus1], sci_img[coords_sliceoffsetminus1], p0=[sci_img[coords_sliceoffsetminus1].max(),source_center_alpha,mrs_fwhm/2.355,0],method='lm')
-            popt_sliceoffsetplus1,pcov = curve_fit(gauss1d_wBaseline, alphaMap[coords_sliceoffsetplus1], sci_img[coords_sliceoffsetplus1], p0=[sci_img[coords_sliceoffsetplus1].max(),source_center_alpha,mrs_fwhm/2.355,0],method='lm')
-        except:
-            failed_fits.append(ibin); continue
+        coords = select_valid(100*int(band[0])+source_center_slice,ibin)
+        coords_sliceoffsetminus1 = select_valid(100*int(band[0])+source_center_slice-1,ibin)
+        coords_sliceoffsetplus1 = select_valid(100*int(band[0])+source_center_slice+1,ibin)
+        if len(coords) == 0:
+            diagnostics.record('along_slice',ibin,0,'no_pixels'); continue
+        profiles = [(alpha_flat[sel],sci_flat[sel]) for sel in [coords,coords_sliceoffsetminus1,coords_sliceoffsetplus1]]
+        tasks.append((profiles,source_center_alpha,mrs_fwhm/2.355))
+        task_bins.append(ibin)
+    for ibin,(popts,nfev,status) in zip(task_bins,fit_bins(_fit_along_slice_bin,_batch_along_slice_bins,tasks)):
+        diagnostics.record('along_slice',ibin,nfev,status)
+        if popts is None:
+            continue
+        popt,popt_sliceoffsetminus1,popt_sliceoffsetplus1 = popts
         sign_amp[ibin]      = popt[0]+popt[3]
         alpha_centers[ibin] = popt[1]
         alpha_fwhms[ibin]   = 2.355*np.abs(popt[2])
@@ -172,56 +588,62 @@ def point_source_centroiding(band,sci_img,d2cMaps,spec_grid=None,fit='2D',center
         bkg_signal_sliceoffsetplus1[ibin]    = popt_sliceoffsetplus1[3]
 
     # omit outliers
+    outliers = set()
     for i in range(len(np.diff(sign_amp))):
         if np.abs(np.diff(alpha_centers)[i]) > 0.05:
             sign_amp[i],sign_amp[i+1],alpha_centers[i],alpha_centers[i+1],alpha_fwhms[i],alpha_fwhms[i+1] = [np.nan for j in range(6)]
+            outliers.update([i,i+1])
+    diagnostics.outliers = len(outliers)
+    diagnostics.bins['status_along_slice'][sorted(outliers)] = 'outlier'
+    diagnostics.stage_times['along_slice'] = time.perf_counter()-start
 
-    if verbose:
-        print( '[Along-slice fit] The following bins failed to converge:')
-        print( failed_fits)
+    logger.log(level,'[Along-slice fit] The following bins failed to converge: %s',diagnostics.failed_bins('along_slice'))
 
     # Fit Gaussian distribution to across-slice signal profile (signal brute-summed in each slice)
+    start = time.perf_counter()
     summed_signal,beta_centers,beta_fwhms = [np.full((len(lambcens)),np.nan) for j in range(3)]
-    failed_fits = []
+    tasks,task_bins = [],[]
     for ibin in range(len(lambcens)):
         if np.isnan(alpha_centers[ibin]):
-            failed_fits.append(ibin)
+            diagnostics.record('across_slice',ibin,0,'skipped')
             continue
-        sel = (np.abs(lambdaMap-lambcens[ibin])<=lambfwhms[ibin]/2.) & (~np.isnan(sci_img))
         try:
-            signals = np.array([sci_img[(sliceMap == 100*int(band[0])+islice) & sel][np.abs(alphaMap[(sliceMap == 100*int(band[0])+islice) & sel]-alpha_centers[ibin]).argmin()] for islice in range(1,1+nslices)])
+            signals = []
+            for islice in range(1,1+nslices):
+                sel = select_valid(100*int(band[0])+islice,ibin)
+                signals.append(sci_flat[sel][np.abs(alpha_flat[sel]-alpha_centers[ibin]).argmin()])
+            signals = np.array(signals)
             signals[source_center_slice-2:source_center_slice+1] = np.array([sign_amp_sliceoffsetminus1[ibin],sign_amp[ibin],sign_amp_sliceoffsetplus1[ibin]])
         except ValueError:
-            failed_fits.append(ibin)
+            diagnostics.record('across_slice',ibin,0,'no_pixels')
             continue
-        try:
-            popt,pcov = curve_fit(gauss1d_wBaseline, unique_betas, signals, p0=[signals.max(),unique_betas[source_center_slice-1],mrs_fwhm/2.355,0],method='lm')
-        except:
-            failed_fits.append(ibin)
+        tasks.append((unique_betas,signals,unique_betas[source_center_slice-1],mrs_fwhm/2.355))
+        task_bins.append(ibin)
+    for ibin,(popt,nfev,status) in zip(task_bins,fit_bins(_fit_across_slice_bin,_batch_across_slice_bins,tasks)):
+        diagnostics.record('across_slice',ibin,nfev,status)
+        if popt is None:
             continue
         summed_signal[ibin] = popt[0]+popt[3]
         beta_centers[ibin]  = popt[1]
         beta_fwhms[ibin]    = 2.355*np.abs(popt[2])
+    diagnostics.stage_times['across_slice'] = time.perf_counter()-start
 
     # # omit outliers
     # for i in range(len(np.diff(summed_signal))):
     #     if np.abs(np.diff(beta_centers)[i]) > 0.05:
     #         summed_signal[i],summed_signal[i+1],beta_centers[i],beta_centers[i+1],beta_fwhms[i],beta_fwhms[i+1] = [np.nan for j in range(6)]
-    if verbose:
-        print( '[Across-slice fit] The following bins failed to converge:')
-        print( failed_fits)
-        print( '')
+    logger.log(level,'[Across-slice fit] The following bins failed to converge: %s',diagnostics.failed_bins('across_slice'))
 
     if fit == '1D':
         sigma_alpha, sigma_beta = alpha_fwhms/2.355, beta_fwhms/2.355
-        return sign_amp,alpha_centers,beta_centers,sigma_alpha,sigma_beta,bkg_signal
+        return finish(sign_amp,alpha_centers,beta_centers,sigma_alpha,sigma_beta,bkg_signal)
 
     elif fit == '2D':
-        if verbose:
-            print( 'STEP 3: 2D Gaussian fit')
+        logger.log(level,'STEP 3: 2D Gaussian fit')
+        start = time.perf_counter()
         sign_amp2D,alpha_centers2D,beta_centers2D,sigma_alpha2D,sigma_beta2D,bkg_amp2D = [np.full((len(lambcens)),np.nan) for j in range(6)]
-        failed_fits = []
 
+        tasks = []
         for ibin in range(len(lambcens)):
             # initial guess for fitting, informed by previous centroiding steps
             amp,alpha0,beta0  = sign_amp[ibin],alpha_centers[ibin],beta_centers[ibin]
@@ -231,15 +653,18 @@ def point_source_centroiding(band,sci_img,d2cMaps,spec_grid=None,fit='2D',center
             bounds = ([0,-np.inf,-np.inf,0,0,-np.inf],[np.inf,np.inf,np.inf,np.inf,np.inf,np.inf])
 
             # data to fit
-            coords = (np.abs(lambdaMap-lambcens[ibin])<lambfwhms[ibin]/2.)
-            alphas, betas, zobs   = alphaMap[coords],betaMap[coords],sci_img[coords]
+            coords = pixel_index.select_all(lambcens[ibin],lambfwhms[ibin]/2.,strict=True)
+            alphas, betas, zobs   = alpha_flat[coords],beta_flat[coords],sci_flat[coords]
             alphabetas = np.array([alphas,betas])
+            tasks.append((alphabetas,zobs,guess,bounds))
 
-            # perform fitting
-            try:
-                popt,pcov = curve_fit(gauss2d, alphabetas, zobs, p0=guess,bounds=bounds)
-            except:
-                failed_fits.append(ibin); continue
+        # perform fitting
+        for ibin,(popt,nfev,status) in enumerate(fit_bins(_fit_2D_bin,_batch_2D_bins,tasks)):
+            if popt is None and not np.all(np.isfinite(tasks[ibin][2])):
+                status = 'skipped' # no initial guess from the 1D fits
+            diagnostics.record('2D',ibin,nfev,status)
+            if popt is None:
+                continue
 
             sign_amp2D[ibin]      = popt[0]
             alpha_centers2D[ibin] = popt[1]
@@ -247,86 +672,241 @@ def point_source_centroiding(band,sci_img,d2cMaps,spec_grid=None,fit='2D',center
             sigma_alpha2D[ibin]   = popt[3]
             sigma_beta2D[ibin]    = popt[4]
             bkg_amp2D[ibin]       = popt[5]
-        if verbose:
-            print( 'The following bins failed to converge:')
-            print( failed_fits)
-
-        return sign_amp2D,alpha_centers2D,beta_centers2D,sigma_alpha2D,sigma_beta2D,bkg_amp2D
-
-def evaluate_psf_cdp(psffits,d2cMaps,source_center=[0,0],norm=True,cdp_slice=None):
-    # PSF CDP is provided as a spectral cube
-    #>get values
-    psf_values = psffits[1].data.transpose(2,1,0).copy() # flip data from Z,Y,X to X,Y,Z
-    if norm:
-        #>normalize values
-        print('Normalizing PSF (divide by sum of all spaxel values)')
-        for layer in range(psf_values.shape[2]):
-            psf_values[:,:,layer] /= psf_values[:,:,layer].sum()
-    if cdp_slice is not None:
-        # use only a single layer of the PSF CDP cube
-        print('Using single slice of PSF cube')
-        for layer in range(psf_values.shape[2]):
-            psf_values[:,:,layer] = psf_values[:,:,cdp_slice]
-
-    #>get grid
-    NAXIS1,NAXIS2,NAXIS3 = psf_values.shape
-
-    alphastpix = psffits[1].header['CRPIX1'] # pixel nr
-    alpha_step = psffits[1].header['CDELT1'] # arcsec/pix
-    stalpha    = psffits[1].header['CRVAL1']-(alphastpix-1)*alpha_step # arcsec
-
-    betastpix = psffits[1].header['CRPIX2'] # pixel nr
-    beta_step = psffits[1].header['CDELT2'] # arcsec/pix
-    stbeta    = psffits[1].header['CRVAL2']-(betastpix-1)*beta_step # arcsec
-
-    stwavl = psffits[1].header['CRVAL3'] # microns
-    wavl_step   = psffits[1].header['CDELT3'] # microns/pix
-
-    alpha_slices = np.linspace(stalpha,stalpha+ (NAXIS1-1.5)*alpha_step,NAXIS1)
-    beta_slices  = np.linspace(stbeta,stbeta+ (NAXIS2-1.5)*beta_step,NAXIS2)
-    wvl_slices   = np.linspace(stwavl ,stwavl+NAXIS3*wavl_step,NAXIS3)
-
-    #> center psf to source
-    alpha_slices += source_center[0]
-    beta_slices  += source_center[1]
-
-    #> create interpolant based on regular grid
-    interpolpsf = scp_interpolate.RegularGridInterpolator((alpha_slices,beta_slices,wvl_slices),psf_values)
-    interpolpsf.fill_value=0.
-    interpolpsf.bounds_error=False
-
-    # evaluate psf at each pixel center and pixel corner
-    alphaULMap = d2cMaps['alphaULMap']
-    alphaURMap = d2cMaps['alphaURMap']
-    alphaLLMap = d2cMaps['alphaLLMap']
-    alphaLRMap = d2cMaps['alphaLRMap']
-    alphaMap   = d2cMaps['alphaMap']
-
-    betaULMap = d2cMaps['betaULMap']
-    betaURMap = d2cMaps['betaURMap']
-    betaLLMap = d2cMaps['betaLLMap']
-    betaLRMap = d2cMaps['betaLRMap']
-    betaMap   = d2cMaps['betaMap']
-
-    lambdaULMap = d2cMaps['lambdaULMap']
-    lambdaURMap = d2cMaps['lambdaURMap']
-    lambdaLLMap = d2cMaps['lambdaLLMap']
-    lambdaLRMap = d2cMaps['lambdaLRMap']
-    lambdaMap = d2cMaps['lambdaMap']
-
-    #> interpolate psf to science image pixel centers and corners
-    #-- assume no significant change in wavelength over one pixel size
-    psfUL  = interpolpsf((alphaULMap,betaULMap,lambdaULMap))
-    psfUR  = interpolpsf((alphaURMap,betaURMap,lambdaURMap))
-    psfLL  = interpolpsf((alphaLLMap,betaLLMap,lambdaLLMap))
-    psfLR  = interpolpsf((alphaLRMap,betaLRMap,lambdaLRMap))
-    psfCEN = interpolpsf((alphaMap,betaMap,lambdaMap))
-
-    #> evaluate psf as a weighted average
-    w = np.array([0.125,0.125,0.125,0.125,0.5]) # WARNING: ARBITRARY!
-    sumweights = w.sum()
-
-    psf = (w[0]*psfUL+w[1]*psfUR+w[2]*psfLL+w[3]*psfLR+w[4]*psfCEN)/sumweights
+        diagnostics.stage_times['2D'] = time.perf_counter()-start
+        logger.log(level,'The following bins failed to converge: %s',diagnostics.failed_bins('2D'))
+
+        return finish(sign_amp2D,alpha_centers2D,beta_centers2D,sigma_alpha2D,sigma_beta2D,bkg_amp2D)
+
+centroid_fields = ['amp','alpha','beta','sigma_alpha','sigma_beta','bkg']
+
+def _open_stack(sci_imgs):
+    # a path to a .npy stack is memory-mapped, so exposures are only read from disk when they are fitted
+    if isinstance(sci_imgs,str):
+        return np.load(sci_imgs,mmap_mode='r')
+    return sci_imgs
+
+def point_source_centroiding_batch(band,sci_imgs,d2cMaps,spec_grid=None,fit='2D',center=None,offset_slice=0,verbose=False,n_workers=None,pool='process',solver='curve_fit',return_diagnostics=False):
+    """Centroid the point source in every exposure of a stack of detector images of one band.
+
+    sci_imgs is a (nexposures,1024,1032) array, a list of images, or the path of a .npy stack (which is
+    memory-mapped, so only one exposure at a time is held in memory). The PixelIndex and SliceStatistics
+    of d2cMaps are built once and shared by all exposures; the other arguments are as for
+    point_source_centroiding (center may also be given per exposure, as a list of (slice,alpha) pairs).
+
+    Returns a structured array: for fit='0D' of shape (nexposures,) with fields slice, beta and alpha;
+    for fit='1D' or '2D' of shape (nexposures,nbins) with fields lambda and the centroid_fields
+    amp, alpha, beta, sigma_alpha, sigma_beta, bkg. With return_diagnostics, the list of the
+    CentroidingDiagnostics of the exposures is returned as well.
+    """
+    sci_imgs    = _open_stack(sci_imgs)
+    nexposures  = len(sci_imgs)
+    pixel_index = PixelIndex(d2cMaps,band)
+    slice_stats = SliceStatistics(d2cMaps,band)
+    if center is None or np.ndim(center) == 1:
+        centers = [center]*nexposures
+    else:
+        centers = center
 
-    print('DONE')
+    if fit == '0D':
+        results = np.zeros(nexposures,dtype=[('slice',int),('beta',float),('alpha',float)])
+    else:
+        nbins   = len(spec_grid[0])
+        results = np.full((nexposures,nbins),np.nan,dtype=[('lambda',float)]+[(name,float) for name in centroid_fields])
+        results['lambda'] = spec_grid[0]
+
+    diagnostics = []
+    for iexp in range(nexposures):
+        logger.log(logging.INFO if verbose else logging.DEBUG,'Exposure {}/{}'.format(iexp+1,nexposures))
+        out = point_source_centroiding(band,np.asarray(sci_imgs[iexp]),d2cMaps,spec_grid=spec_grid,fit=fit,center=centers[iexp],
+                                       offset_slice=offset_slice,verbose=verbose,pixel_index=pixel_index,n_workers=n_workers,
+                                       pool=pool,solver=solver,slice_stats=slice_stats,return_diagnostics=True)
+        out,exposure_diagnostics = out[:-1],out[-1]
+        diagnostics.append(exposure_diagnostics)
+        if fit == '0D':
+            results[iexp] = out
+        else:
+            for name,values in zip(centroid_fields,out):
+                results[name][iexp] = values
+    if return_diagnostics:
+        return results,diagnostics
+    return results
+
+class PSFModel(object):
+    """PSF CDP cube prepared for repeated evaluation on the detector plane.
+
+    The normalized cube and its interpolant are built once, and only the pixels whose centre or corners
+    fall within the wavelength range of the cube are evaluated (the PSF is zero elsewhere). A different
+    source_center only shifts the (alpha,beta) coordinates at which the interpolant is queried.
+    The setup steps are logged, at INFO level if verbose, else DEBUG.
+    """
+    # weights of the UL, UR, LL, LR corners and of the centre of the pixels
+    weights = np.array([0.125,0.125,0.125,0.125,0.5]) # WARNING: ARBITRARY!
+    positions = ['UL','UR','LL','LR','']
+
+    def __init__(self,psffits,d2cMaps,norm=True,cdp_slice=None,verbose=False):
+        # PSF CDP is provided as a spectral cube
+        level = logging.INFO if verbose else logging.DEBUG
+        self.norm,self.cdp_slice = norm,cdp_slice
+        #>get values
+        psf_values = psffits[1].data.transpose(2,1,0).copy() # flip data from Z,Y,X to X,Y,Z
+        if norm:
+            #>normalize values
+            logger.log(level,'Normalizing PSF (divide by sum of all spaxel values)')
+            psf_values /= psf_values.sum(axis=(0,1))
+        if cdp_slice is not None:
+            # use only a single layer of the PSF CDP cube
+            logger.log(level,'Using single slice of PSF cube')
+            psf_values[:,:,:] = psf_values[:,:,cdp_slice][:,:,None]
+
+        #>get grid
+        NAXIS1,NAXIS2,NAXIS3 = psf_values.shape
+        header = psffits[1].header
+        stalpha = header['CRVAL1']-(header['CRPIX1']-1)*header['CDELT1'] # arcsec
+        stbeta  = header['CRVAL2']-(header['CRPIX2']-1)*header['CDELT2'] # arcsec
+        stwavl  = header['CRVAL3'] # microns
+
+        alpha_slices = np.linspace(stalpha,stalpha+ (NAXIS1-1.5)*header['CDELT1'],NAXIS1)
+        beta_slices  = np.linspace(stbeta,stbeta+ (NAXIS2-1.5)*header['CDELT2'],NAXIS2)
+        wvl_slices   = np.linspace(stwavl ,stwavl+NAXIS3*header['CDELT3'],NAXIS3)
+
+        #> create interpolant based on regular grid (for a source at alpha,beta = 0,0)
+        self.interpolpsf = scp_interpolate.RegularGridInterpolator((alpha_slices,beta_slices,wvl_slices),psf_values,
+                                                                   bounds_error=False,fill_value=0.)
+
+        #> in-band pixels, and their centre and corner coordinates
+        self.detector_shape = d2cMaps['lambdaMap'].shape
+        lambdas = np.array([np.ravel(d2cMaps['lambda'+pos+'Map']) for pos in self.positions])
+        inband = np.any((lambdas >= wvl_slices[0]) & (lambdas <= wvl_slices[-1]),axis=0)
+        self.flat_idx = np.flatnonzero(inband)
+        self.alphas   = np.array([np.ravel(d2cMaps['alpha'+pos+'Map'])[self.flat_idx] for pos in self.positions])
+        self.betas    = np.array([np.ravel(d2cMaps['beta'+pos+'Map'])[self.flat_idx] for pos in self.positions])
+        self.lambdas  = lambdas[:,self.flat_idx]
+
+    def evaluate_inband(self,source_center=[0,0]):
+        # PSF at the in-band pixels (flat detector indices self.flat_idx), for a source at source_center
+        #> interpolate psf to science image pixel centers and corners, all in one call
+        #-- assume no significant change in wavelength over one pixel size
+        points = np.stack([self.alphas-source_center[0],self.betas-source_center[1],self.lambdas],axis=-1)
+        psf_positions = self.interpolpsf(points.reshape(-1,3)).reshape(self.alphas.shape)
+
+        #> evaluate psf as a weighted average
+        return self.weights.dot(psf_positions)/self.weights.sum()
+
+    def __call__(self,source_center=[0,0]):
+        # PSF on the full detector plane, for a source at source_center
+        psf = np.zeros(self.detector_shape)
+        psf.flat[self.flat_idx] = self.evaluate_inband(source_center)
+        return psf
+
+def evaluate_psf_cdp(psffits,d2cMaps,source_center=[0,0],norm=True,cdp_slice=None,psf_model=None):
+    # psf_model: PSFModel of psffits and d2cMaps; pass one in to reuse it when evaluating many source centers.
+    # It must have been built with the same norm and cdp_slice, which it fixes once and for all
+    if psf_model is None:
+        psf_model = PSFModel(psffits,d2cMaps,norm=norm,cdp_slice=cdp_slice)
+    elif (psf_model.norm,psf_model.cdp_slice) != (norm,cdp_slice):
+        raise ValueError('psf_model was built with norm={}, cdp_slice={}, not norm={}, cdp_slice={}'.format(psf_model.norm,psf_model.cdp_slice,norm,cdp_slice))
+    psf = psf_model(source_center)
+
+    logger.debug('PSF evaluated for a source at alpha,beta = {} arcsec'.format(source_center))
     return psf
+
+#--optimal extraction
+def _row_wavelength_step(d2cMaps,band):
+    # median wavelength difference between vertically adjacent pixels of the same slice, in band
+    channel   = int(band[0])
+    sliceMap  = d2cMaps['sliceMap']
+    lambdaMap = d2cMaps['lambdaMap']
+    same_slice = (sliceMap[1:] == sliceMap[:-1]) & (sliceMap[1:] >= 100*channel) & (sliceMap[1:] < 100*(channel+1))
+    steps = np.abs(np.diff(lambdaMap,axis=0))[same_slice]
+    return np.nanmedian(steps)
+
+def _extraction_design(band,psf_img,d2cMaps,wavelengths,fit_background,min_psf,pixel_index):
+    # pixels (flat detector indices) falling in the wavelength bins centered on wavelengths, their bin and
+    # their model terms (psf and 1), the rows of the design matrix in the (amplitude,background) columns of
+    # their bin
+    if pixel_index is None:
+        pixel_index = PixelIndex(d2cMaps,band)
+    wavelengths = np.atleast_1d(np.asarray(wavelengths,dtype=float))
+    if len(wavelengths) == 1:
+        #> a single bin is as wide as the wavelength step between adjacent detector rows
+        halfwidth = _row_wavelength_step(d2cMaps,band)/2.
+        edges = np.array([wavelengths[0]-halfwidth,wavelengths[0]+halfwidth])
+    else:
+        edges = np.concatenate([[1.5*wavelengths[0]-0.5*wavelengths[1]],(wavelengths[1:]+wavelengths[:-1])/2.,[1.5*wavelengths[-1]-0.5*wavelengths[-2]]])
+    ibin = np.searchsorted(edges,pixel_index.lambdas_all,side='right')-1
+    psf_values = np.ravel(psf_img)[pixel_index.flat_idx_all]
+    keep = (ibin >= 0) & (ibin < len(wavelengths)) & (psf_values > min_psf)
+    flat_idx,ibin,psf_values = pixel_index.flat_idx_all[keep],ibin[keep],psf_values[keep]
+
+    terms = np.column_stack([psf_values,np.ones(len(flat_idx))][:1+fit_background])
+    return flat_idx,ibin,terms
+
+def _solve_extraction(nbins,ibin,terms,data,weights,scale_by_chi2):
+    #> weighted normal equations of all nbins bins; every pixel is in one bin only, so the normal matrix is
+    # block diagonal, with one (amp,bkg) block per bin, and the blocks are solved all at once. Bins without
+    # enough valid pixels for a non-singular block are left out (NaN)
+    nparams = terms.shape[1]
+    blocks = np.array([[np.bincount(ibin,weights=weights*terms[:,k]*terms[:,l],minlength=nbins) for l in range(nparams)]
+                       for k in range(nparams)]).transpose(2,0,1)
+    rhs    = np.array([np.bincount(ibin,weights=weights*terms[:,k]*data,minlength=nbins) for k in range(nparams)]).T
+    det  = np.linalg.det(blocks)
+    good = np.abs(det) > 1e-12*np.abs(blocks).max(axis=(1,2),initial=0)**nparams
+
+    params = np.full((nbins,nparams),np.nan)
+    covariance = np.full((nbins,nparams,nparams),np.nan)
+    covariance[good] = np.linalg.inv(blocks[good])
+    params[good] = np.linalg.solve(blocks[good],rhs[good][:,:,None])[:,:,0]
+
+    if scale_by_chi2:
+        #> without a variance map, scale the covariance by the reduced chi-square of each bin
+        valid = (weights > 0).astype(float)
+        resid = data-np.sum(terms*np.nan_to_num(params)[ibin],axis=1)
+        chi2  = np.bincount(ibin,weights=valid*resid**2,minlength=nbins)
+        ndof  = np.bincount(ibin,weights=valid,minlength=nbins)-nparams
+        with np.errstate(invalid='ignore',divide='ignore'):
+            covariance *= np.where(ndof > 0,chi2/ndof,np.nan)[:,None,None]
+    return params,covariance
+
+def optimal_extraction(band,sci_img,psf_img,d2cMaps,wavelengths,var_img=None,fit_background=True,min_psf=0.,pixel_index=None):
+    """PSF-weighted optimal extraction of a point source spectrum, for all wavelength bins at once.
+
+    Every in-band pixel is assigned to the wavelength bin (centered on wavelengths) its wavelength falls
+    in, and modelled as amp*psf_img (+ bkg) with one source amplitude (and background) per bin. The
+    normal equations of the weighted least-squares system of all bins (one 2x2 block per bin) are
+    accumulated from the pixel model terms and solved for all bins at once, with weights 1/var_img if given
+    (NaN pixels, and pixels with psf_img <= min_psf, are left out). A single wavelength gets a bin as wide
+    as the wavelength step between adjacent detector rows.
+    sci_img (and var_img) may also be a stack of exposures (n,1024,1032), which share the pixel model terms.
+
+    Returns the spectrum (amp), the background (None if fit_background is False) and the covariance of
+    (amp,bkg) in each bin, as a (nbins,2,2) array ((nbins,1,1) without background). Without var_img, the
+    covariance is scaled by the reduced chi-square of each bin. For a stack, every output gets a leading
+    exposure axis.
+    """
+    flat_idx,ibin,terms = _extraction_design(band,psf_img,d2cMaps,wavelengths,fit_background,min_psf,pixel_index)
+    nbins = np.size(wavelengths)
+
+    sci_img = np.asarray(sci_img)
+    stack = sci_img.ndim == 3
+    sci_imgs = sci_img if stack else sci_img[None]
+    var_imgs = None if var_img is None else (np.asarray(var_img) if stack else np.asarray(var_img)[None])
+
+    spectra,backgrounds,covariances = [],[],[]
+    for iexp in range(len(sci_imgs)):
+        data = np.ravel(sci_imgs[iexp])[flat_idx].astype(float)
+        if var_imgs is None:
+            weights = np.ones(len(data))
+        else:
+            with np.errstate(invalid='ignore',divide='ignore'):
+                weights = 1./np.ravel(var_imgs[iexp])[flat_idx]
+        weights[~np.isfinite(data) | ~np.isfinite(weights) | (weights <= 0)] = 0.
+        data = np.where(weights > 0,data,0.)
+
+        params,covariance = _solve_extraction(nbins,ibin,terms,data,weights,var_imgs is None)
+        spectra.append(params[:,0])
+        backgrounds.append(params[:,1] if fit_background else None)
+        covariances.append(covariance)
+
+    if stack:
+        return np.array(spectra),(np.array(backgrounds) if fit_background else None),np.array(covariances)
+    return spectra[0],backgrounds[0],covariances[0]
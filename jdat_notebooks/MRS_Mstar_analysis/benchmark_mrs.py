@@ -0,0 +1,204 @@
+"""
+Benchmarks of the MRS detector-based extraction functions, on synthetic distortion and PSF CDPs
+
+For every band, each function is timed and every fast path is checked against its reference: the
+d2cMapping engines, d2cMapping_compact, d2cMapping_cached (building, loading from disk and from memory)
+and d2cMapping_bands against the slice-by-slice 'loop' engine, the batched centroiding solver and the
+process pool against serial curve_fit, point_source_centroiding_batch against single-exposure calls,
+PSFModel against the original evaluate_psf_cdp algorithm, DetectorCubeResampler against the summed
+detector signal (which it conserves), and optimal_extraction against per-bin least squares.
+
+=============EXAMPLE OF USE:===============
+python benchmark_mrs.py --bands 1A 2B 3C 4A --repeat 3
+
+# or, from python
+from benchmark_mrs import run_benchmarks
+results = run_benchmarks(['1A'],repeat=3)
+==========================================
+"""
+
+import time
+import argparse
+import tempfile
+
+import numpy as np
+import scipy.interpolate as scp_interpolate
+
+import create_distortionMaps as distortionMaps
+import PointSourceDetectorBasedExtractionFuncs as extractionFuncs
+from d2cResampling import DetectorCubeResampler
+from synthetic_mrs_data import write_distortion_cdps, psf_cdp, point_source_image
+
+def _timeit(func,repeat=3):
+    # best wall time (s) of repeat calls of func, and the result of the last call
+    best = np.inf
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best,time.perf_counter()-start)
+    return best,result
+
+def _max_difference(maps,reference,keys):
+    return max([np.nanmax(np.abs(np.asarray(maps[key],dtype=float)-reference[key]),initial=0) for key in keys])
+
+def _record(results,band,name,seconds,difference=None,tolerance=None):
+    passed = None if difference is None else bool(difference <= tolerance)
+    results.append({'band':band,'benchmark':name,'seconds':seconds,'max_difference':difference,'tolerance':tolerance,'passed':passed})
+
+def benchmark_d2cMapping(band,cdpDir,results,repeat=3):
+    t_ref,reference = _timeit(lambda: distortionMaps.d2cMapping(band,cdpDir,engine='loop'),repeat)
+    _record(results,band,'d2cMapping[loop]',t_ref)
+    for engine in ['vectorized','lattice']:
+        seconds,d2cMaps = _timeit(lambda: distortionMaps.d2cMapping(band,cdpDir,engine=engine),repeat)
+        _record(results,band,'d2cMapping[{}]'.format(engine),seconds,_max_difference(d2cMaps,reference,distortionMaps._map_names),1e-9)
+    seconds,compact = _timeit(lambda: distortionMaps.d2cMapping_compact(band,cdpDir,dtype=np.float64),repeat)
+    _record(results,band,'d2cMapping_compact',seconds,_max_difference(compact,reference,distortionMaps._map_names),1e-9)
+    return reference
+
+def benchmark_d2cMapping_cached(band,cdpDir,reference,results,repeat=3):
+    # first call (maps built and stored), then loaded from disk (in-memory cache emptied) and from memory
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cached = lambda: distortionMaps.d2cMapping_cached(band,cdpDir,cache_dir=cache_dir)
+        def from_disk():
+            distortionMaps._d2cMaps_lru.clear()
+            return cached()
+        for name,func,nrepeat in [('build',cached,1),('disk',from_disk,repeat),('memory',cached,repeat)]:
+            seconds,d2cMaps = _timeit(func,nrepeat)
+            _record(results,band,'d2cMapping_cached[{}]'.format(name),seconds,_max_difference(d2cMaps,reference,distortionMaps._map_names),1e-9)
+        distortionMaps._d2cMaps_lru.clear()
+
+def benchmark_d2cMapping_bands(bands,cdpDir,references,results,repeat=3):
+    # all bands at once, in a process pool, against the per-band 'loop' maps
+    seconds,maps = _timeit(lambda: distortionMaps.d2cMapping_bands(bands,cdpDir),repeat)
+    difference = max([_max_difference(maps[band],references[band],distortionMaps._map_names) for band in bands])
+    _record(results,'all','d2cMapping_bands',seconds,difference,1e-9)
+
+def _centroid_difference(centroids,reference):
+    # largest difference of the fitted centroids (alpha,beta) in the bins where both fits converged
+    return np.nanmax(np.abs(np.array(centroids)-np.array(reference[1:3])),initial=0)
+
+def benchmark_centroiding(band,d2cMaps,sci_img,spec_grid,results,repeat=3,n_workers=2):
+    pixel_index = extractionFuncs.PixelIndex(d2cMaps,band)
+    slice_stats = extractionFuncs.SliceStatistics(d2cMaps,band)
+    kwargs = dict(spec_grid=spec_grid,fit='2D',verbose=False,pixel_index=pixel_index,slice_stats=slice_stats)
+    seconds,reference = _timeit(lambda: extractionFuncs.point_source_centroiding(band,sci_img,d2cMaps,**kwargs),repeat)
+    _record(results,band,'point_source_centroiding[curve_fit]',seconds)
+    seconds,pooled = _timeit(lambda: extractionFuncs.point_source_centroiding(band,sci_img,d2cMaps,n_workers=n_workers,pool='process',**kwargs),repeat)
+    _record(results,band,'point_source_centroiding[process pool]',seconds,_centroid_difference(pooled[1:3],reference),1e-12)
+    seconds,batch = _timeit(lambda: extractionFuncs.point_source_centroiding(band,sci_img,d2cMaps,solver='batch',**kwargs),repeat)
+    _record(results,band,'point_source_centroiding[batch]',seconds,_centroid_difference(batch[1:3],reference),1e-4)
+    return reference
+
+def benchmark_centroiding_batch(band,d2cMaps,sci_img,spec_grid,reference,results,repeat=3,nexposures=3):
+    # a stack of exposures (sci_img first, then other noise realisations), against the single-exposure fit
+    sci_imgs = np.array([sci_img]+[point_source_image(band,d2cMaps,source_center=[0.3,-0.1],seed=seed)[0] for seed in range(1,nexposures)])
+    seconds,batch = _timeit(lambda: extractionFuncs.point_source_centroiding_batch(band,sci_imgs,d2cMaps,spec_grid=spec_grid,fit='2D'),repeat)
+    _record(results,band,'point_source_centroiding_batch[{} exp]'.format(nexposures),seconds,
+            _centroid_difference([batch['alpha'][0],batch['beta'][0]],reference),1e-12)
+
+def _evaluate_psf_cdp_reference(psffits,d2cMaps,source_center=[0,0]):
+    # the original evaluate_psf_cdp: the (normalized) PSF cube grid is moved to source_center, and the
+    # interpolant is evaluated at the centre and corners of every detector pixel
+    psf_values = psffits[1].data.transpose(2,1,0).copy() # flip data from Z,Y,X to X,Y,Z
+    for layer in range(psf_values.shape[2]):
+        psf_values[:,:,layer] /= psf_values[:,:,layer].sum()
+
+    NAXIS1,NAXIS2,NAXIS3 = psf_values.shape
+    header = psffits[1].header
+    stalpha = header['CRVAL1']-(header['CRPIX1']-1)*header['CDELT1'] # arcsec
+    stbeta  = header['CRVAL2']-(header['CRPIX2']-1)*header['CDELT2'] # arcsec
+    stwavl  = header['CRVAL3'] # microns
+    alpha_slices = np.linspace(stalpha,stalpha+ (NAXIS1-1.5)*header['CDELT1'],NAXIS1)+source_center[0]
+    beta_slices  = np.linspace(stbeta,stbeta+ (NAXIS2-1.5)*header['CDELT2'],NAXIS2)+source_center[1]
+    wvl_slices   = np.linspace(stwavl ,stwavl+NAXIS3*header['CDELT3'],NAXIS3)
+    interpolpsf = scp_interpolate.RegularGridInterpolator((alpha_slices,beta_slices,wvl_slices),psf_values,
+                                                          bounds_error=False,fill_value=0.)
+
+    w = np.array([0.125,0.125,0.125,0.125,0.5])
+    psf = sum([wi*interpolpsf((d2cMaps['alpha'+pos+'Map'],d2cMaps['beta'+pos+'Map'],d2cMaps['lambda'+pos+'Map']))
+               for wi,pos in zip(w,['UL','UR','LL','LR',''])])
+    return psf/w.sum()
+
+def benchmark_psf(band,d2cMaps,results,repeat=3,source_center=[0.3,-0.1]):
+    psffits = psf_cdp(band)
+    seconds,reference = _timeit(lambda: _evaluate_psf_cdp_reference(psffits,d2cMaps,source_center),repeat)
+    _record(results,band,'evaluate_psf_cdp[original]',seconds)
+    seconds,psf_model = _timeit(lambda: extractionFuncs.PSFModel(psffits,d2cMaps),repeat)
+    _record(results,band,'PSFModel[build]',seconds)
+    seconds,psf = _timeit(lambda: psf_model(source_center),repeat)
+    #> float32 tolerance: the cube layers are normalized in float32, summed in a different order
+    _record(results,band,'PSFModel[evaluate]',seconds,np.abs(psf-reference).max()/reference.max(),1e-5)
+    return psf
+
+def benchmark_resampling(band,d2cMaps,sci_img,results,repeat=3):
+    # cube of one spaxel per alpha pixel and slice, and two spectral pixels; with mode='sum' every in-band
+    # pixel is distributed over the cube in full, so the summed signal is the reference
+    alpha_step,lambda_step = extractionFuncs.mrs_aux(band)[5],2*extractionFuncs.mrs_aux(band)[9]
+    seconds,resampler = _timeit(lambda: DetectorCubeResampler.from_d2cMaps(d2cMaps,band,alpha_step,lambda_step),repeat)
+    _record(results,band,'DetectorCubeResampler[build]',seconds)
+    seconds,cube = _timeit(lambda: resampler.resample(sci_img,mode='sum'),repeat)
+    total = np.nansum(sci_img[resampler.pixels])
+    _record(results,band,'DetectorCubeResampler[resample]',seconds,abs(np.nansum(cube)-total)/abs(total),1e-10)
+
+def benchmark_extraction(band,d2cMaps,psf_img,results,repeat=3,nbins=60):
+    lmin,lmax = extractionFuncs.mrs_aux(band)[3]
+    wavelengths = np.linspace(lmin+0.01*(lmax-lmin),lmax-0.01*(lmax-lmin),nbins)
+    rng = np.random.default_rng(1)
+    sci_img = 1000*psf_img+3.+0.5*rng.standard_normal(psf_img.shape)
+    var_img = np.full(psf_img.shape,0.25)
+    seconds,(spectrum,background,covariance) = _timeit(lambda: extractionFuncs.optimal_extraction(band,sci_img,psf_img,d2cMaps,wavelengths,var_img=var_img),repeat)
+
+    #> reference: an unweighted (the variance is uniform) least-squares fit per bin
+    pixel_index = extractionFuncs.PixelIndex(d2cMaps,band)
+    flat_idx,ibin,terms = extractionFuncs._extraction_design(band,psf_img,d2cMaps,wavelengths,True,0.,pixel_index)
+    reference = np.full(nbins,np.nan)
+    for i in range(nbins):
+        sel = ibin == i
+        if sel.sum() > 2:
+            reference[i] = np.linalg.lstsq(terms[sel],np.ravel(sci_img)[flat_idx[sel]],rcond=None)[0][0]
+    _record(results,band,'optimal_extraction',seconds,np.nanmax(np.abs(spectrum-reference)/np.abs(reference)),1e-8)
+
+def run_benchmarks(bands,cdpDir=None,repeat=3,nbins=60):
+    # run all benchmarks for bands; synthetic distortion CDPs are written to a temporary directory unless
+    # cdpDir (with CDPs, real or synthetic) is given. Returns a list of records (band, benchmark, best
+    # wall time, largest difference to the reference, tolerance and whether it passed)
+    results = []
+    references = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if cdpDir is None:
+            cdpDir = write_distortion_cdps(tmpdir)
+        for band in bands:
+            d2cMaps = references[band] = benchmark_d2cMapping(band,cdpDir,results,repeat)
+            benchmark_d2cMapping_cached(band,cdpDir,d2cMaps,results,repeat)
+            lmin,lmax = extractionFuncs.mrs_aux(band)[3]
+            spec_grid = [np.linspace(lmin+0.01*(lmax-lmin),lmax-0.01*(lmax-lmin),nbins),np.full(nbins,(lmax-lmin)/200.)]
+            sci_img,err_img = point_source_image(band,d2cMaps,source_center=[0.3,-0.1])
+            centroids = benchmark_centroiding(band,d2cMaps,sci_img,spec_grid,results,repeat)
+            benchmark_centroiding_batch(band,d2cMaps,sci_img,spec_grid,centroids,results,repeat)
+            psf_img = benchmark_psf(band,d2cMaps,results,repeat)
+            benchmark_resampling(band,d2cMaps,sci_img,results,repeat)
+            benchmark_extraction(band,d2cMaps,psf_img,results,repeat,nbins)
+        benchmark_d2cMapping_bands(bands,cdpDir,references,results,repeat)
+    return results
+
+def print_results(results):
+    print('{:<5} {:<40} {:>10} {:>12} {:>7}'.format('band','benchmark','time [s]','max diff','check'))
+    for r in results:
+        difference = '' if r['max_difference'] is None else '{:.2e}'.format(r['max_difference'])
+        check = '' if r['passed'] is None else ('ok' if r['passed'] else 'FAILED')
+        print('{:<5} {:<40} {:>10.4f} {:>12} {:>7}'.format(r['band'],r['benchmark'],r['seconds'],difference,check))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the MRS detector-based extraction functions on synthetic CDPs.')
+    parser.add_argument('--bands',nargs='+',default=['1A','2A','3A','4A'],help='MRS bands to benchmark.')
+    parser.add_argument('--cdp-dir',default=None,dest='cdpDir',help='Directory with distortion CDPs (default: synthetic ones).')
+    parser.add_argument('--repeat',type=int,default=3,help='Number of timed calls per benchmark (the best is reported).')
+    parser.add_argument('--nbins',type=int,default=60,help='Number of wavelength bins for centroiding and extraction.')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.bands,cdpDir=args.cdpDir,repeat=args.repeat,nbins=args.nbins)
+    print_results(results)
+    return 0 if all([r['passed'] is not False for r in results]) else 1
+
+if __name__ == '__main__':
+    raise SystemExit(main())
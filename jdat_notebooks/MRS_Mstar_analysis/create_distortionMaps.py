@@ -26,6 +26,19 @@ band = '2A'
 # make dictionary containing all cube coordinate maps
 d2cMaps = d2cMapping(band,cdpDir)
 
+# or, to reuse maps computed in an earlier session (stored on disk, memory-mapped on load)
+from distortionMaps import d2cMapping_cached
+d2cMaps = d2cMapping_cached(band,cdpDir)
+
+# or, to hold many bands at once (only in-band pixels stored, corner maps computed on first access)
+from distortionMaps import d2cMapping_compact
+d2cMaps = d2cMapping_compact(band,cdpDir,dtype=np.float32)
+
+# or, to build several bands at once (each CDP file read once, bands computed in parallel)
+from distortionMaps import d2cMapping_bands
+allMaps = d2cMapping_bands(['1A','2A','3A','4A'],cdpDir)
+d2cMaps = allMaps['2A']
+
 # plot wavelength map
 import matplotlib.pyplot as plt
 plt.imshow(d2cMaps['lambdaMap'])
@@ -33,10 +46,18 @@ plt.show()
 ==========================================
 """
 
-import numpy as np
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
+from collections.abc import Mapping
 
-def d2cMapping(band,cdpDir,slice_transmission='80pc',fileversion = "8B.05.02"):
+import numpy as np
 
+def mrs_distortion_cdps(fileversion = "8B.05.02"):
     # all MRS distortion files
     distcdp = {}
     distcdp["3C"] = "MIRI_FM_MIRIFULONG_34LONG_DISTORTION_%s.fits" %fileversion
@@ -54,12 +75,53 @@ def d2cMapping(band,cdpDir,slice_transmission='80pc',fileversion = "8B.05.02"):
     distcdp["2C"] = distcdp["1C"]
     distcdp["2B"] = distcdp["1B"]
     distcdp["2A"] = distcdp["1A"]
+    return distcdp
+
+def d2cMapping(band,cdpDir,slice_transmission='80pc',fileversion = "8B.05.02",engine='vectorized'):
+    # engine: 'vectorized' evaluates the distortion polynomials for all in-band pixels at once,
+    #         'lattice' evaluates them once per slice on the lattice of pixel corners (shared by
+    #         neighbouring pixels) and gathers the corner maps from it,
+    #         'loop' is the original slice-by-slice implementation (kept as reference)
+    _check_engine(engine)
 
+    # all MRS distortion files
+    distcdp = mrs_distortion_cdps(fileversion)
 
     # import parameters needed for d2c mapping
+    alphaPoly,lambdaPoly,bdel,bzero,sliceMap = _read_distortion_cdp(band,cdpDir+distcdp[band],slice_transmission,fileversion)
+
+    return _build_d2cMaps(int(band[0]),sliceMap,alphaPoly,lambdaPoly,bdel,bzero,distcdp[band],engine)
+
+_engines = ['vectorized','lattice','loop']
+
+def _check_engine(engine):
+    if engine not in _engines:
+        raise ValueError("engine has to be one of 'vectorized', 'lattice' or 'loop', not {!r}".format(engine))
+
+def _build_d2cMaps(channel,sliceMap,alphaPoly,lambdaPoly,bdel,bzero,cdp_filename,engine='vectorized'):
+    # create maps with wavelengths, alpha and beta coordinates and pixel size
+
+    #> slice numbers in the slice map of the distortion CDP for this band
+    sliceInventory = np.unique(sliceMap)
+    slicesInBand = sliceInventory[np.where( (sliceInventory >= 100*channel ) & (sliceInventory <100*(channel+1)))]
+
+    _check_engine(engine)
+    if engine == 'vectorized':
+        maps = _d2cMaps_vectorized(channel,sliceMap,alphaPoly,lambdaPoly,bdel,bzero)
+    elif engine == 'lattice':
+        maps = _d2cMaps_lattice(channel,sliceMap,alphaPoly,lambdaPoly,bdel,bzero)
+    else:
+        maps = _d2cMaps_loop(channel,sliceMap,slicesInBand,alphaPoly,lambdaPoly,bdel,bzero)
+
+    d2cMaps = {'sliceMap':sliceMap}
+    d2cMaps.update((key,maps[key]) for key in _map_names)
+    d2cMaps.update({'bdel':bdel,'bzero':bzero,'nslices':len(slicesInBand),'cdp_filename':cdp_filename})
+    return d2cMaps
+
+def _read_distortion_cdp(band,cdpFile,slice_transmission,fileversion):
     if fileversion[:5] in ['7B.05','07.05','8B.05','08.05']:
         from astropy.io import fits
-        dist = fits.open(cdpDir+distcdp[band])
+        dist = fits.open(cdpFile)
         alphaPoly = dist['Alpha_CH{}'.format(band[0])].data
         lambdaPoly = dist['Lambda_CH{}'.format(band[0])].data
         bdel = dist[0].header['B_DEL{}'.format(band[0])]
@@ -71,7 +133,7 @@ def d2cMapping(band,cdpDir,slice_transmission='80pc',fileversion = "8B.05.02"):
 
     else:
         from astropy.io import fits
-        dist = fits.open(cdpDir+distcdp[band])
+        dist = fits.open(cdpFile)
         alphaPoly = dist['Alpha_CH{}'.format(band[0])].data
         lambdaPoly = dist['Lambda_CH{}'.format(band[0])].data
         bdel = dist[0].header['B_DEL{}'.format(band[0])]
@@ -81,13 +143,15 @@ def d2cMapping(band,cdpDir,slice_transmission='80pc',fileversion = "8B.05.02"):
         sliceMap = dist['Slice_Number'].data
         dist.close()
 
-    # create maps with wavelengths, alpha and beta coordinates and pixel size
+    return alphaPoly,lambdaPoly,bdel,bzero,sliceMap
 
-    channel = int(band[0])
-    #> slice numbers in the slice map of the distortion CDP for this band
-    sliceInventory = np.unique(sliceMap)
-    slicesInBand = sliceInventory[np.where( (sliceInventory >= 100*channel ) & (sliceInventory <100*(channel+1)))]
+#> names of the coordinate maps, in the order they appear in the d2cMaps dictionary
+_map_names = ['alphaMap','betaMap','lambdaMap',
+              'alphaLLMap','alphaLRMap','alphaULMap','alphaURMap',
+              'betaLLMap','betaLRMap','betaULMap','betaURMap',
+              'lambdaLLMap','lambdaLRMap','lambdaULMap','lambdaURMap']
 
+def _d2cMaps_loop(channel,sliceMap,slicesInBand,alphaPoly,lambdaPoly,bdel,bzero):
     #> initialise the maps with wavelengths, alpha and beta coordinates of corners for every pixel
     lambdaMap  = np.zeros(sliceMap.shape)
     lambdaLLMap = np.zeros(sliceMap.shape)
@@ -195,9 +259,308 @@ def d2cMapping(band,cdpDir,slice_transmission='80pc',fileversion = "8B.05.02"):
         betaURMap[pixels] = betasUR
         betaMap[pixels]   = betas
 
-    d2cMaps = {'sliceMap':sliceMap,'alphaMap':alphaMap,'betaMap':betaMap,'lambdaMap':lambdaMap,
-               'alphaLLMap':alphaLLMap,'alphaLRMap':alphaLRMap,'alphaULMap':alphaULMap,'alphaURMap':alphaURMap,
-               'betaLLMap':betaLLMap,'betaLRMap':betaLRMap,'betaULMap':betaULMap,'betaURMap':betaURMap,
-               'lambdaLLMap':lambdaLLMap,'lambdaLRMap':lambdaLRMap,'lambdaULMap':lambdaULMap,'lambdaURMap':lambdaURMap,
-               'bdel':bdel,'bzero':bzero,'nslices':len(slicesInBand),'cdp_filename':distcdp[band]}
+    return {'alphaMap':alphaMap,'betaMap':betaMap,'lambdaMap':lambdaMap,
+            'alphaLLMap':alphaLLMap,'alphaLRMap':alphaLRMap,'alphaULMap':alphaULMap,'alphaURMap':alphaURMap,
+            'betaLLMap':betaLLMap,'betaLRMap':betaLRMap,'betaULMap':betaULMap,'betaURMap':betaURMap,
+            'lambdaLLMap':lambdaLLMap,'lambdaLRMap':lambdaLRMap,'lambdaULMap':lambdaULMap,'lambdaURMap':lambdaURMap}
+
+def _poly_table(poly):
+    #> per-slice polynomial coefficients (VAR1 followed by the 25 K(i,j)) as a plain (nslices,26) array
+    names = getattr(getattr(poly,'dtype',None),'names',None)
+    if names:
+        return np.column_stack([np.asarray(poly[name],dtype=float) for name in names])
+    return np.asarray(poly,dtype=float)
+
+#> pixel positions evaluated for every pixel, as (x offset, y offset) from the pixel center
+# (see the "new values (flipped old values)" corner convention in _d2cMaps_loop)
+_pixel_positions = {'':(0.,0.),'LL':(-0.5,0.5),'UL':(-0.5,-0.5),'UR':(0.5,-0.5),'LR':(0.5,0.5)}
+
+def _eval_slice_polynomials(polyTable,sliceIdx,pixelCtrx,pixelCtry,positions=_pixel_positions):
+    #> evaluate lambda(x,y) or alpha(x,y) = SUM_i(SUM_j ( (K(i,j)*(x-xs)**j * y**i))) (Eq 2/3 in
+    # MIRI-TN-00001-ETH) for all pixels at once, at the center and four corners of each pixel.
+    # The coefficients are gathered per pixel from its slice index. Both sums are done with Horner's
+    # scheme, and the inner (x) sums are shared between the positions with the same x offset.
+    xs = polyTable[:,0][sliceIdx]
+    offsets = {pos:_pixel_positions[pos] for pos in positions}
+    dxs = {dx:(pixelCtrx+dx)-xs for dx in set(off[0] for off in offsets.values())}
+    ys  = {dy:pixelCtry+dy for dy in set(off[1] for off in offsets.values())}
+
+    results = {pos:np.zeros(len(pixelCtry)) for pos in offsets}
+    for i in range(4,-1,-1):
+        inner = {dx:np.zeros(len(pixelCtry)) for dx in dxs}
+        for j in range(4,-1,-1):
+            coeffs = polyTable[:,1+i*5+j][sliceIdx]
+            for dx in dxs:
+                inner[dx] *= dxs[dx]
+                inner[dx] += coeffs
+        for pos,(dx,dy) in offsets.items():
+            results[pos] *= ys[dy]
+            results[pos] += inner[dx]
+    return results
+
+def _d2cMaps_vectorized(channel,sliceMap,alphaPoly,lambdaPoly,bdel,bzero):
+    #> all pixels belonging to slices of this band, with their slice index s (1-based)
+    pixels = np.where((sliceMap >= 100*channel) & (sliceMap < 100*(channel+1)))
+    pixelCtry = pixels[0]
+    pixelCtrx = pixels[1]
+    s = (sliceMap[pixels] - 100*channel).astype(int)
+
+    maps = {}
+    for name,poly in [('lambda',lambdaPoly),('alpha',alphaPoly)]:
+        values = _eval_slice_polynomials(_poly_table(poly),s-1,pixelCtrx,pixelCtry)
+        for pos in _pixel_positions:
+            maps[name+pos+'Map'] = np.zeros(sliceMap.shape)
+            maps[name+pos+'Map'][pixels] = values[pos]
+
+    maps.update(_beta_maps(sliceMap,pixels,s,bdel,bzero))
+    return maps
+
+def _beta_maps(sliceMap,pixels,s,bdel,bzero):
+    #> Beta(s) = Beta_zero + (s-1) * Delta_Beta (Eq 4 in MIRI-TN-00001-ETH)
+    betas = {'':bzero + (s-1)*bdel,
+             'LL':bzero + (s-0.5-1)*bdel,'LR':bzero + (s-0.5-1)*bdel,
+             'UL':bzero + (s+0.5-1)*bdel,'UR':bzero + (s+0.5-1)*bdel}
+    maps = {}
+    for pos in _pixel_positions:
+        maps['beta'+pos+'Map'] = np.zeros(sliceMap.shape)
+        maps['beta'+pos+'Map'][pixels] = betas[pos]
+    return maps
+
+def _eval_on_grid(coeffs,gridx,gridy):
+    #> evaluate SUM_i(SUM_j ( (K(i,j)*(x-xs)**j * y**i))) on the grid spanned by gridx and gridy;
+    # the polynomial is separable, so this is a (ny,5) x (5,5) x (5,nx) matrix product
+    xs = coeffs[0]
+    K  = coeffs[1:].reshape(5,5)
+    return np.vander(gridy,5,increasing=True) @ K @ np.vander(gridx-xs,5,increasing=True).T
+
+def _d2cMaps_lattice(channel,sliceMap,alphaPoly,lambdaPoly,bdel,bzero):
+    #> all pixels belonging to slices of this band, with their slice index s (1-based)
+    pixels = np.where((sliceMap >= 100*channel) & (sliceMap < 100*(channel+1)))
+    pixelCtry = pixels[0]
+    pixelCtrx = pixels[1]
+    s = (sliceMap[pixels] - 100*channel).astype(int)
+
+    polyTables = {'lambda':_poly_table(lambdaPoly),'alpha':_poly_table(alphaPoly)}
+    maps = {name+pos+'Map':np.zeros(sliceMap.shape) for name in polyTables for pos in _pixel_positions}
+
+    #> group the pixels by slice
+    order = np.argsort(s,kind='stable')
+    slices,starts = np.unique(s[order],return_index=True)
+    ends = np.append(starts[1:],len(order))
+    for sl,start,end in zip(slices,starts,ends):
+        idx = order[start:end]
+        y,x = pixelCtry[idx],pixelCtrx[idx]
+        y0,x0 = y.min(),x.min()
+        ny,nx = y.max()-y0+1,x.max()-x0+1
+        iy,ix = y-y0,x-x0
+        slicePixels = (y,x)
+        #> pixel centers and the (ny+1)x(nx+1) lattice of pixel corners of the slice bounding box
+        ctrx,ctry = x0+np.arange(nx),y0+np.arange(ny)
+        cornx,corny = ctrx[0]-0.5+np.arange(nx+1),ctry[0]-0.5+np.arange(ny+1)
+        for name,polyTable in polyTables.items():
+            centers = _eval_on_grid(polyTable[sl-1],ctrx,ctry)
+            corners = _eval_on_grid(polyTable[sl-1],cornx,corny)
+            maps[name+'Map'][slicePixels]   = centers[iy,ix]
+            maps[name+'ULMap'][slicePixels] = corners[iy,ix]
+            maps[name+'LLMap'][slicePixels] = corners[iy+1,ix]
+            maps[name+'URMap'][slicePixels] = corners[iy,ix+1]
+            maps[name+'LRMap'][slicePixels] = corners[iy+1,ix+1]
+
+    maps.update(_beta_maps(sliceMap,pixels,s,bdel,bzero))
+    return maps
+
+def _read_distortion_cdp_channels(cdpFile,channels,slice_transmission,fileversion):
+    #> read the slice map plane and the polynomial tables of the given channels from one CDP file;
+    # the file is memory-mapped, so only the extensions (and the plane) that are used get read
+    from astropy.io import fits
+    with fits.open(cdpFile,memmap=True) as dist:
+        header = dist[0].header
+        params = {}
+        for channel in channels:
+            params[channel] = (_poly_table(dist['Alpha_CH{}'.format(channel)].data),
+                               _poly_table(dist['Lambda_CH{}'.format(channel)].data),
+                               header['B_DEL{}'.format(channel)],header['B_ZERO{}'.format(channel)])
+        sliceData = dist['Slice_Number'].data
+        if fileversion[:5] in ['7B.05','07.05','8B.05','08.05']:
+            slice_idx = int(slice_transmission[0])-1
+            sliceMap = np.array(sliceData[slice_idx,:,:])
+        else:
+            sliceMap = np.array(sliceData)
+        del sliceData
+    return sliceMap,params
+
+def _build_d2cMaps_star(args):
+    return _build_d2cMaps(*args)
+
+def d2cMapping_bands(bands,cdpDir,slice_transmission='80pc',fileversion = "8B.05.02",engine='vectorized',n_workers=None):
+    # build the d2cMaps of several bands (up to all 12), returned as a dictionary keyed by band.
+    # Each distortion CDP file is opened only once for all the bands it holds (e.g. 1A and 2A), and
+    # the bands are computed in n_workers parallel processes (None: one per CPU, 1: no subprocesses).
+    _check_engine(engine)
+    distcdp = mrs_distortion_cdps(fileversion)
+    bandsPerFile = OrderedDict()
+    for band in bands:
+        bandsPerFile.setdefault(distcdp[band],[]).append(band)
+
+    tasks = []
+    for cdp_filename,fileBands in bandsPerFile.items():
+        channels = sorted(set(int(band[0]) for band in fileBands))
+        sliceMap,params = _read_distortion_cdp_channels(cdpDir+cdp_filename,channels,slice_transmission,fileversion)
+        for band in fileBands:
+            alphaTable,lambdaTable,bdel,bzero = params[int(band[0])]
+            tasks.append((band,(int(band[0]),sliceMap,alphaTable,lambdaTable,bdel,bzero,cdp_filename,engine)))
+
+    if n_workers == 1:
+        results = [_build_d2cMaps_star(args) for band,args in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_build_d2cMaps_star,[args for band,args in tasks]))
+    return OrderedDict((band,d2cMaps) for (band,args),d2cMaps in zip(tasks,results))
+
+def d2cMapping_compact(band,cdpDir,slice_transmission='80pc',fileversion = "8B.05.02",dtype=np.float32):
+    # same as d2cMapping, but returns a CompactD2CMaps object that only stores in-band pixels
+    distcdp = mrs_distortion_cdps(fileversion)
+    alphaPoly,lambdaPoly,bdel,bzero,sliceMap = _read_distortion_cdp(band,cdpDir+distcdp[band],slice_transmission,fileversion)
+    return CompactD2CMaps(int(band[0]),sliceMap,alphaPoly,lambdaPoly,bdel,bzero,distcdp[band],dtype=dtype)
+
+class CompactD2CMaps(Mapping):
+    """d2cMaps holding coordinates for the in-band pixels only.
+
+    Supports the same dictionary-style access as the output of d2cMapping: indexing with one of the map
+    names returns a full-detector array (zero outside the band). The center alpha/lambda coordinates are
+    computed on creation, the corner maps on first access, and the beta maps on every access (from the
+    slice numbers). `inband(key)` returns the coordinates of the in-band pixels only, in the order of
+    `pixels`, without expanding them to the full detector.
+
+    The full-detector arrays are not kept (that would undo the compact storage): every indexing of a
+    map allocates a new one, and so does values() or items() for every map. Membership tests and
+    keys() do not expand anything.
+    """
+    def __init__(self,channel,sliceMap,alphaPoly,lambdaPoly,bdel,bzero,cdp_filename,dtype=np.float32):
+        self.channel = channel
+        self.dtype = np.dtype(dtype)
+        self.sliceMap = sliceMap
+        inband = (sliceMap >= 100*channel) & (sliceMap < 100*(channel+1))
+        self._flat = np.flatnonzero(inband).astype(np.int32)
+        self._s = (sliceMap.ravel()[self._flat] - 100*channel).astype(np.int16)
+        self._polyTables = {'lambda':_poly_table(lambdaPoly),'alpha':_poly_table(alphaPoly)}
+        self._meta = {'bdel':bdel,'bzero':bzero,'nslices':len(np.unique(self._s)),'cdp_filename':cdp_filename}
+        self._values = {}
+        for name in self._polyTables:
+            self._evaluate(name,[''])
+
+    @property
+    def pixels(self):
+        # (y,x) detector coordinates of the in-band pixels
+        return np.unravel_index(self._flat,self.sliceMap.shape)
+
+    @property
+    def nbytes(self):
+        return self._flat.nbytes + self._s.nbytes + sum(v.nbytes for v in self._values.values())
+
+    def _evaluate(self,name,positions):
+        y,x = self.pixels
+        values = _eval_slice_polynomials(self._polyTables[name],self._s.astype(int)-1,x,y,positions=positions)
+        for pos in positions:
+            self._values[name+pos+'Map'] = values[pos].astype(self.dtype)
+
+    def inband(self,key):
+        if key not in _map_names:
+            raise KeyError(key)
+        if key.startswith('beta'):
+            offset = {'':0.,'LL':-0.5,'LR':-0.5,'UL':0.5,'UR':0.5}[key[4:-3]]
+            return (self._meta['bzero'] + (self._s+offset-1)*self._meta['bdel']).astype(self.dtype)
+        if key not in self._values:
+            #> the first access to any corner map of a coordinate computes all four of them
+            name = 'lambda' if key.startswith('lambda') else 'alpha'
+            self._evaluate(name,['LL','UL','UR','LR'])
+        return self._values[key]
+
+    def __getitem__(self,key):
+        if key == 'sliceMap':
+            return self.sliceMap
+        if key in self._meta:
+            return self._meta[key]
+        values = self.inband(key)
+        fullMap = np.zeros(self.sliceMap.shape,dtype=self.dtype)
+        fullMap.ravel()[self._flat] = values
+        return fullMap
+
+    def __contains__(self,key):
+        #> the keys only, without expanding the maps as Mapping.__contains__ (through __getitem__) would
+        return key == 'sliceMap' or key in _map_names or key in self._meta
+
+    def __iter__(self):
+        return iter(['sliceMap']+_map_names+list(self._meta))
+
+    def __len__(self):
+        return 1+len(_map_names)+len(self._meta)
+
+#> cache of d2cMaps: memory-mappable .npy files on disk, plus an in-process LRU of recently used bands
+D2C_CACHE_DIR  = os.path.join(os.path.expanduser('~'),'.cache','mrs_d2cMaps')
+D2C_CACHE_SIZE = 4
+_d2cMaps_lru = OrderedDict()
+_cdp_hashes  = {}
+
+def _cdp_hash(cdpFile):
+    #> sha256 of the CDP file content, remembered for as long as the file is unchanged
+    stat = os.stat(cdpFile)
+    key = (os.path.abspath(cdpFile),stat.st_size,stat.st_mtime)
+    if key not in _cdp_hashes:
+        h = hashlib.sha256()
+        with open(cdpFile,'rb') as f:
+            for block in iter(lambda: f.read(1<<20),b''):
+                h.update(block)
+        _cdp_hashes[key] = h.hexdigest()
+    return _cdp_hashes[key]
+
+def _save_d2cMaps(d2cMaps,path):
+    #> write to a temporary directory first and rename it, so concurrent workers never see partial maps
+    parent = os.path.dirname(path)
+    os.makedirs(parent,exist_ok=True)
+    tmpdir = tempfile.mkdtemp(dir=parent)
+    meta = {}
+    for key,value in d2cMaps.items():
+        if isinstance(value,np.ndarray):
+            np.save(os.path.join(tmpdir,key+'.npy'),value)
+        else:
+            meta[key] = value
+    with open(os.path.join(tmpdir,'meta.json'),'w') as f:
+        json.dump(meta,f)
+    try:
+        os.rename(tmpdir,path)
+    except OSError:
+        # another process stored the same maps in the meantime
+        shutil.rmtree(tmpdir,ignore_errors=True)
+
+def _load_d2cMaps(path):
+    with open(os.path.join(path,'meta.json')) as f:
+        meta = json.load(f)
+    d2cMaps = {key:np.load(os.path.join(path,key+'.npy'),mmap_mode='r') for key in ['sliceMap']+_map_names}
+    d2cMaps.update(meta)
     return d2cMaps
+
+def d2cMapping_cached(band,cdpDir,slice_transmission='80pc',fileversion = "8B.05.02",cache_dir=None,engine='vectorized'):
+    # same as d2cMapping, but the maps are cached on disk (keyed by band, file version, slice transmission
+    # and the CDP file content) and the most recently used ones are kept in memory. Maps loaded from disk
+    # are read-only memory-maps, so parallel workers share their pages.
+    _check_engine(engine)
+    if cache_dir is None:
+        cache_dir = D2C_CACHE_DIR
+    cdpFile = cdpDir+mrs_distortion_cdps(fileversion)[band]
+    key = '{}_{}_{}_{}'.format(band,fileversion,slice_transmission,_cdp_hash(cdpFile)[:16])
+    path = os.path.join(cache_dir,key)
+
+    lru_key = (os.path.abspath(cache_dir),key)
+    if lru_key in _d2cMaps_lru:
+        _d2cMaps_lru.move_to_end(lru_key)
+        return dict(_d2cMaps_lru[lru_key])
+
+    if not os.path.exists(os.path.join(path,'meta.json')):
+        _save_d2cMaps(d2cMapping(band,cdpDir,slice_transmission=slice_transmission,fileversion=fileversion,engine=engine),path)
+    d2cMaps = _load_d2cMaps(path)
+
+    _d2cMaps_lru[lru_key] = d2cMaps
+    while len(_d2cMaps_lru) > D2C_CACHE_SIZE:
+        _d2cMaps_lru.popitem(last=False)
+    return dict(d2cMaps)
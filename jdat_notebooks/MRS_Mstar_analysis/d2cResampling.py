@@ -0,0 +1,130 @@
+"""
+Resampling of MRS detector images onto a regular (alpha, beta, lambda) cube grid, based on the d2c maps
+made by create_distortionMaps.d2cMapping
+
+Every in-band detector pixel is approximated by the box spanned by its corner coordinates in the
+d2c maps (alpha and lambda from the four corners, beta from the slice edges). The fraction of that
+box falling in each spaxel of the output grid is precomputed once, as a sparse spaxel x pixel weight
+matrix. Building a cube from a detector image (or a stack of dithers) is then a single sparse
+matrix product.
+
+=============EXAMPLE OF USE:===============
+from create_distortionMaps import d2cMapping
+from d2cResampling import DetectorCubeResampler
+
+d2cMaps = d2cMapping(band,cdpDir)
+resampler = DetectorCubeResampler.from_d2cMaps(d2cMaps,band,alpha_step=0.13,lambda_step=0.001)
+
+cube = resampler.resample(sci_img)          # (nlambda,nbeta,nalpha)
+cubes = resampler.resample(sci_img_stack)   # (nexposures,nlambda,nbeta,nalpha)
+==========================================
+"""
+
+import numpy as np
+import scipy.sparse as sparse
+
+from PointSourceDetectorBasedExtractionFuncs import _inband_pixels as _inband_flat_idx
+
+def _inband_pixels(d2cMaps,band):
+    #> (y,x) detector coordinates of the in-band pixels: the pixels of the slices of the channel, as in
+    # the extraction functions (and in the order of CompactD2CMaps.inband)
+    sliceMap = np.asarray(d2cMaps['sliceMap'])
+    return np.unravel_index(_inband_flat_idx(np.ravel(sliceMap),int(band[0])),sliceMap.shape)
+
+def _inband_values(d2cMaps,key,pixels):
+    if hasattr(d2cMaps,'inband'):
+        return np.asarray(d2cMaps.inband(key),dtype=float)
+    return np.asarray(d2cMaps[key][pixels],dtype=float)
+
+def _pixel_footprints(d2cMaps,pixels):
+    #> (lo,hi) extent of each in-band pixel along alpha, beta and lambda
+    footprints = []
+    for name in ['alpha','beta','lambda']:
+        corners = np.array([_inband_values(d2cMaps,name+pos+'Map',pixels) for pos in ['LL','LR','UL','UR']])
+        footprints.append((corners.min(axis=0),corners.max(axis=0)))
+    return footprints
+
+def _axis_overlaps(lo,hi,edges):
+    #> indices of the bins (given by their edges) overlapped by each interval [lo,hi], and the fraction of
+    # the interval in each of them; padded to the largest number of overlapped bins, with zero fractions
+    nbins = len(edges)-1
+    i0 = np.searchsorted(edges,lo,side='right')-1
+    i1 = np.searchsorted(edges,hi,side='left')-1
+    i1 = np.maximum(i1,i0)
+    width = max(int((np.minimum(i1,nbins-1)-np.maximum(i0,0)).max(initial=0))+1,1)
+    idx = np.maximum(i0,0)[:,None] + np.arange(width)[None,:]
+    valid = (idx <= i1[:,None]) & (idx < nbins)
+    idx = np.minimum(idx,nbins-1)
+    overlap = np.minimum(hi[:,None],edges[idx+1]) - np.maximum(lo[:,None],edges[idx])
+    length = (hi-lo)[:,None]
+    with np.errstate(invalid='ignore',divide='ignore'):
+        frac = np.where(length > 0,np.clip(overlap,0,None)/length,0.)
+    frac[~valid] = 0.
+    return idx,frac
+
+class DetectorCubeResampler(object):
+    """Precomputed sparse detector-pixel -> spaxel weights for one band and output grid.
+
+    The pixels resampled are those of the slices of the channel of band in the slice map. alpha_edges, beta_edges and lambda_edges are the bin edges of the output cube, which has shape
+    (nlambda,nbeta,nalpha). The weight of a (spaxel,pixel) pair is the fraction of the pixel footprint
+    that falls in the spaxel.
+    """
+    def __init__(self,d2cMaps,band,alpha_edges,beta_edges,lambda_edges):
+        self.alpha_edges  = np.asarray(alpha_edges,dtype=float)
+        self.beta_edges   = np.asarray(beta_edges,dtype=float)
+        self.lambda_edges = np.asarray(lambda_edges,dtype=float)
+        self.detector_shape = d2cMaps['sliceMap'].shape
+        self.pixels = _inband_pixels(d2cMaps,band)
+        nalpha,nbeta,nlambda = len(self.alpha_edges)-1,len(self.beta_edges)-1,len(self.lambda_edges)-1
+        self.cube_shape = (nlambda,nbeta,nalpha)
+
+        (alo,ahi),(blo,bhi),(llo,lhi) = _pixel_footprints(d2cMaps,self.pixels)
+        ia,fa = _axis_overlaps(alo,ahi,self.alpha_edges)
+        ib,fb = _axis_overlaps(blo,bhi,self.beta_edges)
+        il,fl = _axis_overlaps(llo,lhi,self.lambda_edges)
+
+        npix = len(alo)
+        weights = fl[:,:,None,None]*fb[:,None,:,None]*fa[:,None,None,:]
+        spaxels = (il[:,:,None,None]*nbeta + ib[:,None,:,None])*nalpha + ia[:,None,None,:]
+        pixel_idx = np.broadcast_to(np.arange(npix)[:,None,None,None],weights.shape)
+        keep = weights > 0
+        self.weights = sparse.csr_matrix((weights[keep],(spaxels[keep],pixel_idx[keep])),
+                                         shape=(nlambda*nbeta*nalpha,npix))
+        self.weights.sum_duplicates()
+
+    @classmethod
+    def from_d2cMaps(cls,d2cMaps,band,alpha_step,lambda_step,beta_step=None):
+        """Output grid covering the band: regular steps in alpha and lambda, and (by default) one spaxel
+        per slice along beta."""
+        pixels = _inband_pixels(d2cMaps,band)
+        (alo,ahi),(blo,bhi),(llo,lhi) = _pixel_footprints(d2cMaps,pixels)
+        if beta_step is None:
+            beta_step = d2cMaps['bdel']
+        edges = []
+        for lo,hi,step in [(alo,ahi,alpha_step),(blo,bhi,beta_step),(llo,lhi,lambda_step)]:
+            nbins = int(np.ceil((hi.max()-lo.min())/step - 1e-9))
+            edges.append(lo.min() + step*np.arange(nbins+1))
+        return cls(d2cMaps,band,*edges)
+
+    def resample(self,sci_img,mode='mean'):
+        """Resample a detector image (ny,nx) or a stack of them (n,ny,nx) onto the cube grid.
+
+        mode='mean' gives the weighted mean of the overlapping pixels in each spaxel (NaN pixels are
+        ignored, spaxels without valid pixels are NaN), mode='sum' the weighted sum, which conserves the
+        total signal.
+        """
+        if mode not in ('mean','sum'):
+            raise ValueError("mode has to be either 'mean' or 'sum'")
+        sci_img = np.asarray(sci_img)
+        stack = sci_img.ndim == 3
+        values = sci_img[...,self.pixels[0],self.pixels[1]]
+        values = values.T if stack else values[:,None]
+        valid = ~np.isnan(values)
+        values = np.where(valid,values,0.)
+
+        cube = self.weights @ values
+        if mode == 'mean':
+            with np.errstate(invalid='ignore',divide='ignore'):
+                cube = cube/(self.weights @ valid.astype(float))
+        cube = cube.T.reshape((-1,)+self.cube_shape)
+        return cube if stack else cube[0]
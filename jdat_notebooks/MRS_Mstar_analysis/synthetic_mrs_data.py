@@ -0,0 +1,144 @@
+"""
+Synthetic MRS calibration data and detector images, for testing and benchmarking without the CDP files
+
+The distortion CDPs follow the layout read by create_distortionMaps: a primary header with the B_DELn and
+B_ZEROn keywords, Alpha_CHn and Lambda_CHn tables with one row of polynomial coefficients (VAR1 = xs,
+VAR2_i_j = K(i,j)) per slice, and a Slice_Number cube with one slice map per slice transmission (10pc to
+90pc). Both channels of a detector are in each file, with the slices in the order of mrs_sliceids and the
+wavelength ranges, slice widths and pixel sizes of the real bands. The PSF CDP is a Gaussian cube with
+the WCS keywords read by evaluate_psf_cdp.
+
+=============EXAMPLE OF USE:===============
+from synthetic_mrs_data import write_distortion_cdps, psf_cdp, point_source_image
+from create_distortionMaps import d2cMapping
+
+cdpDir = write_distortion_cdps('/tmp/synthetic_cdps/')
+d2cMaps = d2cMapping('1A',cdpDir)
+
+psffits = psf_cdp('1A')
+sci_img,err_img = point_source_image('1A',d2cMaps,source_center=[0.3,-0.1])
+==========================================
+"""
+
+import os
+
+import numpy as np
+
+from create_distortionMaps import mrs_distortion_cdps
+from PointSourceDetectorBasedExtractionFuncs import mrs_aux, mrs_sliceids
+
+det_dims = (1024,1032)
+
+#> half of the detector (left/right) of every channel
+_detector_half = {'1':0,'2':1,'3':1,'4':0}
+
+def _slice_columns(channel,ntransmissions=9):
+    # first and last detector column of every slice of channel, for each slice transmission; the lower
+    # the transmission threshold, the wider the slices
+    slice_order = mrs_sliceids[channel]
+    width = (det_dims[1]//2-8)//len(slice_order)
+    x0 = 4+_detector_half[channel]*det_dims[1]//2
+    columns = {}
+    for ipos,slice_number in enumerate(slice_order):
+        start = x0+ipos*width
+        columns[slice_number] = [(start+1+(k+1)//4,start+width-2-(k+1)//4) for k in range(ntransmissions)]
+    return columns
+
+def _channel_tables(band,columns,rng):
+    # Alpha_CHn and Lambda_CHn coefficient rows (xs, then K(i,j) for y**i (x-xs)**j) of every slice
+    from astropy.io import fits
+    channel = band[0]
+    lmin,lmax = mrs_aux(band)[3]
+    alphapix = mrs_aux(band)[5]
+    nslices  = len(columns)
+    tables = {}
+    for kind in ['Alpha','Lambda']:
+        rows = np.zeros((nslices,26))
+        for slice_number,cols in columns.items():
+            s = slice_number-100*int(channel)
+            xs = (cols[0][0]+cols[0][1])/2.
+            K = np.zeros((5,5))
+            if kind == 'Lambda':
+                #> wavelength increasing along the detector rows, slightly tilted and curved, staying in band
+                K[0,0] = lmin+0.002*(lmax-lmin)*(1+rng.random())
+                K[1,0] = 0.995*(lmax-lmin)/(det_dims[0]-1)
+                K[0,1] = 1e-5*(lmax-lmin)*rng.standard_normal()
+                K[2,0] = 1e-9*(lmax-lmin)*rng.standard_normal()
+            else:
+                #> alpha increasing along the slice (x), with a slight dependence on the row
+                K[0,0] = 0.01*rng.standard_normal()
+                K[0,1] = alphapix*(1+0.01*rng.standard_normal())
+                K[1,0] = 1e-5*rng.standard_normal()
+                K[1,1] = 1e-7*rng.standard_normal()
+            rows[s-1] = np.concatenate([[xs],K.ravel()])
+        cols = [fits.Column(name='VAR1',format='D',array=rows[:,0])]
+        cols += [fits.Column(name='VAR2_{}_{}'.format(i,j),format='D',array=rows[:,1+5*i+j]) for i in range(5) for j in range(5)]
+        tables[kind] = fits.BinTableHDU.from_columns(cols,name='{}_CH{}'.format(kind,channel))
+    return tables
+
+def write_distortion_cdps(cdpDir,fileversion="8B.05.02",seed=0,overwrite=True):
+    # write a synthetic distortion CDP for every MRS detector and grating setting to cdpDir, with the file
+    # names of mrs_distortion_cdps; returns cdpDir (with a trailing separator, as d2cMapping expects)
+    from astropy.io import fits
+    rng = np.random.default_rng(seed)
+    os.makedirs(cdpDir,exist_ok=True)
+    distcdp = mrs_distortion_cdps(fileversion)
+    for subband in ['A','B','C']:
+        for channels in [('1','2'),('3','4')]:
+            header = fits.Header()
+            sliceMap = np.zeros((9,)+det_dims)
+            tables = []
+            for channel in channels:
+                band = channel+subband
+                columns = _slice_columns(channel)
+                for slice_number,cols in columns.items():
+                    for k,(first,last) in enumerate(cols):
+                        sliceMap[k,:,first:last+1] = slice_number
+                bdel = mrs_aux(band)[6]
+                header['B_DEL'+channel]  = bdel
+                header['B_ZERO'+channel] = -bdel*(len(columns)-1)/2.
+                channel_tables = _channel_tables(band,columns,rng)
+                tables += [channel_tables['Alpha'],channel_tables['Lambda']]
+            hdulist = fits.HDUList([fits.PrimaryHDU(header=header)]+tables+[fits.ImageHDU(sliceMap,name='Slice_Number')])
+            hdulist.writeto(os.path.join(cdpDir,distcdp[channels[0]+subband]),overwrite=overwrite)
+    return os.path.join(cdpDir,'')
+
+def _psf_fwhm(band,lambdas):
+    #> MRS PSF FWHM (arcsec) of the band, scaling linearly with wavelength around the band center
+    lmin,lmax = mrs_aux(band)[3]
+    return mrs_aux(band)[8]*np.asarray(lambdas)/((lmin+lmax)/2.)
+
+def psf_cdp(band,nspaxels=61,nlambda=200):
+    # Gaussian PSF cube of band, as an HDUList with the layout and WCS keywords of the PSF CDP
+    from astropy.io import fits
+    lmin,lmax = mrs_aux(band)[3]
+    step = mrs_aux(band)[5]/2.
+    offsets = (np.arange(nspaxels)-(nspaxels-1)/2.)*step
+    lambdas = np.linspace(lmin,lmax,nlambda)
+    sigmas  = _psf_fwhm(band,lambdas)/2.355
+    cube = np.exp(-(offsets[None,None,:]**2+offsets[None,:,None]**2)/(2*sigmas[:,None,None]**2))
+    hdu = fits.ImageHDU(cube.astype(np.float32),name='PSF')
+    for axis,(crval,cdelt) in enumerate([(0.,step),(0.,step),(lmin,(lmax-lmin)/nlambda)]):
+        hdu.header['CRPIX{}'.format(axis+1)] = (nspaxels+1)/2. if axis < 2 else 1.
+        hdu.header['CDELT{}'.format(axis+1)] = cdelt
+        hdu.header['CRVAL{}'.format(axis+1)] = crval
+    return fits.HDUList([fits.PrimaryHDU(),hdu])
+
+def point_source_image(band,d2cMaps,source_center=[0,0],amplitude=100.,background=1.,noise=0.5,nan_fraction=0.,seed=0):
+    # detector image of a point source at source_center (alpha,beta in arcsec) in band: a Gaussian PSF of
+    # the band's FWHM with peak amplitude (a number, or a function of wavelength), on a constant
+    # background, with Gaussian noise and a fraction of NaN pixels; returns sci_img and err_img
+    rng = np.random.default_rng(seed)
+    sliceMap = d2cMaps['sliceMap']
+    channel = int(band[0])
+    inband = (sliceMap > 100*channel) & (sliceMap < 100*(channel+1))
+    lambdas = d2cMaps['lambdaMap'][inband]
+    sigmas = _psf_fwhm(band,lambdas)/2.355
+    amp = amplitude(lambdas) if callable(amplitude) else amplitude
+    sci_img = np.zeros(det_dims)
+    sci_img[inband] = amp*np.exp(-((d2cMaps['alphaMap'][inband]-source_center[0])**2+(d2cMaps['betaMap'][inband]-source_center[1])**2)/(2*sigmas**2))+background
+    sci_img[inband] += noise*rng.standard_normal(inband.sum())
+    err_img = np.full(det_dims,float(noise))
+    if nan_fraction > 0:
+        sci_img[rng.random(det_dims) < nan_fraction] = np.nan
+    return sci_img,err_img
@@ -0,0 +1,39 @@
+"""
+Regression tests of the d2cMapping engines against the original slice-by-slice implementation
+('loop'), on the synthetic distortion CDPs of synthetic_mrs_data. Run with pytest from this directory.
+"""
+
+import numpy as np
+import pytest
+
+import create_distortionMaps as distortionMaps
+from synthetic_mrs_data import write_distortion_cdps
+
+@pytest.fixture(scope='module')
+def cdpDir(tmp_path_factory):
+    return write_distortion_cdps(str(tmp_path_factory.mktemp('cdps')))
+
+@pytest.mark.parametrize('band',['1A','2B','3C','4A'])
+@pytest.mark.parametrize('engine',['vectorized','lattice'])
+def test_engines_match_loop(cdpDir,band,engine):
+    reference = distortionMaps.d2cMapping(band,cdpDir,engine='loop')
+    d2cMaps = distortionMaps.d2cMapping(band,cdpDir,engine=engine)
+    assert np.array_equal(d2cMaps['sliceMap'],reference['sliceMap'])
+    for key in distortionMaps._map_names:
+        np.testing.assert_allclose(d2cMaps[key],reference[key],rtol=0,atol=1e-9,equal_nan=True)
+    for key in ['bdel','bzero','nslices','cdp_filename']:
+        assert d2cMaps[key] == reference[key]
+
+def test_unknown_engine(tmp_path):
+    #> rejected before the (here missing) CDP file is opened
+    with pytest.raises(ValueError,match='engine'):
+        distortionMaps.d2cMapping('1A',str(tmp_path)+'/',engine='loops')
+
+def test_compact_maps(cdpDir):
+    reference = distortionMaps.d2cMapping('1A',cdpDir,engine='loop')
+    compact = distortionMaps.d2cMapping_compact('1A',cdpDir,dtype=np.float64)
+    inband = (reference['sliceMap'] >= 100) & (reference['sliceMap'] < 200)
+    for key in distortionMaps._map_names:
+        assert key in compact
+        np.testing.assert_allclose(compact[key][inband],reference[key][inband],rtol=0,atol=1e-9)
+    assert 'unknown' not in compact
@@ -0,0 +1,91 @@
+"""
+Tests of DetectorCubeResampler: against a pixel-by-pixel, spaxel-by-spaxel resampler on a small hand-built
+d2cMaps, and flux conservation on the synthetic distortion CDPs of synthetic_mrs_data. Run with pytest from
+this directory.
+"""
+
+import numpy as np
+import pytest
+
+import create_distortionMaps as distortionMaps
+import PointSourceDetectorBasedExtractionFuncs as extractionFuncs
+from d2cResampling import DetectorCubeResampler
+from synthetic_mrs_data import write_distortion_cdps
+
+def _small_d2cMaps():
+    #> 3x4 detector: slices 1 and 2 of channel 1, one pixel out of any slice, and one pixel of channel 2
+    # that has coordinates too (it must not be resampled with channel 1)
+    sliceMap = np.array([[101,101,102,0],
+                         [101,101,102,201],
+                         [101,101,102,0]])
+    bzero,bdel = -0.2,0.4
+    y,x = np.indices(sliceMap.shape)
+    s = sliceMap % 100
+    alpha = 0.3*x + 0.05*y - 0.4
+    lambdas = 5. + 0.01*y + 0.002*x
+    d2cMaps = {'sliceMap':sliceMap,'bdel':bdel,'bzero':bzero,'nslices':2,'cdp_filename':'hand-built'}
+    for pos,dalpha,dlambda,dbeta in [('',0.,0.,0.),('LL',-0.15,-0.005,-0.5),('LR',0.15,-0.005,-0.5),
+                                     ('UL',-0.15,0.005,0.5),('UR',0.15,0.005,0.5)]:
+        d2cMaps['alpha'+pos+'Map']  = np.where(s > 0,alpha+dalpha,0.)
+        d2cMaps['beta'+pos+'Map']   = np.where(s > 0,bzero+(s-1+dbeta)*bdel,0.)
+        d2cMaps['lambda'+pos+'Map'] = np.where(s > 0,lambdas+dlambda,0.)
+    return d2cMaps
+
+def _loop_resample(d2cMaps,band,sci_img,alpha_edges,beta_edges,lambda_edges):
+    #> every in-band pixel box, spaxel by spaxel: the weighted sum of the pixels in each spaxel
+    channel = int(band[0])
+    sliceMap = d2cMaps['sliceMap']
+    cube = np.zeros((len(lambda_edges)-1,len(beta_edges)-1,len(alpha_edges)-1))
+    for y,x in np.ndindex(sliceMap.shape):
+        if not (100*channel <= sliceMap[y,x] < 100*(channel+1)):
+            continue
+        box = []
+        for name in ['lambda','beta','alpha']:
+            corners = [d2cMaps[name+pos+'Map'][y,x] for pos in ['LL','LR','UL','UR']]
+            box.append((min(corners),max(corners)))
+        for spaxel in np.ndindex(cube.shape):
+            frac = 1.
+            for (lo,hi),edges,i in zip(box,[lambda_edges,beta_edges,alpha_edges],spaxel):
+                frac *= max(0.,min(hi,edges[i+1])-max(lo,edges[i]))/(hi-lo)
+            cube[spaxel] += frac*sci_img[y,x]
+    return cube
+
+def test_matches_loop():
+    d2cMaps = _small_d2cMaps()
+    alpha_edges  = np.array([-0.6,-0.3,0.,0.25,0.5])
+    beta_edges   = np.array([-0.4,0.,0.4,0.8])
+    lambda_edges = np.array([4.99,5.004,5.012,5.03])
+    sci_img = np.arange(1.,13.).reshape(3,4)
+    resampler = DetectorCubeResampler(d2cMaps,'1A',alpha_edges,beta_edges,lambda_edges)
+    assert resampler.cube_shape == (3,3,4)
+    assert np.array_equal(np.ravel_multi_index(resampler.pixels,(3,4)),[0,1,2,4,5,6,8,9,10])
+
+    cube = resampler.resample(sci_img,mode='sum')
+    np.testing.assert_allclose(cube,_loop_resample(d2cMaps,'1A',sci_img,alpha_edges,beta_edges,lambda_edges),rtol=1e-12,atol=1e-12)
+    #> the mean is the sum divided by the summed weights
+    weights = _loop_resample(d2cMaps,'1A',np.ones((3,4)),alpha_edges,beta_edges,lambda_edges)
+    with np.errstate(invalid='ignore'):
+        np.testing.assert_allclose(resampler.resample(sci_img),cube/weights,rtol=1e-12)
+
+@pytest.fixture(scope='module')
+def cdpDir(tmp_path_factory):
+    return write_distortion_cdps(str(tmp_path_factory.mktemp('cdps')))
+
+def test_flux_conservation(cdpDir):
+    band = '2B'
+    d2cMaps = distortionMaps.d2cMapping(band,cdpDir)
+    resampler = DetectorCubeResampler.from_d2cMaps(d2cMaps,band,alpha_step=0.2,lambda_step=0.002)
+    #> the same pixels as the extraction functions
+    pixel_index = extractionFuncs.PixelIndex(d2cMaps,band)
+    assert np.array_equal(np.ravel_multi_index(resampler.pixels,d2cMaps['sliceMap'].shape),np.sort(pixel_index.flat_idx))
+
+    rng = np.random.default_rng(0)
+    sci_imgs = rng.uniform(0.,1.,(2,)+d2cMaps['sliceMap'].shape)
+    cubes = resampler.resample(sci_imgs,mode='sum')
+    totals = sci_imgs[:,resampler.pixels[0],resampler.pixels[1]].sum(axis=1)
+    np.testing.assert_allclose(cubes.sum(axis=(1,2,3)),totals,rtol=1e-10)
+
+    #> compact maps give the same cube
+    compact = distortionMaps.d2cMapping_compact(band,cdpDir,dtype=np.float64)
+    compact_resampler = DetectorCubeResampler.from_d2cMaps(compact,band,alpha_step=0.2,lambda_step=0.002)
+    np.testing.assert_allclose(compact_resampler.resample(sci_imgs[0],mode='sum'),cubes[0],rtol=1e-9,atol=1e-12)
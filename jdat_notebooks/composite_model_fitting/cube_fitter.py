@@ -0,0 +1,357 @@
+'''Spaxel by spaxel fitting of a composite model to a spectral cube
+
+fit_cube fits a model built from custom_models components (or any
+picklable astropy model) to every spaxel of a (nwave, ny, nx) cube in a
+pool of worker processes. Spaxels are fitted from the brightest one
+outwards: each fit starts from the parameters of an already converged
+neighbour, which is usually much closer to the solution than the initial
+model. Spaxels with too few valid points or a low signal to noise ratio
+are skipped, and the results can be checkpointed to a file, from which
+an interrupted run resumes.
+
+Example:
+    from n5548_models import model1
+    result = fit_cube(model1, wavelength, flux_cube, uncertainty_cube,
+                      n_workers=8, checkpoint='n5548_cube.npz')
+    norm_map = result.parameter('norm_5')
+    norm_err = result.uncertainty('norm_5')
+'''
+import heapq
+import itertools
+import logging
+import os
+import time
+import warnings
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                FIRST_COMPLETED, wait)
+
+import numpy as np
+from astropy.modeling import fitting
+
+from custom_models import compile_ties, fit_covariance, tie_matrix, with_fit_deriv
+
+logger = logging.getLogger(__name__)
+
+# spaxel status codes
+NOT_FITTED = 0
+CONVERGED = 1
+FAILED = 2
+LOW_SNR = 3
+NO_DATA = 4
+
+_status_names = {NOT_FITTED: 'not fitted', CONVERGED: 'converged', FAILED: 'failed',
+                 LOW_SNR: 'low snr', NO_DATA: 'no data'}
+
+# model, wavelengths and fitter of the worker processes, set by _init_worker
+_worker = {}
+
+
+def _free_parameters(model):
+    return [i for i, name in enumerate(model.param_names)
+            if not model.fixed[name] and not model.tied[name]]
+
+
+def _covariance_map(model):
+    # (nparams, nfree) matrix mapping the covariance of the free parameters
+    # to all parameters; rows of tied parameters are NaN if the ties are not
+    # declarative
+    free = _free_parameters(model)
+    matrix = tie_matrix(model)
+    if matrix is None:
+        matrix = np.identity(len(model.param_names))
+        for i, name in enumerate(model.param_names):
+            if model.tied[name]:
+                matrix[i] = np.nan
+    return matrix[:, free]
+
+
+def _init_worker(model, wavelength, fitter, fitter_kwargs):
+    _worker['model'] = model
+    _worker['wavelength'] = wavelength
+    _worker['fitter'] = fitter
+    _worker['fitter_kwargs'] = fitter_kwargs
+    _worker['covariance_map'] = _covariance_map(model)
+
+
+def _fit_spaxel(flux, weights, start):
+    # fits the worker model to one spectrum from the parameters start;
+    # returns the parameters, their uncertainties, the status, the number of
+    # model evaluations and the reduced chi square
+    model = _worker['model'].copy()
+    model.parameters = start
+    valid = weights > 0
+    x, y, w = _worker['wavelength'][valid], flux[valid], weights[valid]
+    # read-only, so that its sortedness is checked once per fit (see custom_models._is_sorted)
+    x.flags.writeable = False
+    fitter = _worker['fitter']()
+    nparams = len(start)
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            fit = fitter(model, x, y, weights=w, **_worker['fitter_kwargs'])
+    except Exception:
+        return np.full(nparams, np.nan), np.full(nparams, np.nan), FAILED, 0, np.nan
+
+    info = getattr(fitter, 'fit_info', None) or {}
+    params = fit.parameters.copy()
+    converged = info.get('ierr', 1) in (1, 2, 3, 4) and np.all(np.isfinite(params))
+    nfree = _worker['covariance_map'].shape[1]
+    dof = max(len(y) - nfree, 1)
+    chi2 = np.sum(((fit(x) - y) * w) ** 2) / dof
+
+    errors = np.full(nparams, np.nan)
+    cov = info.get('param_cov')
+    if cov is None:
+        # singular with parameters at a bound, see fit_covariance
+        try:
+            cov = fit_covariance(fit, x, y, w)
+        except ValueError:
+            pass
+    if cov is not None:
+        jac = _worker['covariance_map']
+        errors = np.sqrt(np.abs(np.einsum('ij,jk,ik->i', jac, cov, jac)))
+    return params, errors, CONVERGED if converged else FAILED, info.get('nfev', 0), chi2
+
+
+def _spaxel_weights(cube, uncertainty):
+    # 1/sigma weights of every cube pixel, zero for invalid ones; without
+    # uncertainties the noise of each spaxel is estimated from the scatter of
+    # consecutive flux differences
+    valid = np.isfinite(cube)
+    if uncertainty is not None:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weights = np.where(valid & np.isfinite(uncertainty) & (uncertainty > 0),
+                               1. / uncertainty, 0.)
+        return weights
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        diff = np.diff(cube, axis=0)
+        mad = np.nanmedian(np.abs(diff - np.nanmedian(diff, axis=0)), axis=0)
+    sigma = 1.4826 * mad / np.sqrt(2.)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weights = np.where(valid & (sigma > 0), 1. / sigma, 0.)
+    return weights
+
+
+def _neighbours(y, x, shape):
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            if (dy or dx) and 0 <= y + dy < shape[0] and 0 <= x + dx < shape[1]:
+                yield y + dy, x + dx
+
+
+class CubeFitResult(object):
+    '''Results of fit_cube: the fitted parameters and their uncertainties as
+    (nparams, ny, nx) cubes, in the order of param_names, and per spaxel
+    maps of the status (see the status codes of this module), the number of
+    model evaluations and the reduced chi square. Spaxels that were not
+    fitted are NaN.
+    '''
+    def __init__(self, model, parameters, uncertainties, status, nfev, chi2):
+        self.model = model
+        self.param_names = model.param_names
+        self.parameters = parameters
+        self.uncertainties = uncertainties
+        self.status = status
+        self.nfev = nfev
+        self.chi2 = chi2
+
+    def parameter(self, name):
+        '''map of the fitted values of parameter name'''
+        return self.parameters[self.param_names.index(name)]
+
+    def uncertainty(self, name):
+        '''map of the uncertainties of parameter name'''
+        return self.uncertainties[self.param_names.index(name)]
+
+    def model_at(self, y, x):
+        '''fitted model of spaxel (y, x), or None if it was not fitted'''
+        if self.status[y, x] not in (CONVERGED, FAILED):
+            return None
+        model = self.model.copy()
+        model.parameters = self.parameters[:, y, x]
+        return model
+
+    def model_cube(self, wavelength):
+        '''evaluates the fitted model of every converged spaxel at
+        wavelength, as a (nwave, ny, nx) cube (NaN elsewhere)'''
+        cube = np.full((len(wavelength),) + self.status.shape, np.nan)
+        model = self.model.copy()
+        for y, x in zip(*np.nonzero(self.status == CONVERGED)):
+            model.parameters = self.parameters[:, y, x]
+            cube[:, y, x] = model(wavelength)
+        return cube
+
+    def summary(self):
+        '''number of spaxels per status'''
+        return dict((_status_names[code], int(np.sum(self.status == code)))
+                    for code in _status_names)
+
+
+def _save_checkpoint(filename, result):
+    # written to a temporary file first, so that an interrupted write does
+    # not destroy the previous checkpoint
+    tmp = os.fspath(filename) + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, parameters=result.parameters, uncertainties=result.uncertainties,
+                 status=result.status, nfev=result.nfev, chi2=result.chi2,
+                 param_names=np.array(result.param_names))
+    os.replace(tmp, filename)
+
+
+def _load_checkpoint(filename, result):
+    with np.load(filename) as data:
+        if (list(data['param_names']) != list(result.param_names) or
+                data['status'].shape != result.status.shape):
+            raise ValueError('checkpoint %s does not match the model or the cube' % filename)
+        for key in ('parameters', 'uncertainties', 'status', 'nfev', 'chi2'):
+            getattr(result, key)[...] = data[key]
+
+
+def fit_cube(model, wavelength, cube, uncertainty=None, snr_min=3., n_workers=None,
+             fitter=fitting.LevMarLSQFitter, fitter_kwargs=None, warm_start=True,
+             checkpoint=None, checkpoint_interval=60., analytic_deriv=False, verbose=False):
+    '''fits model to every spaxel of cube and returns a CubeFitResult
+
+    model: the model, with the initial parameters and the constraints of
+        the fits. Its ties have to be declarative (custom_models.tied_to)
+        for the model to be sent to the worker processes; they are compiled
+        (compile_ties) before fitting.
+    wavelength: (nwave,) wavelengths of the cube, in the units of model
+    cube: (nwave, ny, nx) fluxes; NaN pixels are ignored
+    uncertainty: (nwave, ny, nx) 1-sigma uncertainties of cube, used as
+        1/sigma weights; by default the noise of each spaxel is estimated
+        from its consecutive flux differences
+    snr_min: spaxels whose median flux / uncertainty is below snr_min are
+        not fitted (status LOW_SNR), nor are spaxels with no more valid
+        points than free parameters (NO_DATA), which leave no degrees of
+        freedom for the chi square and the uncertainties
+    n_workers: number of worker processes (default: the number of CPUs);
+        with n_workers=1 the fits run in this process
+    fitter, fitter_kwargs: fitter class and keyword arguments of its call
+        (e.g. maxiter)
+    warm_start: if True, each spaxel starts from the parameters of an
+        already converged neighbour (the brightest spaxels are fitted first),
+        otherwise from the parameters of model. A warm start that does not
+        converge is retried from the parameters of model. Until a first
+        spaxel converges there is nothing to warm start from: the n_workers
+        brightest spaxels are then fitted from the parameters of model. As
+        fits complete in an order that depends on the workers, warm started
+        results can differ slightly between runs.
+    checkpoint: file name (.npz); if it exists, the spaxels it holds are not
+        fitted again, and the results are written to it every
+        checkpoint_interval seconds and at the end
+    analytic_deriv: if True, the fits use the analytic Jacobian of
+        custom_models.with_fit_deriv. It needs fewer model evaluations, but
+        with active bounds LevMarLSQFitter can end in a different minimum
+        than with its numerical Jacobian (see with_fit_deriv)
+    verbose: progress is logged at INFO level if True, else at DEBUG level
+    '''
+    cube = np.asarray(cube, dtype=float)
+    wavelength = np.asarray(wavelength, dtype=float)
+    if cube.ndim != 3 or cube.shape[0] != len(wavelength):
+        raise ValueError('cube has to be (nwave, ny, nx), with nwave = len(wavelength)')
+    shape = cube.shape[1:]
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    fitter_kwargs = {} if fitter_kwargs is None else dict(fitter_kwargs)
+
+    model = compile_ties(model)
+    if analytic_deriv:
+        model = with_fit_deriv(model)
+    start = model.parameters.copy()
+    nparams, nfree = len(start), len(_free_parameters(model))
+
+    weights = _spaxel_weights(cube, None if uncertainty is None else np.asarray(uncertainty, dtype=float))
+    nvalid = np.sum(weights > 0, axis=0)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        snr = np.nanmedian(np.where(weights > 0, cube * weights, np.nan), axis=0)
+
+    result = CubeFitResult(model, np.full((nparams,) + shape, np.nan),
+                           np.full((nparams,) + shape, np.nan), np.zeros(shape, dtype=int),
+                           np.zeros(shape, dtype=int), np.full(shape, np.nan))
+    if checkpoint is not None and os.path.exists(checkpoint):
+        _load_checkpoint(checkpoint, result)
+    todo = result.status == NOT_FITTED
+    result.status[todo & (nvalid <= nfree)] = NO_DATA
+    result.status[todo & (nvalid > nfree) & ~(snr >= snr_min)] = LOW_SNR
+
+    # spaxels still to fit, and the frontier of spaxels next to converged
+    # ones, brightest first, with the parameters to start from
+    pending = set(zip(*np.nonzero(result.status == NOT_FITTED)))
+    frontier = []
+    order = itertools.count()
+
+    def add_neighbours(y, x):
+        for yx in _neighbours(y, x, shape):
+            if yx in pending:
+                heapq.heappush(frontier, (-snr[yx], next(order), yx,
+                                          result.parameters[:, y, x].copy()))
+
+    if warm_start:
+        for y, x in zip(*np.nonzero(result.status == CONVERGED)):
+            add_neighbours(y, x)
+
+    if n_workers > 1:
+        executor = ProcessPoolExecutor(n_workers, initializer=_init_worker,
+                                       initargs=(model, wavelength, fitter, fitter_kwargs))
+    else:
+        executor = ThreadPoolExecutor(1, initializer=_init_worker,
+                                      initargs=(model, wavelength, fitter, fitter_kwargs))
+    level = logging.INFO if verbose else logging.DEBUG
+    running = {}
+    converged = np.any(result.status == CONVERGED)
+    nfits = 0
+    t_start = last_checkpoint = time.time()
+    with executor:
+        while pending or running:
+            while len(running) < 2 * n_workers:
+                task = None
+                while frontier:
+                    yx, params = heapq.heappop(frontier)[2:]
+                    if yx in pending:
+                        task = (yx, params, True)
+                        break
+                if task is None and pending and (not warm_start or not running or
+                                                 (not converged and len(running) < n_workers)):
+                    # nothing to warm start from: the brightest pending spaxel
+                    yx = max(pending, key=lambda yx: snr[yx])
+                    task = (yx, start, False)
+                if task is None:
+                    break
+                yx, params, warm = task
+                pending.discard(yx)
+                future = executor.submit(_fit_spaxel, cube[:, yx[0], yx[1]],
+                                         weights[:, yx[0], yx[1]], params)
+                running[future] = (yx, warm)
+
+            done, not_done = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                yx, warm = running.pop(future)
+                params, errors, status, nfev, chi2 = future.result()
+                nfits += 1
+                result.nfev[yx] += nfev
+                if status != CONVERGED and warm:
+                    # retry from the initial parameters
+                    running[executor.submit(_fit_spaxel, cube[:, yx[0], yx[1]],
+                                            weights[:, yx[0], yx[1]], start)] = (yx, False)
+                    continue
+                result.parameters[:, yx[0], yx[1]] = params
+                result.uncertainties[:, yx[0], yx[1]] = errors
+                result.status[yx] = status
+                result.chi2[yx] = chi2
+                if status == CONVERGED and warm_start:
+                    converged = True
+                    add_neighbours(*yx)
+
+            if checkpoint is not None and time.time() - last_checkpoint > checkpoint_interval:
+                _save_checkpoint(checkpoint, result)
+                last_checkpoint = time.time()
+                logger.log(level, '%d fits, %d spaxels left, %.1f s', nfits,
+                           len(pending) + len(running), time.time() - t_start)
+
+    if checkpoint is not None:
+        _save_checkpoint(checkpoint, result)
+    logger.log(level, '%d fits in %.1f s: %s', nfits, time.time() - t_start, result.summary())
+    return result
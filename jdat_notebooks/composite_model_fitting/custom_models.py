@@ -1,19 +1,28 @@
+import hashlib
+import pickle
+import weakref
+from collections import OrderedDict
+
 import astropy.constants as ac
 import numpy as np
 
 import astropy.modeling.models as models
 from astropy.modeling import Fittable1DModel, Parameter
+from astropy.modeling.core import CompoundModel
 
+# speed of light in km/s, for the line widths
+_c_kms = ac.c.to('km/s').value
 
-def ccm(wav, ebmv=1, rv=3.5):
-    '''computes reddening correction according to the Cardelli, Clayton and Mathis 
-    model (ApJ 1989 v345, p245)
-    
-    wav: wavelengths in microns (expect a numpy array of wavelengths
-    ebmv: e(B-V) in magnitudes
-    rv:  Rv = A(V)/E(B-V) 
+
+# Number of wavelength grids whose extinction coefficients are kept by ccm_coefficients
+CCM_CACHE_SIZE = 16
+_ccm_cache = OrderedDict()
+
+
+def _ccm_ab(x):
+    '''evaluates the a(x) and b(x) coefficients of the CCM extinction law
+    on an array of inverse wavelengths x (in 1/micron)
     '''
-    x = 1./wav
     irmask = (x >= 0.3) & (x <= 1.1)
     omask  = (x >  1.1) & (x <= 3.3)
     nuvmask1 = (x > 3.3) & (x <= 8.0) 
@@ -46,6 +55,42 @@ def ccm(wav, ebmv=1, rv=3.5):
     a[fuvmask] = -1.073 - 0.628 * xfuv + 0.137 * xfuv**2 - 0.070 * xfuv**3
     b[fuvmask] = 13.670 + 4.257 * xfuv - 0.420 * xfuv**2 + 0.374 * xfuv**3
 
+    return a, b
+
+
+def ccm_coefficients(wav):
+    '''returns the a(x) and b(x) coefficients of the CCM extinction law for
+    the wavelengths wav (in microns), so that A(lambda)/A(V) = a + b / Rv
+
+    The coefficients only depend on the wavelength grid, which does not change
+    during a fit, so they are computed once per grid and kept in a small LRU
+    cache keyed by the grid content. The returned arrays are read-only.
+    '''
+    wav = np.asarray(wav, dtype=float)
+    key = (wav.shape, hashlib.sha1(np.ascontiguousarray(wav).view(np.uint8)).hexdigest())
+    if key in _ccm_cache:
+        _ccm_cache.move_to_end(key)
+        return _ccm_cache[key]
+
+    a, b = _ccm_ab(1./wav)
+    a.flags.writeable = False
+    b.flags.writeable = False
+    _ccm_cache[key] = (a, b)
+    while len(_ccm_cache) > CCM_CACHE_SIZE:
+        _ccm_cache.popitem(last=False)
+    return a, b
+
+
+def ccm(wav, ebmv=1, rv=3.5):
+    '''computes reddening correction according to the Cardelli, Clayton and Mathis 
+    model (ApJ 1989 v345, p245)
+    
+    wav: wavelengths in microns (expect a numpy array of wavelengths
+    ebmv: e(B-V) in magnitudes
+    rv:  Rv = A(V)/E(B-V) 
+    '''
+    a, b = ccm_coefficients(wav)
+
     result = 10 ** (-0.4 * ebmv * (rv * a + b))
 
     return result
@@ -66,7 +111,7 @@ def bipolar_gaussian(x, norm=1., mean=0., fwhm=1., skew=1.):
     The units of mean and x should be consistent.
     '''
     sqrt2pi = np.sqrt(2.* np.pi)
-    sigma = mean * fwhm / ac.c.to('km/s').value / 2.354820044
+    sigma = mean * fwhm / _c_kms / 2.354820044
     val = 0. * x
     lowerx = (x > (mean - 10*sigma)) & (x < mean)
     upperx = (x < (mean + 10*sigma*skew)) & (x > mean)
@@ -76,6 +121,148 @@ def bipolar_gaussian(x, norm=1., mean=0., fwhm=1., skew=1.):
     return val
 
 
+def bipolar_gaussian_windowed(x, norm=1., mean=0., fwhm=1., skew=1., out=None):
+    '''Same as bipolar_gaussian, for sorted 1-D x and scalar parameters
+
+    Only the samples within the -10 sigma / +10 sigma*skew window around the
+    mean (located with searchsorted) are evaluated, so the cost scales with the
+    line width rather than with the length of x. The result is added to out
+    (zeros if not given), so several components can be accumulated in one
+    array.
+    '''
+    sqrt2pi = np.sqrt(2.* np.pi)
+    sigma = mean * fwhm / _c_kms / 2.354820044
+    if out is None:
+        out = np.zeros(x.shape)
+    # same selection as bipolar_gaussian: x == mean falls in neither window
+    lo = np.searchsorted(x, mean - 10*sigma, side='right')
+    mid_lo = np.searchsorted(x, mean, side='left')
+    mid_hi = np.searchsorted(x, mean, side='right')
+    hi = np.searchsorted(x, mean + 10*sigma*skew, side='left')
+    if mid_lo > lo:
+        term = - ((x[lo:mid_lo]-mean)/sigma) ** 2 / 2.
+        out[lo:mid_lo] += 2 * norm * np.exp(term) / sigma / sqrt2pi / (1. + skew)
+    if hi > mid_hi:
+        term = - ((x[mid_hi:hi]-mean)/sigma) ** 2 / 2.
+        out[mid_hi:hi] += 2 * norm * np.exp(term/skew**2) / sigma / sqrt2pi / (1. + skew)
+    return out
+
+
+def _bipolar_gaussian_deriv(x, norm, mean, fwhm, skew):
+    # derivatives of bipolar_gaussian; with t = (x - mean) / (sigma * side),
+    # side = 1 below the mean and skew above it, val = norm * B * exp(-t**2/2)
+    # where B = 2 / (sigma * sqrt(2 pi) * (1 + skew)) and sigma ~ mean * fwhm
+    sqrt2pi = np.sqrt(2.* np.pi)
+    sigma = mean * fwhm / _c_kms / 2.354820044
+    lowerx = (x > (mean - 10*sigma)) & (x < mean)
+    upperx = (x < (mean + 10*sigma*skew)) & (x > mean)
+    side = np.where(upperx, skew, 1.)
+    t = (x-mean) / sigma / side
+    d_norm = np.where(lowerx | upperx, 2 * np.exp(- t ** 2 / 2.) / sigma / sqrt2pi / (1. + skew), 0.)
+    val = norm * d_norm
+    d_mean = val * (t / (sigma * side) + (t ** 2 - 1.) / mean)
+    d_fwhm = val * (t ** 2 - 1.) / fwhm
+    d_skew = val * (np.where(upperx, t ** 2 / skew, 0.) - 1. / (1. + skew))
+    return [d_norm, d_mean, d_fwhm, d_skew]
+
+
+def bipolar_gaussian_deriv(x, norm=1., mean=0., fwhm=1., skew=1.):
+    '''derivatives of bipolar_gaussian with respect to norm, mean, fwhm and
+    skew, as a list of four arrays of the shape of x
+
+    The window edges (-10 sigma and +10 sigma*skew), where the function
+    drops to zero, are ignored. For sorted 1-D x and scalar parameters
+    only the samples within the window are computed.
+    '''
+    x = np.asarray(x)
+    if _is_windowable(x, norm, mean, fwhm, skew):
+        norm, mean, fwhm, skew = [np.ravel(p)[0] for p in (norm, mean, fwhm, skew)]
+        sigma = mean * fwhm / _c_kms / 2.354820044
+        lo = np.searchsorted(x, mean - 10*sigma, side='right')
+        hi = np.searchsorted(x, mean + 10*sigma*skew, side='left')
+        deriv = np.zeros((4,) + x.shape)
+        if hi > lo:
+            deriv[:, lo:hi] = _bipolar_gaussian_deriv(x[lo:hi], norm, mean, fwhm, skew)
+        return list(deriv)
+    return _bipolar_gaussian_deriv(x, norm, mean, fwhm, skew)
+
+
+def _is_windowable(x, *params):
+    # the windowed evaluation applies to sorted 1-D x and single parameter values
+    return (np.ndim(x) == 1 and all(np.size(p) == 1 for p in params) and
+            _is_sorted(x))
+
+
+# weak reference to the last read-only x checked by _is_sorted, and the result
+_sorted_x = (None, False)
+
+
+def _is_sorted(x):
+    # whether x is sorted; the fitters pass the same x to every evaluation, so
+    # the O(N) check is remembered for the last x that cannot change (read-only
+    # and owning its data, as the spectra of fit_cube)
+    global _sorted_x
+    ref, result = _sorted_x
+    if ref is not None and ref() is x:
+        return result
+    result = bool(np.all(x[1:] >= x[:-1]))
+    if isinstance(x, np.ndarray) and not x.flags.writeable and x.flags.owndata:
+        _sorted_x = (weakref.ref(x), result)
+    return result
+
+
+def _bipolar_gaussians_windowed(x, norm, mean, fwhm, skew, out=None):
+    # bipolar_gaussians for sorted 1-D x, added to out: the window edges of
+    # all the components at once, as in bipolar_gaussian_windowed. The
+    # windows are then evaluated one slice at a time: gathering all of them
+    # in one array pass (index arrays and bincount) was 3x slower for the
+    # 20 n5548 lines than the contiguous slices
+    sqrt2pi = np.sqrt(2.* np.pi)
+    sigma = mean * fwhm / _c_kms / 2.354820044
+    scale = 2 * norm / sigma / sqrt2pi / (1. + skew)
+    lo = np.searchsorted(x, mean - 10*sigma, side='right')
+    mid_lo = np.searchsorted(x, mean, side='left')
+    mid_hi = np.searchsorted(x, mean, side='right')
+    hi = np.searchsorted(x, mean + 10*sigma*skew, side='left')
+    if out is None:
+        out = np.zeros(x.shape)
+    for i in range(len(norm)):
+        if mid_lo[i] > lo[i]:
+            dx = (x[lo[i]:mid_lo[i]] - mean[i]) / sigma[i]
+            out[lo[i]:mid_lo[i]] += scale[i] * np.exp(- dx ** 2 / 2.)
+        if hi[i] > mid_hi[i]:
+            dx = (x[mid_hi[i]:hi[i]] - mean[i]) / (sigma[i] * skew[i])
+            out[mid_hi[i]:hi[i]] += scale[i] * np.exp(- dx ** 2 / 2.)
+    return out
+
+
+def bipolar_gaussians(x, norm, mean, fwhm, skew):
+    '''sum of bipolar gaussians, with one element of the parameter arrays
+    norm, mean, fwhm and skew per component
+
+    Each component is the same as in bipolar_gaussian. For sorted 1-D x the
+    window edges of all the components are located at once and each window
+    is evaluated and accumulated as a slice of x (one Python step per
+    window side), otherwise the components are evaluated together in one
+    broadcast over (component, x).
+    '''
+    sqrt2pi = np.sqrt(2.* np.pi)
+    x = np.asarray(x)
+    norm, mean, fwhm, skew = [np.ravel(p) for p in (norm, mean, fwhm, skew)]
+    if _is_windowable(x):
+        return _bipolar_gaussians_windowed(x, norm, mean, fwhm, skew)
+
+    norm, mean, fwhm, skew = [np.reshape(p, (-1,) + (1,) * x.ndim)
+                              for p in (norm, mean, fwhm, skew)]
+    sigma = mean * fwhm / _c_kms / 2.354820044
+    lowerx = (x > (mean - 10*sigma)) & (x < mean)
+    upperx = (x < (mean + 10*sigma*skew)) & (x > mean)
+    term = - ((x-mean)/sigma) ** 2 / 2.
+    term = np.where(upperx, term/skew**2, term)
+    val = np.where(lowerx | upperx, np.exp(np.where(lowerx | upperx, term, 0.)), 0.)
+    val *= 2 * norm / sigma / sqrt2pi / (1. + skew)
+    return val.sum(axis=0)
+
 
 # Classes that extend Fittable1DModel to provide for specfit's needs.
 
@@ -101,8 +288,196 @@ class gaussian(Fittable1DModel):
 
     @staticmethod
     def evaluate(x, norm, mean, fwhm, skew):
+        if _is_windowable(x, norm, mean, fwhm, skew):
+            return bipolar_gaussian_windowed(
+                x, *[np.ravel(p)[0] for p in (norm, mean, fwhm, skew)])
         return bipolar_gaussian(x, norm, mean, fwhm, skew)
 
+    @staticmethod
+    def fit_deriv(x, norm, mean, fwhm, skew):
+        return bipolar_gaussian_deriv(x, norm, mean, fwhm, skew)
+
+
+class _multigaussian(Fittable1DModel):
+    '''Base class of the multigaussian(n) models'''
+    n_components = 0
+
+    def __init__(self, *args, **kwargs):
+        self.component_names = kwargs.pop('component_names', None)
+        super(_multigaussian, self).__init__(*args, **kwargs)
+
+    def __reduce__(self):
+        # the classes are made on the fly, so pickle the number of components
+        return (_new_multigaussian, (self.n_components,), self.__dict__)
+
+    @staticmethod
+    def evaluate(x, *params):
+        if _is_windowable(x, *params):
+            return bipolar_gaussians(x, *[np.ravel(params[k::4]) for k in range(4)])
+        # model sets and array valued parameters: sum the components one by one
+        return sum(bipolar_gaussian(x, *params[i:i+4]) for i in range(0, len(params), 4))
+
+    @staticmethod
+    def fit_deriv(x, *params):
+        deriv = []
+        for i in range(0, len(params), 4):
+            deriv.extend(bipolar_gaussian_deriv(x, *params[i:i+4]))
+        return deriv
+
+
+_multigaussian_classes = {}
+
+
+def _new_multigaussian(n):
+    cls = multigaussian(n)
+    return cls.__new__(cls)
+
+
+def multigaussian(n):
+    '''returns a Fittable1DModel class for the sum of n bipolar gaussians
+
+    The parameters of component i are norm_i, mean_i, fwhm_i and skew_i, with
+    the same meaning as in the gaussian class. All components are evaluated in
+    a single call (see bipolar_gaussians), instead of one model evaluation per
+    component as in a compound model of n gaussian instances. Classes are
+    created once per n.
+    '''
+    if n not in _multigaussian_classes:
+        members = OrderedDict([('n_components', n)])
+        for i in range(n):
+            members['norm_%d' % i] = Parameter(default=1)
+            members['mean_%d' % i] = Parameter(default=0)
+            members['fwhm_%d' % i] = Parameter(default=1)
+            members['skew_%d' % i] = Parameter(default=1)
+        _multigaussian_classes[n] = type('multigaussian%d' % n, (_multigaussian,), dict(members))
+    return _multigaussian_classes[n]
+
+
+def _sum_terms(model):
+    # the terms of the top level sum of a (compound) model
+    if getattr(model, 'op', None) == '+':
+        return _sum_terms(model.left) + _sum_terms(model.right)
+    return [model]
+
+
+def _leaves(model):
+    if getattr(model, 'op', None) is not None:
+        return _leaves(model.left) + _leaves(model.right)
+    return [model]
+
+
+class _FusedComponent(object):
+    # component `index` of a multigaussian model, with the attribute
+    # interface of the gaussian it replaces (m[name].mean, ...)
+    def __init__(self, model, index):
+        self._model = model
+        self._index = index
+
+    def __getattr__(self, pname):
+        return getattr(self._model, '%s_%d' % (pname, self._index))
+
+
+class _FusedModelView(object):
+    # a fused compound model, indexed with the component names of the
+    # original one, so that ties written for the original model still work
+    def __init__(self, model, fused_name, components):
+        self._model = model
+        self._fused_name = fused_name
+        self._components = components
+
+    def __getitem__(self, key):
+        if key in self._components:
+            fused = self._model
+            if fused.name != self._fused_name:
+                fused = fused[self._fused_name]
+            return _FusedComponent(fused, self._components[key])
+        return self._model[key]
+
+
+class _FusedTie(object):
+    # a tie of the original model, evaluated on the fused one
+    def __init__(self, tie, fused_name, components):
+        self.tie = tie
+        self.fused_name = fused_name
+        self.components = components
+
+    def __call__(self, model):
+        return self.tie(_FusedModelView(model, self.fused_name, self.components))
+
+
+def _fused_tie(tie, fused_name, components, sources):
+    if isinstance(tie, _resolved_tie) and tie.parameter in sources:
+        # compiled tie: back to the component parameter it refers to
+        tie = tied_to(*(sources[tie.parameter] + (tie.scale,)))
+    if isinstance(tie, tied_to):
+        if tie.component in components:
+            index = components[tie.component]
+            return tied_to(fused_name, '%s_%d' % (tie.parameter, index), tie.scale)
+        return tie
+    return _FusedTie(tie, fused_name, components)
+
+
+def fuse_gaussians(model, name='gaussians'):
+    '''returns a copy of model in which the gaussian components of the top
+    level sum are replaced by a single multigaussian component called name
+
+    The other terms (e.g. powerlaw * ccmext) are kept, the parameter values,
+    bounds and fixed flags of the gaussians are carried over, and ties of the
+    original model (including the ones referring to gaussian components by
+    name, and the ones resolved by compile_ties) are remapped to the fused
+    parameters. The original component names (gaussian<i> for unnamed ones)
+    are kept in the component_names attribute of the fused component, whose
+    parameters norm_i, mean_i, fwhm_i and skew_i belong to component_names[i].
+
+    Only the gaussians that are terms of the top level sum are fused: a
+    gaussian inside another term, e.g. in (powerlaw + gaussian) * ccmext,
+    is kept as it is, in that term. Raises ValueError if two gaussians to
+    fuse have the same name, since ties to that name would be ambiguous.
+
+    Example:
+        fused = fuse_gaussians(n5548_models.model1)
+        fit_result = fitter(fused, wavelength, flux, weights=inverse_sigma)
+    '''
+    terms = _sum_terms(model)
+    gaussians = [term for term in terms if isinstance(term, gaussian)]
+    if not gaussians:
+        return model.copy()
+    names = [g.name for g in gaussians if g.name is not None]
+    duplicates = sorted(set(n for n in names if names.count(n) > 1))
+    if duplicates:
+        raise ValueError('gaussian components with the same name: %s' % ', '.join(duplicates))
+    components = OrderedDict([(g.name if g.name is not None else 'gaussian%d' % i, i)
+                              for i, g in enumerate(gaussians)])
+    if len(components) < len(gaussians):
+        raise ValueError('a gaussian component is named like an unnamed one (gaussian<i>)')
+    sources = dict((name, key) for key, name in _component_parameters(model).items()
+                   if key[0] is not None)
+
+    kwargs = {'bounds': {}, 'fixed': {}, 'tied': {}}
+    for i, g in enumerate(gaussians):
+        for pname in g.param_names:
+            fused_pname = '%s_%d' % (pname, i)
+            param = getattr(g, pname)
+            kwargs[fused_pname] = param.value
+            kwargs['bounds'][fused_pname] = param.bounds
+            kwargs['fixed'][fused_pname] = param.fixed
+            if param.tied:
+                kwargs['tied'][fused_pname] = _fused_tie(param.tied, name, components, sources)
+    fused = multigaussian(len(gaussians))(name=name, component_names=list(components), **kwargs)
+
+    result = None
+    for term in terms:
+        if isinstance(term, gaussian):
+            continue
+        term = term.copy()
+        for leaf in _leaves(term):
+            for pname in leaf.param_names:
+                param = getattr(leaf, pname)
+                if param.tied:
+                    param.tied = _fused_tie(param.tied, name, components, sources)
+        result = term if result is None else result + term
+    return fused if result is None else result + fused
+
 
 class ccmext(Fittable1DModel):
     '''computes reddening correction according to the Cardelli, Clayton and Mathis
@@ -120,10 +495,18 @@ class ccmext(Fittable1DModel):
     def evaluate(x, ebmv, rv):
         return ccm(x/10000., ebmv, rv)
 
+    @staticmethod
+    def fit_deriv(x, ebmv, rv):
+        a, b = ccm_coefficients(x/10000.)
+        val = 10 ** (-0.4 * ebmv * (rv * a + b))
+        d_ebmv = -0.4 * np.log(10.) * (rv * a + b) * val
+        d_rv = -0.4 * np.log(10.) * ebmv * a * val
+        return [d_ebmv, d_rv]
+
 
 # these are not strictly necessary since the powerlaw could be instantiated
 # directly from astropy. I keep then here as placeholders for future
-# enhancements.
+# enhancements. Their analytic fit_deriv is inherited from PowerLaw1D.
 class powerlaw(models.PowerLaw1D):
     # Parameter names must be identical with the superclass'.
     # This requirement comes from the 'guimodel' project, in
@@ -139,3 +522,389 @@ class powerlaw_2(models.PowerLaw1D):
         super(powerlaw_2, self).__init__(amp, x0, alpha, **kwargs)
 
 
+# Declarative parameter ties. A tie is a scale factor times a parameter of a
+# named component, e.g. tied = {'mean': tied_to('gaussian5', 'mean', 1.019043)}
+# in place of lambda m: 1.019043 * m['gaussian5'].mean. Unlike lambdas, they
+# can be pickled (models can be saved to a file or sent to worker processes)
+# and chains of them can be resolved in advance (see compile_ties).
+
+class tied_to(object):
+    '''Tie of a parameter to scale times the parameter `parameter` of the
+    component called `component` of the same (compound) model'''
+
+    def __init__(self, component, parameter, scale=1.0):
+        self.component = component
+        self.parameter = parameter
+        self.scale = float(scale)
+
+    def __call__(self, model):
+        source = model if model.name == self.component else model[self.component]
+        return self.scale * getattr(source, self.parameter).value
+
+    def __repr__(self):
+        return 'tied_to(%r, %r, %r)' % (self.component, self.parameter, self.scale)
+
+
+class _resolved_tie(object):
+    # tie to scale times the top level parameter `parameter` of a model, as
+    # made by compile_ties
+    def __init__(self, parameter, scale):
+        self.parameter = parameter
+        self.scale = scale
+
+    def __call__(self, model):
+        return self.scale * getattr(model, self.parameter).value
+
+    def __repr__(self):
+        return '_resolved_tie(%r, %r)' % (self.parameter, self.scale)
+
+
+def _component_parameters(model):
+    # (component name, parameter name) -> top level parameter name of model
+    names = {}
+    offset = 0
+    for leaf in _leaves(model):
+        leaf_names = leaf.param_names
+        for pname, name in zip(leaf_names, model.param_names[offset:offset+len(leaf_names)]):
+            names[(leaf.name, pname)] = name
+        offset += len(leaf_names)
+    return names
+
+
+def _linear_ties(model):
+    # top level parameter name -> (root parameter, scale) for every tie that
+    # is, through chains of declarative ties, a multiple of an untied
+    # parameter; None for the other ties
+    names = _component_parameters(model)
+    tied = dict((name, model.tied[name]) for name in model.param_names if model.tied[name])
+    resolved = {}
+
+    def resolve(name, chain):
+        if name in resolved:
+            return resolved[name]
+        tie = tied[name]
+        if isinstance(tie, _resolved_tie):
+            source, scale = tie.parameter, tie.scale
+        elif isinstance(tie, tied_to):
+            if (tie.component, tie.parameter) not in names:
+                raise ValueError("%s is tied to unknown parameter '%s' of component '%s'"
+                                 % (name, tie.parameter, tie.component))
+            source, scale = names[(tie.component, tie.parameter)], tie.scale
+        else:
+            resolved[name] = None
+            return None
+        if source in chain:
+            raise ValueError('circular ties: ' + ' -> '.join(chain + [source]))
+        if source in tied:
+            root = resolve(source, chain + [source])
+            resolved[name] = None if root is None else (root[0], scale * root[1])
+        else:
+            resolved[name] = (source, scale)
+        return resolved[name]
+
+    for name in tied:
+        resolve(name, [name])
+    return resolved
+
+
+def compile_ties(model):
+    '''returns a copy of model in which the declarative ties (tied_to) are
+    resolved to the top level parameters of model, following chains of ties
+    down to an untied parameter, so that each tie is a single multiplication
+    instead of a lookup by component name
+
+    Compile the complete model: the resolved ties refer to the parameter
+    names of model (e.g. mean_5), which change when components are added.
+    Ties that are not declarative, or depend on one that is not, are kept.
+    Raises ValueError for circular ties and ties to unknown parameters.
+    '''
+    model = model.copy()
+    for name, link in _linear_ties(model).items():
+        if link is not None:
+            getattr(model, name).tied = _resolved_tie(*link)
+    return model
+
+
+def tie_matrix(model):
+    '''returns the linear map M of the ties of model, such that M @ params
+    are the parameters with all ties resolved, or None if some ties are not
+    declarative (see tied_to)
+
+    The rows of untied parameters are those of the identity, the row of a
+    tied parameter holds the product of the scales of its chain of ties in
+    the column of the untied parameter at its end.
+    '''
+    names = model.param_names
+    index = dict((name, i) for i, name in enumerate(names))
+    matrix = np.identity(len(names))
+    for name, link in _linear_ties(model).items():
+        if link is None:
+            return None
+        i = index[name]
+        matrix[i, i] = 0.
+        matrix[i, index[link[0]]] = link[1]
+    return matrix
+
+
+def save_model(model, filename):
+    '''writes model to filename (with pickle); all its ties have to be
+    declarative (see tied_to)'''
+    with open(filename, 'wb') as f:
+        pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_model(filename):
+    '''reads a model written by save_model'''
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
+# Evaluation of compound models. CompoundModel evaluates every component
+# separately, each with its own input checks and output array; for sums of
+# many gaussians the checks and the full length arrays cost more than the
+# line windows themselves.
+
+def _is_arithmetic(model):
+    if getattr(model, 'op', None) is not None:
+        return (model.op in ('+', '-', '*', '/') and
+                _is_arithmetic(model.left) and _is_arithmetic(model.right))
+    return model.n_inputs == 1
+
+
+def _accumulate(model, x, params, out):
+    # adds the values of model at the sorted 1-D x to out, for the scalar
+    # parameters params (in the order of the leaves of model); the terms of
+    # sums are added in place, gaussians only within their windows
+    op = getattr(model, 'op', None)
+    if op is None:
+        if isinstance(model, gaussian):
+            bipolar_gaussian_windowed(x, *params, out=out)
+        elif isinstance(model, _multigaussian):
+            _bipolar_gaussians_windowed(x, *[np.array(params[k::4]) for k in range(4)], out=out)
+        else:
+            out += model.evaluate(x, *params)
+        return out
+
+    nleft = len(model.left.param_names)
+    if op == '+':
+        _accumulate(model.left, x, params[:nleft], out)
+        return _accumulate(model.right, x, params[nleft:], out)
+    left = _accumulate(model.left, x, params[:nleft], np.zeros(x.shape))
+    right = _accumulate(model.right, x, params[nleft:], np.zeros(x.shape))
+    if op == '-':
+        out += left - right
+    elif op == '*':
+        out += left * right
+    else:
+        out += left / right
+    return out
+
+
+class _windowed_compound(CompoundModel):
+    '''Compound model evaluated in one pass (see windowed_sum)'''
+
+    def _one_pass(self, args, params, kw):
+        # values of the model at args[0] in one pass, or None if it does not
+        # apply; x is checked once here instead of once per component
+        if len(args) != 1 or kw or not _is_arithmetic(self):
+            return None
+        x = args[0]
+        if not isinstance(x, np.ndarray) or not _is_windowable(x, *params):
+            return None
+        return _accumulate(self, x, [np.ravel(p)[0] for p in params],
+                           np.zeros(x.shape, dtype=float))
+
+    def _evaluate(self, *args, **kw):
+        # called by __call__ with the inputs only
+        val = self._one_pass(args, self.parameters, kw)
+        if val is None:
+            return super(_windowed_compound, self)._evaluate(*args, **kw)
+        return val
+
+    def evaluate(self, *args, **kw):
+        val = self._one_pass(args[:self.n_inputs], args[self.n_inputs:], kw)
+        if val is None:
+            return super(_windowed_compound, self).evaluate(*args, **kw)
+        return val
+
+
+def windowed_sum(model):
+    '''returns a copy of the compound model model that is evaluated in one
+    pass over its components
+
+    For sorted 1-D x (the spectra fitted here) and single parameter sets, x
+    is checked once instead of once per component, one output array is
+    allocated, and the terms of sums (gaussians within their windows) are
+    added to it in place. Other inputs, and models with operators other
+    than +, -, * and /, are evaluated as by CompoundModel. The values are
+    the same as those of model.
+
+    Example:
+        fit_result = fitter(windowed_sum(n5548_models.model1), wavelength, flux,
+                            weights=inverse_sigma)
+    '''
+    model = model.copy()
+    if getattr(model, 'op', None) is None:
+        return model
+    return _windowed_compound(model.op, model.left, model.right, name=model.name)
+
+
+# Analytic derivatives of compound models. The fitters only use the
+# derivatives of the free parameters, so the derivatives of tied parameters
+# are folded into the parameters they are tied to (chain rule).
+
+_deriv_operators = ('+', '-', '*', '/')
+
+
+def _has_compound_deriv(model):
+    if getattr(model, 'op', None) is not None:
+        return (model.op in _deriv_operators and
+                _has_compound_deriv(model.left) and _has_compound_deriv(model.right))
+    return model.fit_deriv is not None and model.n_inputs == 1
+
+
+def _value_and_deriv(model, x, params):
+    # value of model at x and its derivatives with respect to params (all
+    # the parameters of model, in the order of its leaves)
+    if getattr(model, 'op', None) is None:
+        params = [np.asarray(p) for p in params]
+        val = np.asarray(model.evaluate(x, *params), dtype=float)
+        deriv = model.fit_deriv(x, *params)
+        if not model.col_fit_deriv:
+            deriv = np.moveaxis(np.asarray(deriv), -1, 0)
+        return val, [np.broadcast_to(d, val.shape) for d in deriv]
+
+    nleft = len(model.left.param_names)
+    lval, lderiv = _value_and_deriv(model.left, x, params[:nleft])
+    rval, rderiv = _value_and_deriv(model.right, x, params[nleft:])
+    if model.op == '+':
+        return lval + rval, lderiv + rderiv
+    if model.op == '-':
+        return lval - rval, lderiv + [-d for d in rderiv]
+    if model.op == '*':
+        return lval * rval, [d * rval for d in lderiv] + [lval * d for d in rderiv]
+    return lval / rval, [d / rval for d in lderiv] + [- lval * d / rval ** 2 for d in rderiv]
+
+
+def _resolve_ties(model, params, tied):
+    # sets params to model and the tied parameters from their ties, in
+    # parameter order as the fitters do; returns the resulting parameters
+    model.parameters = params
+    for name in tied:
+        setattr(model, name, model.tied[name](model))
+    return model.parameters.copy()
+
+
+def tie_jacobian(model, params=None, step=1e-6):
+    '''returns the derivatives of the parameters of model with respect to its
+    free parameters, once the ties are resolved, as a (nparams, nparams)
+    matrix: column j holds d params / d params[j] for the free parameters
+
+    If all the ties are declarative (tied_to), this is the exact linear map
+    of tie_matrix. Otherwise the ties are arbitrary functions of the model:
+    the columns are computed by finite differences of relative size step,
+    and the columns of fixed and tied parameters are the identity. The
+    parameter values of model are restored on return.
+    '''
+    names = model.param_names
+    tied = [name for name in names if model.tied[name]]
+    if not tied:
+        return np.identity(len(names))
+    matrix = tie_matrix(model)
+    if matrix is not None:
+        return matrix
+    jac = np.identity(len(names))
+    saved = model.parameters.copy()
+    params = saved if params is None else np.array(params, dtype=float)
+    try:
+        base = _resolve_ties(model, params, tied)
+        for j, name in enumerate(names):
+            if model.fixed[name] or model.tied[name]:
+                continue
+            h = step * max(abs(base[j]), 1e-30)
+            perturbed = base.copy()
+            perturbed[j] += h
+            jac[:, j] = (_resolve_ties(model, perturbed, tied) - base) / h
+            jac[j, j] = 1.
+    finally:
+        model.parameters = saved
+    return jac
+
+
+class _compound_deriv(_windowed_compound):
+    '''Compound model with an analytic fit_deriv (see with_fit_deriv), also
+    evaluated in one pass (see windowed_sum)'''
+
+    @property
+    def fit_deriv(self):
+        if not _has_compound_deriv(self):
+            return None
+        return self._fit_deriv
+
+    def _fit_deriv(self, x, *params):
+        val, deriv = _value_and_deriv(self, x, params)
+        deriv = np.array(deriv)
+        if any(self.tied.values()):
+            deriv = np.tensordot(tie_jacobian(self, params).T, deriv, axes=1)
+        # parameters at a bound keep their derivatives: the fitters clip the
+        # parameters to the bounds, and a zero column would pin them there
+        return list(deriv)
+
+
+def with_fit_deriv(model):
+    '''returns a copy of the compound model model with an analytic fit_deriv
+
+    The derivatives are combined from the fit_deriv of the components
+    (gaussian, multigaussian, ccmext, powerlaw or any astropy model with a
+    fit_deriv) through the +, -, * and / operators, and the derivatives of
+    tied parameters are added to the free parameters they depend on (see
+    tie_jacobian), so that the fitters get the Jacobian of the free
+    parameters without evaluating the model once per free parameter. If a
+    component has no fit_deriv, the fitters estimate the Jacobian as before.
+
+    The derivatives are exact, also for parameters at a bound. LevMarLSQFitter
+    clips the parameters to their bounds without telling leastsq, so a step
+    that overshoots a bound can lead to a different (worse) minimum than
+    with the numerical Jacobian: compare the chi square of both fits when
+    bounds are reached.
+
+    Example:
+        fit_result = fitter(with_fit_deriv(n5548_models.model1), wavelength, flux,
+                            weights=inverse_sigma)
+    '''
+    model = model.copy()
+    if getattr(model, 'op', None) is None:
+        return model
+    return _compound_deriv(model.op, model.left, model.right, name=model.name)
+
+
+def fit_covariance(model, x, y, weights=None):
+    '''returns the covariance matrix of the free parameters of the fitted
+    model, from the analytic derivatives of its components, or None if it is
+    singular. As in LevMarLSQFitter, weights are taken as inverse absolute
+    uncertainties; without weights the covariance is scaled by the reduced
+    chi square.
+
+    This is the covariance LevMarLSQFitter reports in fit_info['param_cov'],
+    without refitting, e.g. for a model fitted by another fitter or when
+    leastsq gives none. Raises ValueError if a component has no fit_deriv.
+    '''
+    if not _has_compound_deriv(model):
+        raise ValueError('all the components of model need a fit_deriv')
+    x = np.asarray(x, dtype=float)
+    params = model.parameters.copy()
+    val, deriv = _value_and_deriv(model, x, params)
+    deriv = np.array(deriv)
+    if any(model.tied.values()):
+        deriv = np.tensordot(tie_jacobian(model, params).T, deriv, axes=1)
+    free = [i for i, name in enumerate(model.param_names)
+            if not model.fixed[name] and not model.tied[name]]
+    jac = deriv[free].T
+    if weights is not None:
+        jac = jac * np.asarray(weights, dtype=float)[:, None]
+    try:
+        cov = np.linalg.inv(jac.T @ jac)
+    except np.linalg.LinAlgError:
+        return None
+    if weights is None:
+        cov *= np.sum((val - y) ** 2) / (len(x) - len(free))
+    return cov
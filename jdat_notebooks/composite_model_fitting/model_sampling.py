@@ -0,0 +1,385 @@
+'''Uncertainties of composite model fits by bootstrap and MCMC sampling
+
+Both need the model for many parameter sets. evaluate_parameter_sets
+evaluates a (compound) model built from custom_models components for K
+parameter sets in one broadcast call, returning a (K, N) array, in chunks
+of bounded memory. Gaussian components are only evaluated over the span
+of their windows (-10 sigma to +10 sigma*skew) in the K sets.
+
+bootstrap refits K residual-resampled data sets together with a batched
+Levenberg-Marquardt, and sample_posterior runs an affine invariant
+ensemble sampler (Goodman & Weare 2010) whose walkers are evaluated
+together. Only the free parameters are sampled; fixed parameters keep
+their values and tied ones follow their ties (declarative ties, see
+custom_models.tied_to, are applied to all the sets at once).
+
+Example:
+    fit_result = fitter(n5548_models.model1, wavelength, flux, weights=inverse_sigma)
+    samples, status = bootstrap(fit_result, wavelength, flux, inverse_sigma, n_samples=500)
+    samples = samples[status == CONVERGED]
+    covariance = custom_models.fit_covariance(fit_result, wavelength, flux, inverse_sigma)
+    posterior = sample_posterior(fit_result, wavelength, flux, inverse_sigma,
+                                 covariance=covariance)
+    print(posterior.summary(burn=500))
+'''
+import logging
+
+import numpy as np
+
+from custom_models import _c_kms, gaussian, _multigaussian, tie_matrix
+
+logger = logging.getLogger(__name__)
+
+# default memory budget (bytes) of the temporary arrays of one chunk: the
+# evaluation is bound by memory traffic, chunks that stay in the processor
+# cache are several times faster than a single large one
+MAX_MEMORY = 2**21
+# memory budget (bytes) of the residuals and Jacobians of the sets fitted
+# together by bootstrap
+FIT_MEMORY = 2**28
+
+# status codes of the bootstrap refits
+CONVERGED = 1
+STALLED = 2
+MAX_ITER = 3
+
+_status_names = {CONVERGED: 'converged', STALLED: 'stalled', MAX_ITER: 'max_iter'}
+
+
+def free_parameters(model):
+    '''indices (in model.param_names) of the free parameters of model'''
+    return [i for i, name in enumerate(model.param_names)
+            if not model.fixed[name] and not model.tied[name]]
+
+
+class _Expansion(object):
+    # maps (K, nfree) free parameter values of model to its (K, nparams)
+    # parameter sets; the fixed and tied flags of astropy models are rebuilt
+    # at every access, so they are looked up once here
+    def __init__(self, model):
+        self.model = model.copy()
+        self.free = free_parameters(model)
+        self.tied = [name for name in model.param_names if model.tied[name]]
+        self.matrix = tie_matrix(model) if self.tied else None
+
+    def __call__(self, free_sets):
+        free_sets = np.atleast_2d(free_sets)
+        params = np.tile(self.model.parameters, (len(free_sets), 1))
+        params[:, self.free] = free_sets
+        if not self.tied:
+            return params
+        if self.matrix is not None:
+            return params @ self.matrix.T
+        # ties that are arbitrary functions of the model: resolve set by set
+        model = self.model
+        for k in range(len(params)):
+            model.parameters = params[k]
+            for name in self.tied:
+                setattr(model, name, model.tied[name](model))
+            params[k] = model.parameters
+        return params
+
+
+def expand_parameters(model, free_sets):
+    '''returns the full (K, nparams) parameter sets of model for the (K, nfree)
+    values free_sets of its free parameters: the fixed parameters have the
+    values of model and the tied ones are resolved from their ties'''
+    return _Expansion(model)(free_sets)
+
+
+def _gaussian_sets(x, val, norm, mean, fwhm, skew):
+    # adds the bipolar gaussians of the (K, 1) parameter columns to val,
+    # over the samples of the sorted (1, N) x within one of their windows;
+    # same function as bipolar_gaussian, without its boolean indexing
+    sigma = mean * fwhm / _c_kms / 2.354820044
+    lo = np.searchsorted(x[0], np.min(mean - 10*sigma), side='right')
+    hi = np.searchsorted(x[0], np.max(mean + 10*sigma*skew), side='left')
+    if hi <= lo:
+        return
+    d = x[:, lo:hi] - mean
+    t = d / np.where(d < 0, sigma, sigma * skew)
+    term = np.exp(-0.5 * t**2)
+    term *= 2 * norm / sigma / np.sqrt(2. * np.pi) / (1. + skew)
+    # zero outside the -10 sigma / +10 sigma*skew windows and at the mean
+    term *= (np.abs(t) < 10) & (d != 0)
+    val[:, lo:hi] += term
+
+
+def _evaluate_sets(model, x, params, out=None):
+    # adds to out (K, N) the values of model at the sorted (1, N) x for the
+    # (K, nparams) parameter sets params, in the order of the leaves of
+    # model; terms of sums are accumulated in place
+    if out is None:
+        out = np.zeros((len(params), x.shape[1]))
+    op = getattr(model, 'op', None)
+    if op is not None:
+        nleft = len(model.left.param_names)
+        if op == '+':
+            _evaluate_sets(model.left, x, params[:, :nleft], out)
+            return _evaluate_sets(model.right, x, params[:, nleft:], out)
+        left = _evaluate_sets(model.left, x, params[:, :nleft])
+        right = _evaluate_sets(model.right, x, params[:, nleft:])
+        if op == '-':
+            out += left - right
+        elif op == '*':
+            out += left * right
+        elif op == '/':
+            out += left / right
+        elif op == '**':
+            out += left ** right
+        else:
+            raise ValueError("operator '%s' is not supported" % op)
+        return out
+
+    columns = [params[:, i:i+1] for i in range(params.shape[1])]
+    if isinstance(model, gaussian):
+        _gaussian_sets(x, out, *columns)
+    elif isinstance(model, _multigaussian):
+        for i in range(0, len(columns), 4):
+            _gaussian_sets(x, out, *columns[i:i+4])
+    else:
+        out += model.evaluate(x, *columns)
+    return out
+
+
+def _chunks(nsets, npoints, chunk_size, max_memory, per_set=4):
+    if chunk_size is None:
+        chunk_size = max(1, int(max_memory // (8 * npoints * per_set)))
+    for start in range(0, nsets, chunk_size):
+        yield slice(start, min(start + chunk_size, nsets))
+
+
+def evaluate_parameter_sets(model, x, parameters, chunk_size=None, max_memory=MAX_MEMORY):
+    '''evaluates model at x for every row of parameters, a (K, nparams) array
+    in the order of model.param_names (see expand_parameters to get them
+    from the free parameters); returns a (K, len(x)) array
+
+    The sets are evaluated chunk_size at a time, by default as many as fit
+    in about max_memory bytes of temporaries.
+    '''
+    x = np.asarray(x, dtype=float)
+    parameters = np.atleast_2d(np.asarray(parameters, dtype=float))
+    order = None
+    if np.any(x[1:] < x[:-1]):
+        order = np.argsort(x, kind='stable')
+        x = x[order]
+    out = np.empty((len(parameters), len(x)))
+    for chunk in _chunks(len(parameters), len(x), chunk_size, max_memory):
+        out[chunk] = _evaluate_sets(model, x[None, :], parameters[chunk])
+    if order is not None:
+        out[:, order] = out.copy()
+    return out
+
+
+def chi2_parameter_sets(model, x, y, weights, parameters, chunk_size=None, max_memory=MAX_MEMORY):
+    '''chi square sum(((model(x) - y) * weights)**2) of every row of the
+    (K, nparams) parameters, without keeping the (K, N) model values'''
+    parameters = np.atleast_2d(parameters)
+    weights = np.ones(len(x)) if weights is None else np.asarray(weights)
+    chi2 = np.empty(len(parameters))
+    for chunk in _chunks(len(parameters), len(x), chunk_size, max_memory):
+        values = evaluate_parameter_sets(model, x, parameters[chunk],
+                                         chunk_size=chunk.stop - chunk.start)
+        chi2[chunk] = np.sum(((values - y) * weights) ** 2, axis=1)
+    return chi2
+
+
+def _bounds(model, free):
+    lower = np.array([model.bounds[model.param_names[i]][0] for i in free], dtype=float)
+    upper = np.array([model.bounds[model.param_names[i]][1] for i in free], dtype=float)
+    return np.where(np.isnan(lower), -np.inf, lower), np.where(np.isnan(upper), np.inf, upper)
+
+
+def _batch_fit(model, x, ys, weights, start, max_iter=50, rtol=1e-8, gtol=1e-5,
+               chunk_size=None, max_memory=MAX_MEMORY):
+    # Levenberg-Marquardt fits of the free parameters of model to every row
+    # of ys (K, N), all sets stepping together; the Jacobian is computed by
+    # forward differences, with one evaluate_parameter_sets call per free
+    # parameter. Parameters are clipped to their bounds, as in the astropy
+    # fitters. The sets are fitted in groups whose Jacobians fit in
+    # FIT_MEMORY; chunk_size and max_memory apply to the model evaluations.
+    # A set has converged (CONVERGED) when a step lowers its chi square by
+    # at most rtol, relative, or when it is at a stationary point: the
+    # cosine between the residuals and every Jacobian column is at most
+    # gtol (ignoring parameters held at a bound; gtol has to stay above the
+    # error of the forward differences). A set whose damping grows
+    # beyond 1e10 without either is STALLED, and one still iterating after
+    # max_iter steps is MAX_ITER.
+    # Returns the (K, nfree) fitted values and the (K,) status codes
+    expand = _Expansion(model)
+    free = expand.free
+    lower, upper = _bounds(model, free)
+    nsets, nfree = len(ys), len(free)
+    p = np.tile(np.clip(start, lower, upper), (nsets, 1))
+    lam = np.full(nsets, 1e-3)
+    status = np.full(nsets, MAX_ITER)
+
+    def residuals(p, rows):
+        values = evaluate_parameter_sets(model, x, expand(p),
+                                         chunk_size, max_memory)
+        return (values - ys[rows]) * weights
+
+    for chunk in _chunks(nsets, len(x), None, FIT_MEMORY, per_set=nfree + 4):
+        rows = np.arange(nsets)[chunk]
+        r = residuals(p[rows], rows)
+        chi2 = np.sum(r ** 2, axis=1)
+        for it in range(max_iter):
+            active = status[rows] == MAX_ITER
+            if not np.any(active):
+                break
+            rows_a, p_a, r_a = rows[active], p[rows[active]], r[active]
+            h = 1e-6 * np.maximum(np.abs(p_a), 1e-30)
+            jac = np.empty(r_a.shape + (nfree,))
+            for j in range(nfree):
+                step = p_a.copy()
+                step[:, j] += h[:, j]
+                jac[:, :, j] = (residuals(step, rows_a) - r_a) / h[:, j:j+1]
+            jtj = np.einsum('kni,knj->kij', jac, jac)
+            jtr = np.einsum('kni,kn->ki', jac, r_a)
+            diag = np.einsum('kii->ki', jtj)
+
+            # stationary points; the descent direction is -jtr, parameters
+            # at a bound it points out of do not count
+            held = ((p_a <= lower) & (jtr > 0)) | ((p_a >= upper) & (jtr < 0))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                cosine = np.where(jtr == 0, 0., np.abs(jtr) / np.sqrt(diag * chi2[active][:, None]))
+            stationary = np.all(held | (cosine <= gtol), axis=1)
+
+            damped = jtj + (lam[rows_a, None] * np.maximum(diag, 1e-300))[:, :, None] * np.identity(nfree)
+            delta = -np.linalg.solve(damped, jtr[:, :, None])[:, :, 0]
+            trial = np.clip(p_a + delta, lower, upper)
+            r_trial = residuals(trial, rows_a)
+            chi2_trial = np.sum(r_trial ** 2, axis=1)
+            better = (chi2_trial < chi2[active]) & ~stationary
+            done = stationary | (better & (chi2[active] - chi2_trial <= rtol * chi2[active]))
+            stalled = ~done & ~better & (lam[rows_a] > 1e10)
+            p[rows_a[better]] = trial[better]
+            idx = np.nonzero(active)[0]
+            r[idx[better]] = r_trial[better]
+            chi2[idx[better]] = chi2_trial[better]
+            lam[rows_a] = np.where(better, lam[rows_a] / 10., lam[rows_a] * 10.)
+            status[rows_a[done]] = CONVERGED
+            status[rows_a[stalled]] = STALLED
+    return p, status
+
+
+def bootstrap(model, x, y, weights=None, n_samples=200, max_iter=50, seed=None,
+              chunk_size=None, max_memory=MAX_MEMORY):
+    '''residual bootstrap of the fit of model to (x, y)
+
+    model is the fitted model: its free parameters are the best fit. The
+    weighted residuals (y - model(x)) * weights are resampled with
+    replacement onto the best-fit model to make n_samples data sets, which
+    are all refitted together (see _batch_fit). Returns the (n_samples,
+    nfree) fitted free parameters (in the order of free_parameters) and the
+    status of every refit: CONVERGED, STALLED (no step lowered the chi
+    square any more, away from a stationary point) or MAX_ITER (still
+    iterating after max_iter steps). Refits that did not converge are
+    logged as a warning; leave them out of the uncertainty estimates.
+    '''
+    rng = np.random.default_rng(seed)
+    x = np.asarray(x, dtype=float)
+    weights = np.ones(len(x)) if weights is None else np.asarray(weights, dtype=float)
+    best = model(x)
+    valid = np.nonzero(weights > 0)[0]
+    normalized = (np.asarray(y) - best)[valid] * weights[valid]
+    ys = np.tile(best, (n_samples, 1))
+    draws = rng.integers(0, len(valid), (n_samples, len(valid)))
+    ys[:, valid] += normalized[draws] / weights[valid]
+    start = model.parameters[free_parameters(model)]
+    params, status = _batch_fit(model, x, ys, weights, start, max_iter=max_iter,
+                                chunk_size=chunk_size, max_memory=max_memory)
+    failed = dict((_status_names[code], int(np.sum(status == code)))
+                  for code in (STALLED, MAX_ITER) if np.any(status == code))
+    if failed:
+        logger.warning('%d of %d bootstrap refits did not converge: %s',
+                       sum(failed.values()), n_samples, failed)
+    return params, status
+
+
+class PosteriorSamples(object):
+    '''Result of sample_posterior: the chain of the free parameters
+    param_names, (nsteps, nwalkers, nfree), the log posterior of every
+    sample, (nsteps, nwalkers), and the acceptance fraction of every walker
+    '''
+    def __init__(self, param_names, chain, log_prob, acceptance_fraction):
+        self.param_names = param_names
+        self.chain = chain
+        self.log_prob = log_prob
+        self.acceptance_fraction = acceptance_fraction
+
+    def samples(self, burn=0, thin=1):
+        '''(nsamples, nfree) samples of all walkers after the first burn steps'''
+        return self.chain[burn::thin].reshape(-1, self.chain.shape[2])
+
+    def summary(self, burn=0, thin=1):
+        '''median and 16th/84th percentiles of every free parameter'''
+        p16, p50, p84 = np.percentile(self.samples(burn, thin), [16, 50, 84], axis=0)
+        return dict((name, (median, median - lo, hi - median))
+                    for name, lo, median, hi in zip(self.param_names, p16, p50, p84))
+
+
+def sample_posterior(model, x, y, weights=None, n_steps=2000, n_walkers=None, covariance=None,
+                     scale=1e-3, stretch=2., seed=None, chunk_size=None, max_memory=MAX_MEMORY):
+    '''samples the posterior of the free parameters of model given (x, y),
+    with a Gaussian likelihood of 1/sigma weights and uniform priors within
+    the parameter bounds, using an affine invariant ensemble sampler
+
+    model: the model, ideally fitted: the walkers start around its free
+        parameters, drawn from covariance (the covariance of the free
+        parameters, e.g. from custom_models.fit_covariance) if given, otherwise
+        with a relative scatter scale
+    n_walkers: number of walkers (default: twice the number of free
+        parameters plus two, at least 32); each half of the ensemble is
+        evaluated in one evaluate_parameter_sets call per step
+    stretch: scale parameter of the stretch move
+    '''
+    rng = np.random.default_rng(seed)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    weights = np.ones(len(x)) if weights is None else np.asarray(weights, dtype=float)
+    expand = _Expansion(model)
+    free = expand.free
+    nfree = len(free)
+    lower, upper = _bounds(model, free)
+    if n_walkers is None:
+        n_walkers = max(2 * nfree + 2, 32)
+    n_walkers += n_walkers % 2
+
+    def log_prob(p):
+        inside = np.all((p >= lower) & (p <= upper), axis=1)
+        lp = np.full(len(p), -np.inf)
+        if np.any(inside):
+            lp[inside] = -0.5 * chi2_parameter_sets(model, x, y, weights,
+                                                    expand(p[inside]),
+                                                    chunk_size, max_memory)
+        return lp
+
+    p0 = model.parameters[free]
+    if covariance is not None:
+        walkers = rng.multivariate_normal(p0, covariance, n_walkers)
+    else:
+        walkers = p0 + scale * np.where(p0 != 0, np.abs(p0), 1.) * rng.standard_normal((n_walkers, nfree))
+    walkers = np.clip(walkers, lower, upper)
+    lp = log_prob(walkers)
+
+    chain = np.empty((n_steps, n_walkers, nfree))
+    log_probs = np.empty((n_steps, n_walkers))
+    accepted = np.zeros(n_walkers)
+    half = n_walkers // 2
+    groups = [np.arange(half), np.arange(half, n_walkers)]
+    for step in range(n_steps):
+        for g in range(2):
+            active, others = groups[g], groups[1 - g]
+            z = ((stretch - 1.) * rng.random(half) + 1.) ** 2 / stretch
+            partners = walkers[rng.choice(others, half)]
+            proposal = partners + z[:, None] * (walkers[active] - partners)
+            lp_new = log_prob(proposal)
+            accept = np.log(rng.random(half)) < (nfree - 1) * np.log(z) + lp_new - lp[active]
+            walkers[active[accept]] = proposal[accept]
+            lp[active[accept]] = lp_new[accept]
+            accepted[active[accept]] += 1
+        chain[step] = walkers
+        log_probs[step] = lp
+    names = [model.param_names[i] for i in free]
+    return PosteriorSamples(names, chain, log_probs, accepted / n_steps)
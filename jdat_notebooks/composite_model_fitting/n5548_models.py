@@ -1,6 +1,6 @@
 # Model for n5548 in new format
 
-from custom_models import gaussian, powerlaw, ccmext
+from custom_models import gaussian, powerlaw, ccmext, tied_to
 
 model1 = \
     powerlaw(name = 'powerlaw1',
@@ -44,7 +44,7 @@ model1 = \
                        'mean': (1000., 2000.),
                        'fwhm': (500., 2000.),
                        'skew': (1., 1.)},
-             tied = {'fwhm': lambda m: 1.0 * m['C III 1176'].fwhm},
+             tied = {'fwhm': tied_to('C III 1176', 'fwhm', 1.0)},
              fixed = {'norm': True,
                       'mean': True,
                       'skew': True},
@@ -125,7 +125,7 @@ model1 = \
                        'mean': (1000., 2000.),
                        'fwhm': (100.,  2000.),
                        'skew': (1., 1.)},
-             tied = {'fwhm': lambda m: 1.0 * m['Ly alpha - NLR, ILR,  medium,  very broad'].fwhm},
+             tied = {'fwhm': tied_to('Ly alpha - NLR, ILR,  medium,  very broad', 'fwhm', 1.0)},
              fixed = {'norm': True,
                       'mean': True,
                       'skew': True},
@@ -139,9 +139,9 @@ model1 = \
                        'mean': (1150., 2000.),
                        'fwhm': (30.,  12000.),
                        'skew': (1., 1.)},
-             tied = {'norm': lambda m: 1.0      * m['N V - 2 NLR, 2 ILR, 2 medium, 1 very broad'].norm,
-                     'mean': lambda m: 1.003215 * m['N V - 2 NLR, 2 ILR, 2 medium, 1 very broad'].mean,
-                     'fwhm': lambda m: 1.0      * m['N V - 2 NLR, 2 ILR, 2 medium, 1 very broad'].fwhm},
+             tied = {'norm': tied_to('N V - 2 NLR, 2 ILR, 2 medium, 1 very broad', 'norm', 1.0),
+                     'mean': tied_to('N V - 2 NLR, 2 ILR, 2 medium, 1 very broad', 'mean', 1.003215),
+                     'fwhm': tied_to('N V - 2 NLR, 2 ILR, 2 medium, 1 very broad', 'fwhm', 1.0)},
              fixed = {'skew': True},
              ) \
 + \
@@ -153,8 +153,8 @@ model1 = \
                        'mean': (1000., 2000.),
                        'fwhm': (100.,  2000.),
                        'skew': (1., 1.)},
-             tied = {'mean': lambda m: 1.019043 * m['gaussian5'].mean,
-                     'fwhm': lambda m: 1.0      * m['gaussian5'].fwhm},
+             tied = {'mean': tied_to('gaussian5', 'mean', 1.019043),
+                     'fwhm': tied_to('gaussian5', 'fwhm', 1.0)},
              fixed = {'norm': True,
                       'skew': True},
              ) \
@@ -167,9 +167,9 @@ model1 = \
                        'mean': (1150., 2000.),
                        'fwhm': (30.,  12000.),
                        'skew': (1., 1.)},
-             tied = {'norm': lambda m: 1.0      * m['gaussian11'].norm,
-                     'mean': lambda m: 1.003215 * m['gaussian11'].mean,
-                     'fwhm': lambda m: 1.0      * m['gaussian11'].fwhm},
+             tied = {'norm': tied_to('gaussian11', 'norm', 1.0),
+                     'mean': tied_to('gaussian11', 'mean', 1.003215),
+                     'fwhm': tied_to('gaussian11', 'fwhm', 1.0)},
              fixed = {'skew': True},
              ) \
 + \
@@ -181,8 +181,8 @@ model1 = \
                        'mean': (1000., 2000.),
                        'fwhm': (500.,  50000.),
                        'skew': (1., 1.)},
-             tied = {'mean': lambda m: 1.019043 * m['gaussian6'].mean,
-                     'fwhm': lambda m: 1.0      * m['gaussian6'].fwhm},
+             tied = {'mean': tied_to('gaussian6', 'mean', 1.019043),
+                     'fwhm': tied_to('gaussian6', 'fwhm', 1.0)},
              fixed = {'skew': True},
              ) \
 + \
@@ -194,9 +194,9 @@ model1 = \
                        'mean': (1150., 2000.),
                        'fwhm': (500.,  50000.),
                        'skew': (1., 1.)},
-             tied = {'norm': lambda m: 1.0      * m['gaussian13'].norm,
-                     'mean': lambda m: 1.003215 * m['gaussian13'].mean,
-                     'fwhm': lambda m: 1.0      * m['gaussian13'].fwhm},
+             tied = {'norm': tied_to('gaussian13', 'norm', 1.0),
+                     'mean': tied_to('gaussian13', 'mean', 1.003215),
+                     'fwhm': tied_to('gaussian13', 'fwhm', 1.0)},
              fixed = {'skew': True},
              ) \
 + \
@@ -208,8 +208,8 @@ model1 = \
                        'mean': (1000., 2000.),
                        'fwhm': (500.,  50000.),
                        'skew': (1., 1.)},
-             tied = {'mean': lambda m: 1.019043 * m['gaussian7'].mean,
-                     'fwhm': lambda m: 1.0      * m['gaussian7'].fwhm},
+             tied = {'mean': tied_to('gaussian7', 'mean', 1.019043),
+                     'fwhm': tied_to('gaussian7', 'fwhm', 1.0)},
              fixed = {'skew': True},
              ) \
 + \
@@ -221,9 +221,9 @@ model1 = \
                        'mean': (1150., 2000.),
                        'fwhm': (500.,  50000.),
                        'skew': (1., 1.)},
-             tied = {'norm': lambda m: 1.0      * m['gaussian15'].norm,
-                     'mean': lambda m: 1.003215 * m['gaussian15'].mean,
-                     'fwhm': lambda m: 1.0      * m['gaussian15'].fwhm},
+             tied = {'norm': tied_to('gaussian15', 'norm', 1.0),
+                     'mean': tied_to('gaussian15', 'mean', 1.003215),
+                     'fwhm': tied_to('gaussian15', 'fwhm', 1.0)},
              fixed = {'skew': True},
              ) \
 + \
@@ -235,8 +235,8 @@ model1 = \
                        'mean': (1000., 2000.),
                        'fwhm': (1500.,  25000.),
                        'skew': (1., 1.)},
-             tied = {'mean': lambda m: 1.020682 * m['gaussian15'].mean,
-                     'fwhm': lambda m: 1.0      * m['gaussian15'].fwhm},
+             tied = {'mean': tied_to('gaussian15', 'mean', 1.020682),
+                     'fwhm': tied_to('gaussian15', 'fwhm', 1.0)},
              fixed = {'skew': True},
              ) \
 + \
@@ -249,8 +249,8 @@ model1 = \
                        'mean': (1000., 2000.),
                        'fwhm': (200.,  20000.),
                        'skew': (0.1, 9.)},
-             tied = {'fwhm': lambda m: 1.0 * m['Ly alpha broad absorption'].fwhm,
-                     'skew': lambda m: 1.0 * m['Ly alpha broad absorption'].skew},
+             tied = {'fwhm': tied_to('Ly alpha broad absorption', 'fwhm', 1.0),
+                     'skew': tied_to('Ly alpha broad absorption', 'skew', 1.0)},
              fixed = {'norm': True,
                       'mean': True},
              ) \
@@ -278,8 +278,8 @@ model1 = \
                        'mean': (1000., 2000.),
                        'fwhm': (200.,  20000.),
                        'skew': (0.05, 5.)},
-             tied = {'fwhm': lambda m: 1.0 * m['Ly alpha broad absorption'].fwhm,
-                     'skew': lambda m: 1.0 * m['Ly alpha broad absorption'].skew},
+             tied = {'fwhm': tied_to('Ly alpha broad absorption', 'fwhm', 1.0),
+                     'skew': tied_to('Ly alpha broad absorption', 'skew', 1.0)},
              fixed = {'mean': True},
              ) \
 + \
@@ -292,8 +292,8 @@ model1 = \
                        'mean': (1150., 2000.),
                        'fwhm': (200.,  20000.),
                        'skew': (0.05, 5.)},
-             tied = {'norm': lambda m: 1.0      * m['N V broad absorption'].norm,
-                     'mean': lambda m: 1.003215 * m['N V broad absorption'].mean,
-                     'fwhm': lambda m: 1.0      * m['N V broad absorption'].fwhm,
-                     'skew': lambda m: 1.0      * m['N V broad absorption'].skew},
+             tied = {'norm': tied_to('N V broad absorption', 'norm', 1.0),
+                     'mean': tied_to('N V broad absorption', 'mean', 1.003215),
+                     'fwhm': tied_to('N V broad absorption', 'fwhm', 1.0),
+                     'skew': tied_to('N V broad absorption', 'skew', 1.0)},
              )
@@ -0,0 +1,122 @@
+# Checks of fit_cube on a small synthetic cube
+#
+# Run with pytest from this directory.
+
+import numpy as np
+import pytest
+
+from astropy.modeling import fitting
+
+from custom_models import gaussian, powerlaw
+from cube_fitter import fit_cube, CONVERGED, LOW_SNR, NO_DATA, NOT_FITTED
+
+
+def _model():
+    return (gaussian(norm=50., mean=1213., fwhm=1500., skew=1., name='line',
+                     fixed={'skew': True}) +
+            powerlaw(amplitude=1., x_0=1215., alpha=0., name='continuum',
+                     fixed={'x_0': True, 'alpha': True}))
+
+
+def _cube(seed=0):
+    # 5x6 spaxels of a line whose flux falls off from the centre, on a flat
+    # continuum; spaxel (0, 0) is empty, (0, 1) has exactly as many valid
+    # points as free parameters, and the last column has no signal
+    rng = np.random.default_rng(seed)
+    wavelength = np.linspace(1180., 1250., 150)
+    model = _model()
+    ny, nx = 5, 6
+    cube = np.empty((len(wavelength), ny, nx))
+    for y in range(ny):
+        for x in range(nx):
+            model.norm_0 = 100. * np.exp(-((y - 2.) ** 2 + (x - 2.) ** 2) / 8.)
+            model.mean_0 = 1215. + 0.5 * (x - 2.)
+            model.fwhm_0 = 2000.
+            model.amplitude_1 = 2.
+            cube[:, y, x] = model(wavelength)
+    cube[:, :, -1] = 0.
+    uncertainty = np.full(cube.shape, 0.1)
+    cube += uncertainty * rng.standard_normal(cube.shape)
+    cube[:, 0, 0] = np.nan
+    cube[4:, 0, 1] = np.nan
+    return wavelength, cube, uncertainty
+
+
+class _CountingFitter(fitting.LevMarLSQFitter):
+    # counts the fits (n_workers=1 runs them in this process)
+    calls = 0
+
+    def __call__(self, *args, **kwargs):
+        _CountingFitter.calls += 1
+        return super(_CountingFitter, self).__call__(*args, **kwargs)
+
+
+@pytest.fixture(scope='module')
+def serial():
+    wavelength, cube, uncertainty = _cube()
+    return fit_cube(_model(), wavelength, cube, uncertainty, n_workers=1, warm_start=False)
+
+
+def test_status(serial):
+    assert serial.status[0, 0] == NO_DATA
+    assert serial.status[0, 1] == NO_DATA
+    assert np.all(serial.status[:, -1] == LOW_SNR)
+    assert np.all(serial.status[1:, :-1] == CONVERGED)
+    assert np.all(np.isnan(serial.parameters[:, serial.status != CONVERGED]))
+    assert np.allclose(serial.parameter('amplitude_1')[1:, :-1], 2., atol=0.05)
+    assert np.allclose(serial.parameter('mean_0')[2, :-1], 1215. + 0.5 * (np.arange(5) - 2.),
+                       atol=0.05)
+    assert np.all(serial.uncertainty('norm_0')[1:, :-1] > 0)
+
+
+def test_workers(serial):
+    wavelength, cube, uncertainty = _cube()
+    pooled = fit_cube(_model(), wavelength, cube, uncertainty, n_workers=2, warm_start=False)
+    assert np.array_equal(pooled.status, serial.status)
+    assert np.allclose(pooled.parameters, serial.parameters, rtol=1e-10, equal_nan=True)
+    assert np.allclose(pooled.uncertainties, serial.uncertainties, rtol=1e-10, equal_nan=True)
+    # warm starts end in the same minima
+    warm = fit_cube(_model(), wavelength, cube, uncertainty, n_workers=2)
+    assert np.array_equal(warm.status, serial.status)
+    assert np.allclose(warm.parameters, serial.parameters, rtol=1e-5, equal_nan=True)
+
+
+def test_estimated_uncertainty(serial):
+    wavelength, cube, uncertainty = _cube()
+    result = fit_cube(_model(), wavelength, cube, None, n_workers=1, warm_start=False)
+    assert np.array_equal(result.status, serial.status)
+    converged = result.status == CONVERGED
+    assert np.allclose(result.parameters[:, converged], serial.parameters[:, converged],
+                       rtol=1e-3)
+    # the noise estimated from the flux differences is close to the true one
+    # (somewhat larger, as the differences include the slopes of the line)
+    for name in ['norm_0', 'mean_0', 'fwhm_0', 'amplitude_1']:
+        ratio = result.uncertainty(name)[converged] / serial.uncertainty(name)[converged]
+        assert np.all((ratio > 0.7) & (ratio < 1.6))
+
+
+def test_checkpoint_resume(serial, tmp_path):
+    wavelength, cube, uncertainty = _cube()
+    checkpoint = tmp_path / 'cube.npz'
+    first = fit_cube(_model(), wavelength, cube, uncertainty, n_workers=1, warm_start=False,
+                     fitter=_CountingFitter, checkpoint=checkpoint)
+    assert _CountingFitter.calls == np.sum(first.status == CONVERGED)
+
+    # everything is in the checkpoint: nothing is fitted again
+    _CountingFitter.calls = 0
+    resumed = fit_cube(_model(), wavelength, cube, uncertainty, n_workers=1, warm_start=False,
+                       fitter=_CountingFitter, checkpoint=checkpoint)
+    assert _CountingFitter.calls == 0
+    assert np.array_equal(resumed.status, first.status)
+    assert np.array_equal(resumed.parameters, first.parameters, equal_nan=True)
+
+    # an interrupted run: only the spaxels missing from the checkpoint are fitted
+    with np.load(checkpoint) as data:
+        saved = dict(data)
+    saved['status'][2:, :] = NOT_FITTED
+    np.savez(checkpoint, **saved)
+    resumed = fit_cube(_model(), wavelength, cube, uncertainty, n_workers=1, warm_start=False,
+                       fitter=_CountingFitter, checkpoint=checkpoint)
+    assert _CountingFitter.calls == np.sum(first.status[2:, :] == CONVERGED)
+    assert np.array_equal(resumed.status, first.status)
+    assert np.allclose(resumed.parameters, first.parameters, rtol=1e-10, equal_nan=True)
@@ -0,0 +1,133 @@
+# Checks of the analytic derivatives of custom_models against finite differences
+#
+# Run with pytest from this directory.
+
+import numpy as np
+import pytest
+
+from astropy.modeling import fitting
+
+import custom_models
+from custom_models import (gaussian, ccmext, powerlaw, tied_to, compile_ties,
+                           fuse_gaussians, windowed_sum, with_fit_deriv, _value_and_deriv,
+                           tie_jacobian)
+
+
+def _numerical_deriv(model, x, step=1e-6):
+    # central differences of model with respect to every parameter,
+    # resolving the ties after each step as the fitters do
+    model = model.copy()
+    tied = [name for name in model.param_names if model.tied[name]]
+
+    def evaluate(params):
+        model.parameters = params
+        for name in tied:
+            setattr(model, name, model.tied[name](model))
+        return model(x)
+
+    base = model.parameters.copy()
+    deriv = []
+    for j, name in enumerate(model.param_names):
+        h = step * max(abs(base[j]), 1e-3)
+        upper = base.copy()
+        upper[j] += h
+        lower = base.copy()
+        lower[j] -= h
+        deriv.append((evaluate(upper) - evaluate(lower)) / (2 * h))
+    return np.array(deriv)
+
+
+def _test_model():
+    # skewed gaussians tied to each other, on a reddened powerlaw
+    model = (powerlaw(amplitude=1., x_0=1000., alpha=1., name='continuum',
+                      fixed={'x_0': True}) *
+             ccmext(ebmv=0.05, rv=3.1, name='extinction', fixed={'rv': True}) +
+             gaussian(norm=20., mean=1215., fwhm=2000., skew=1.5, name='broad') +
+             gaussian(norm=5., mean=1240., fwhm=500., skew=1., name='narrow',
+                      tied={'fwhm': tied_to('broad', 'fwhm', 0.25)}))
+    model = compile_ties(model)
+    # tie-consistent parameters
+    model.fwhm_3 = 0.25 * model.fwhm_2.value
+    return model
+
+
+def test_windowed_sum():
+    x = np.linspace(1150., 1300., 2000)
+    model = _test_model()
+    windowed = windowed_sum(model)
+    assert np.array_equal(windowed(x), model(x))
+    # unsorted and scalar inputs go through CompoundModel
+    assert np.array_equal(windowed(x[::-1]), model(x[::-1]))
+    assert windowed(1215.) == model(1215.)
+
+
+def test_sorted_x_cache():
+    # the sortedness of a read-only x is checked once, and only for that x
+    model = gaussian(norm=20., mean=1215., fwhm=2000., skew=1.5)
+    x = np.linspace(1150., 1300., 2000)
+    expected = model(x)
+    readonly = x.copy()
+    readonly.flags.writeable = False
+    assert np.array_equal(model(readonly), expected)
+    assert custom_models._sorted_x[0]() is readonly
+    assert np.array_equal(model(readonly), expected)
+    shuffled = readonly[::-1].copy()
+    shuffled.flags.writeable = False
+    assert np.array_equal(model(shuffled), expected[::-1])
+    assert custom_models._sorted_x[0]() is shuffled
+    # writeable arrays may change between calls, and are checked every time
+    model(x)
+    assert custom_models._sorted_x[0]() is shuffled
+
+
+def test_component_derivatives():
+    x = np.linspace(1150., 1300., 2000)
+    for model in [gaussian(norm=20., mean=1215., fwhm=2000., skew=1.5),
+                  ccmext(ebmv=0.05, rv=3.1),
+                  powerlaw(amplitude=1., x_0=1000., alpha=1.)]:
+        analytic = np.array(model.fit_deriv(x, *model.parameters))
+        numerical = _numerical_deriv(model, x)
+        for a, n in zip(analytic, numerical):
+            assert np.allclose(a, n, rtol=0, atol=1e-5 * max(np.abs(n).max(), 1e-12))
+
+
+def test_compound_derivatives_with_ties():
+    x = np.linspace(1150., 1300., 2000)
+    model = _test_model()
+    value, deriv = _value_and_deriv(model, x, model.parameters)
+    analytic = np.tensordot(tie_jacobian(model).T, np.array(deriv), axes=1)
+    numerical = _numerical_deriv(model, x)
+    free = [i for i, name in enumerate(model.param_names)
+            if not model.fixed[name] and not model.tied[name]]
+    assert np.allclose(value, model(x))
+    for i in free:
+        assert np.allclose(analytic[i], numerical[i], rtol=0,
+                           atol=1e-5 * max(np.abs(numerical[i]).max(), 1e-12))
+
+
+def test_fit_from_a_bound():
+    # a parameter starting at a bound can move off it
+    x = np.linspace(1200., 1300., 500)
+    truth = (powerlaw(amplitude=1., x_0=1000., alpha=1.) +
+             gaussian(norm=20., mean=1250., fwhm=2000., skew=1.))
+    y = truth(x) + np.random.default_rng(0).normal(0., 0.01, len(x))
+    model = (powerlaw(amplitude=1., x_0=1000., alpha=1., fixed={'x_0': True}) +
+             gaussian(norm=0., mean=1250., fwhm=2000., skew=1., bounds={'norm': (0., 1e3)}))
+    fitter = fitting.LevMarLSQFitter()
+    fit = fitter(with_fit_deriv(model), x, y, maxiter=500)
+    assert abs(fit.norm_1.value - 20.) < 0.5
+    assert fitter.fit_info['param_cov'] is not None
+
+
+def test_fuse_gaussians():
+    x = np.linspace(1150., 1300., 2000)
+    model = _test_model()
+    fused = fuse_gaussians(model)
+    assert np.allclose(fused(x), model(x), rtol=1e-14, atol=0)
+    assert fused['gaussians'].component_names == ['broad', 'narrow']
+    assert fused.tied['fwhm_1_2'].scale == 0.25
+
+    duplicate = model.copy()
+    duplicate['narrow'].name = 'broad'
+    with pytest.raises(ValueError):
+        fuse_gaussians(duplicate)
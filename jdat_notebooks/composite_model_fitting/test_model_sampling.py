@@ -0,0 +1,114 @@
+# Checks of the parameter set evaluation and of the bootstrap and MCMC
+# uncertainties of model_sampling
+#
+# Run with pytest from this directory.
+
+import numpy as np
+import pytest
+
+from astropy.modeling import fitting
+
+from custom_models import gaussian, ccmext, powerlaw, tied_to, compile_ties, fit_covariance
+from model_sampling import (evaluate_parameter_sets, expand_parameters, free_parameters,
+                            bootstrap, sample_posterior, _batch_fit,
+                            CONVERGED, STALLED, MAX_ITER)
+
+
+def _compound_model():
+    # reddened powerlaw with two gaussians, the fwhm of one tied to the other
+    model = (powerlaw(amplitude=1., x_0=1000., alpha=1., name='continuum',
+                      fixed={'x_0': True}) *
+             ccmext(ebmv=0.05, rv=3.1, name='extinction', fixed={'rv': True}) +
+             gaussian(norm=20., mean=1215., fwhm=2000., skew=1.5, name='broad') +
+             gaussian(norm=5., mean=1240., fwhm=500., skew=1., name='narrow',
+                      tied={'fwhm': tied_to('broad', 'fwhm', 0.25)}))
+    return compile_ties(model)
+
+
+def _random_sets(model, k, rng):
+    # k parameter sets scattered around those of model, ties resolved
+    free = free_parameters(model)
+    p0 = model.parameters[free]
+    return expand_parameters(model, p0 * (1. + 0.05 * rng.standard_normal((k, len(free)))))
+
+
+def test_evaluate_parameter_sets():
+    rng = np.random.default_rng(0)
+    model = _compound_model()
+    x = rng.permutation(np.linspace(1150., 1300., 500))
+    params = _random_sets(model, 10, rng)
+    expected = []
+    for p in params:
+        model.parameters = p
+        expected.append(model(x))
+    for kwargs in [{}, {'chunk_size': 3}, {'max_memory': 1}]:
+        values = evaluate_parameter_sets(model, x, params, **kwargs)
+        assert values.shape == (10, len(x))
+        assert np.allclose(values, expected, rtol=1e-12, atol=1e-12)
+
+
+def test_expand_parameters():
+    model = _compound_model()
+    free = free_parameters(model)
+    names = model.param_names
+    assert names[free[0]] == 'amplitude_0'
+    assert 'fwhm_3' not in [names[i] for i in free]
+    assert 'x_0_0' not in [names[i] for i in free]
+
+    free_sets = model.parameters[free] * np.array([[1.], [2.]])
+    params = expand_parameters(model, free_sets)
+    fwhm_2, fwhm_3 = names.index('fwhm_2'), names.index('fwhm_3')
+    assert np.allclose(params[:, fwhm_3], 0.25 * params[:, fwhm_2])
+    assert np.all(params[:, names.index('x_0_0')] == 1000.)
+    assert np.all(params[:, free] == free_sets)
+
+    # a tie that is an arbitrary function is resolved set by set
+    model.tied['fwhm_3'] = lambda m: m.fwhm_2 / 2.
+    params = expand_parameters(model, free_sets)
+    assert np.allclose(params[:, fwhm_3], 0.5 * params[:, fwhm_2])
+
+
+@pytest.fixture(scope='module')
+def gaussian_fit():
+    # one gaussian with noise of 0.2, fitted with its covariance
+    rng = np.random.default_rng(1)
+    x = np.linspace(1180., 1250., 300)
+    y = gaussian(norm=100., mean=1215., fwhm=2000., skew=1.3)(x) + 0.2 * rng.standard_normal(len(x))
+    weights = np.full(len(x), 5.)
+    start = gaussian(norm=80., mean=1214., fwhm=1800., skew=1.3, fixed={'skew': True})
+    fit = fitting.LevMarLSQFitter()(start, x, y, weights=weights)
+    return fit, x, y, weights, fit_covariance(fit, x, y, weights)
+
+
+def test_bootstrap(gaussian_fit):
+    fit, x, y, weights, cov = gaussian_fit
+    samples, status = bootstrap(fit, x, y, weights, n_samples=400, seed=2)
+    assert samples.shape == (400, 3)
+    assert np.all(status == CONVERGED)
+    ratio = samples.std(axis=0) / np.sqrt(np.diag(cov))
+    assert np.all((ratio > 0.8) & (ratio < 1.2))
+
+
+def test_bootstrap_failures(gaussian_fit):
+    fit, x, y, weights, cov = gaussian_fit
+    # refits cut short are not converged
+    samples, status = bootstrap(fit, x, y, weights, n_samples=20, max_iter=1, seed=2)
+    assert np.all(status == MAX_ITER)
+    # a data set that no step can improve stalls, and is not converged either
+    ys = np.array([y, np.where(x > 1215., np.nan, y)])
+    params, status = _batch_fit(fit, x, ys, weights, fit.parameters[:3] * 1.01)
+    assert list(status) == [CONVERGED, STALLED]
+
+
+def test_sample_posterior(gaussian_fit):
+    fit, x, y, weights, cov = gaussian_fit
+    posterior = sample_posterior(fit, x, y, weights, n_steps=1500, covariance=cov, seed=3)
+    assert posterior.param_names == ['norm', 'mean', 'fwhm']
+    assert posterior.chain.shape == (1500, 32, 3)
+    assert 0.2 < np.mean(posterior.acceptance_fraction) < 0.9
+    samples = posterior.samples(burn=300)
+    ratio = samples.std(axis=0) / np.sqrt(np.diag(cov))
+    assert np.all((ratio > 0.85) & (ratio < 1.15))
+    correlation = np.corrcoef(samples.T)
+    expected = cov / np.sqrt(np.outer(np.diag(cov), np.diag(cov)))
+    assert np.allclose(correlation, expected, atol=0.1)
@@ -3,9 +3,17 @@
 import os
 import logging
 
-from nbpages import make_parser, run_parsed, make_html_index
+from nbpages import make_parser, run_parsed, HTMLIndexBuilder
 
-args = make_parser().parse_args()
+parser = make_parser()
+parser.add_argument('--index-page-size', default=None, type=int,
+                    dest='index_page_size',
+                    help='Maximum number of notebooks per index page (default: '
+                         'all on one page).')
+parser.add_argument('--index-group-by', default=None,
+                    choices=['directory', 'instrument'], dest='index_group_by',
+                    help='Group the notebooks on the index pages.')
+args = parser.parse_args()
 if args.template_file is None and os.path.exists('nb_html.tpl'):
     args.template_file = 'nb_html.tpl'
 
@@ -25,4 +33,6 @@ if args.exclude is None:
 converted = run_parsed('.', output_type='HTML', args=args)
 
 logging.getLogger('nbpages').info('Generating index.html')
-make_html_index(converted, './index.tpl')
+builder = HTMLIndexBuilder('./index.tpl', page_size=args.index_page_size,
+                           group_by=args.index_group_by)
+builder.build(converted, 'index.html')
@@ -36,13 +36,12 @@ else
   REMOTE_NAME="${REMOTE_NAME}"
 fi
 
-git clone -b ${DEPLOY_BRANCH} --single-branch ${REPO_URL} /out
-
-cd /out
-
-cp -aR ${WORKSPACE}/* .
-
-git add .
-git commit -m "Automated deployment to GitHub Pages: ${BUILD_TAG}" --allow-empty
-git push $REMOTE_NAME $DEPLOY_BRANCH
-git clean -dfx
+# only changed files are copied and committed (see nbpages/publish.py), with
+# precompressed .gz copies of the html/css/js files
+SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+PYTHONPATH="${SCRIPT_DIR}:${PYTHONPATH}" python -m nbpages.publish \
+  --workspace "${WORKSPACE}" \
+  --repo-url "${REPO_URL}" \
+  --branch "${DEPLOY_BRANCH}" \
+  --build-tag "${BUILD_TAG}" \
+  --remote-name "${REMOTE_NAME}"
@@ -5,10 +5,92 @@
 <title>jdat_notebooks Index</title>
 </head>
 <body>
-<ul>
-{% for notebook_html_path in notebook_html_paths %}
-  <li><a href="{{ notebook_html_path }}">{{ notebook_html_path }}</a></li>
+{% macro notebook_list(notebooks) -%}
+<ul class="notebook-index">
+{% for notebook in notebooks %}
+  <li data-keywords="{{ notebook.keywords | join(',') }}"{% if notebook.instrument %} data-instrument="{{ notebook.instrument }}"{% endif %}><a href="{{ notebook.path }}">{{ notebook.title }}</a></li>
 {% endfor %}
 </ul>
+{%- endmacro %}
+{% if search_index_path %}
+<input type="search" id="notebook-search" placeholder="Search notebooks by title, keyword or instrument" hidden>
+<ul id="search-results" class="notebook-index" hidden></ul>
+{% endif %}
+<div id="notebooks"{% if search_index_path %} data-search-index="{{ search_index_path }}"{% endif %}>
+{% if groups %}
+{% for group_name, group_notebooks in groups %}
+<h2>{{ group_name or 'Other' }}</h2>
+{{ notebook_list(group_notebooks) }}
+{% endfor %}
+{% else %}
+{{ notebook_list(notebooks) }}
+{% endif %}
+</div>
+{% if page_paths and page_paths | length > 1 %}
+<nav>
+{% if prev_page_path %}<a href="{{ prev_page_path }}" rel="prev">Previous</a>{% endif %}
+{% for page_path in page_paths %}
+  {% if loop.index == page_number %}<span>{{ loop.index }}</span>{% else %}<a href="{{ page_path }}">{{ loop.index }}</a>{% endif %}
+{% endfor %}
+{% if next_page_path %}<a href="{{ next_page_path }}" rel="next">Next</a>{% endif %}
+</nav>
+{% endif %}
+{% if search_index_path %}
+<script>
+// Search all notebooks (not only those on this page) with the prebuilt index
+// written next to this page: every query word has to be a prefix of a token
+// of the notebook's title, keywords or instrument.
+(function () {
+  var listing = document.getElementById('notebooks');
+  var input = document.getElementById('notebook-search');
+  var results = document.getElementById('search-results');
+  var nav = document.querySelector('nav');
+  var searchIndex = null;
+
+  function tokenize(text) {
+    return text.toLowerCase().match(/[a-z0-9]+/g) || [];
+  }
+
+  function matches(word) {
+    var docs = {};
+    Object.keys(searchIndex.index).forEach(function (token) {
+      if (token.lastIndexOf(word, 0) === 0) {
+        searchIndex.index[token].forEach(function (i) { docs[i] = true; });
+      }
+    });
+    return docs;
+  }
+
+  function search() {
+    var words = tokenize(input.value);
+    listing.hidden = words.length > 0;
+    if (nav) { nav.hidden = words.length > 0; }
+    results.hidden = words.length === 0;
+    results.textContent = '';
+    if (words.length === 0) { return; }
+
+    var found = words.map(matches);
+    searchIndex.docs.forEach(function (nb, i) {
+      if (found.every(function (docs) { return docs[i]; })) {
+        var item = document.createElement('li');
+        var link = document.createElement('a');
+        link.href = nb.path;
+        link.textContent = nb.title;
+        item.appendChild(link);
+        results.appendChild(item);
+      }
+    });
+  }
+
+  fetch(listing.getAttribute('data-search-index'))
+    .then(function (response) { return response.json(); })
+    .then(function (data) {
+      searchIndex = data;
+      input.hidden = false;
+      input.addEventListener('input', search);
+    });
+})();
+</script>
+{% endif %}
 </body>
 </html>
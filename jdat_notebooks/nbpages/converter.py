@@ -2,6 +2,7 @@
 from os import path, walk, remove, makedirs
 
 import re
+import json
 import time
 import logging
 import argparse
@@ -12,7 +13,8 @@ from nbconvert.exporters import RSTExporter, HTMLExporter
 from nbconvert.writers import FilesWriter
 import nbformat
 
-__all__ = ['NBPagesConverter', 'process_notebooks', 'make_parser', 'run_parsed']
+__all__ = ['NBPagesConverter', 'process_notebooks', 'make_parser', 'run_parsed',
+           'metadata_sidecar_path']
 
 logger = logging.getLogger('nbpages')
 def init_logger():
@@ -105,6 +107,8 @@ class NBPagesConverter(object):
         et = time.time()
         logger.info('Execution of notebook {} took {} sec'.format(self.nb_name,
                     et - st))
+        # record the runtime so the conversion stage can put it in the sidecar
+        nb.metadata['nbpages'] = {'runtime': et - st}
 
         if write:
             logger.debug('Writing executed notebook to file {0}...'
@@ -176,28 +180,26 @@ class NBPagesConverter(object):
         if self._output_type == 'RST':
             self._add_filter_keywords(output_file_path)
 
+        self._write_metadata(output_file_path, resources)
+
         if remove_executed:  # optionally, clean up the executed notebook file
             remove(self._executed_nb_path)
 
         return output_file_path
 
+    def _read_executed(self):
+        with open(self._executed_nb_path) as f:
+            return nbformat.read(f, as_version=self.nb_version)
+
     def _add_filter_keywords(self, output_file_path):
         """
         read the executed notebook, grab the keywords from the header,
         add them in to the output as filter keywords
         """
-        with open(self._executed_nb_path) as f:
-            nb = nbformat.read(f, as_version=self.nb_version)
+        nb = self._read_executed()
 
-        top_cell_text = nb['cells'][0]['source']
-        match = re.search('## [kK]eywords\s+(.*)', top_cell_text)
-
-        if match:
-            keywords = match.groups()[0].split(',')
-            keywords = [clean_keyword(k) for k in keywords if k.strip()]
-            keyword_filters = ['filter{0}'.format(k) for k in keywords]
-        else:
-            keyword_filters = []
+        keywords = parse_keywords(nb['cells'][0]['source'])
+        keyword_filters = ['filter{0}'.format(k) for k in keywords]
 
         # Add metatags to top of RST files to get rendered into HTML, used for
         # the search and filter functionality in Learn Astropy
@@ -211,6 +213,57 @@ class NBPagesConverter(object):
             rst_text = '{0}\n{1}'.format(meta_tutorials, rst_text)
             f.write(rst_text)
 
+    def extract_metadata(self):
+        """
+        Collect the per-notebook metadata used to build the site's search
+        index from the executed notebook.
+
+        Returns
+        -------
+        metadata : dict
+            With keys ``name``, ``title``, ``keywords``, ``instrument`` and
+            ``runtime`` (execution time in seconds, or ``None`` if unknown).
+        """
+        nb = self._read_executed()
+
+        header_cells = [cell['source'] for cell in nb['cells'][:3]
+                        if cell['cell_type'] == 'markdown']
+        header = '\n'.join(header_cells)
+
+        title = self.nb_name
+        match = re.search(r'^#+\s+(.+)$', header, re.MULTILINE)
+        if match:
+            title = match.groups()[0].strip()
+
+        instrument = None
+        match = re.search(r'\*\*Cross-in(?:s)?trument:\*\*\s*([^<\n]*)', header)
+        if match:
+            instrument = match.groups()[0].strip().rstrip('.').strip() or None
+
+        keywords = parse_keywords(nb['cells'][0]['source']) if nb['cells'] else []
+        runtime = nb.metadata.get('nbpages', {}).get('runtime')
+
+        return {'name': self.nb_name, 'title': title, 'keywords': keywords,
+                'instrument': instrument, 'runtime': runtime}
+
+    def _write_metadata(self, output_file_path, resources):
+        """
+        Write the JSON metadata sidecar next to the converted output file.
+        """
+        metadata = self.extract_metadata()
+
+        output_size = path.getsize(output_file_path)
+        for data in resources.get('outputs', {}).values():
+            output_size += len(data)
+        metadata['output_size'] = output_size
+
+        sidecar_path = metadata_sidecar_path(output_file_path)
+        logger.debug('Writing metadata sidecar to {0}'.format(sidecar_path))
+        with open(sidecar_path, 'w') as f:
+            json.dump(metadata, f)
+
+        return sidecar_path
+
 
 def process_notebooks(nbfile_or_path, exec_only=False, exclude=[], include=[],
                       **kwargs):
@@ -284,6 +337,25 @@ def process_notebooks(nbfile_or_path, exec_only=False, exclude=[], include=[],
     return converted
 
 
+def metadata_sidecar_path(output_file_path):
+    """
+    The path of the JSON metadata sidecar written alongside a converted
+    notebook.
+    """
+    return path.splitext(output_file_path)[0] + '.meta.json'
+
+
+def parse_keywords(cell_text):
+    """Parse the ``## Keywords`` line of a notebook header cell into a list of
+    cleaned keywords (see `clean_keyword`).
+    """
+    match = re.search(r'## [kK]eywords\s+(.*)', cell_text)
+    if not match:
+        return []
+    keywords = match.groups()[0].split(',')
+    return [clean_keyword(k) for k in keywords if k.strip()]
+
+
 def clean_keyword(kw):
     """Given a keyword parsed from the header of one of the tutorials, return
     a 'cleaned' keyword that can be used by the filtering machinery.
@@ -1,9 +1,102 @@
 import os
+import re
+import json
+
 import jinja2
 
+from .converter import metadata_sidecar_path
+
+__all__ = ['make_html_index', 'HTMLIndexBuilder', 'load_notebook_metadata',
+           'build_search_index']
+
+# jinja2 environments keyed on (template directory, bytecode cache directory),
+# so repeated index builds reuse the already-compiled templates
+_environments = {}
+
+
+def _get_environment(template_dir, bytecode_cache_dir=None):
+    key = (os.path.abspath(template_dir), bytecode_cache_dir)
+    if key not in _environments:
+        if bytecode_cache_dir is None:
+            bytecode_cache = None
+        else:
+            os.makedirs(bytecode_cache_dir, exist_ok=True)
+            bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_cache_dir)
+        _environments[key] = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(template_dir),
+            autoescape=jinja2.select_autoescape(['html', 'xml']),
+            bytecode_cache=bytecode_cache)
+    return _environments[key]
+
+
+def load_notebook_metadata(converted_file):
+    """
+    Load the JSON metadata sidecar written by the converter for a converted
+    notebook.  If there is no sidecar, a minimal record derived from the file
+    name is returned instead.
+    """
+    sidecar = metadata_sidecar_path(converted_file)
+    if os.path.exists(sidecar):
+        with open(sidecar) as f:
+            return json.load(f)
+
+    name = os.path.splitext(os.path.basename(converted_file))[0]
+    return {'name': name, 'title': name, 'keywords': [], 'instrument': None,
+            'runtime': None, 'output_size': None}
+
+
+def _tokenize(text):
+    return re.findall('[a-z0-9]+', text.lower())
+
+
+def build_search_index(notebooks):
+    """
+    Build a compact inverted search index from a list of notebook metadata
+    records (as returned by `load_notebook_metadata`, with an added ``path``).
+
+    Returns
+    -------
+    search_index : dict
+        ``docs`` is the list of notebook records, ``index`` maps each search
+        token to the sorted list of positions in ``docs`` that contain it.
+    """
+    index = {}
+    for i, nb in enumerate(notebooks):
+        text = ' '.join([nb.get('title') or '', nb.get('instrument') or ''] +
+                        list(nb.get('keywords') or []))
+        for token in set(_tokenize(text)):
+            index.setdefault(token, []).append(i)
+
+    return {'docs': notebooks,
+            'index': {token: index[token] for token in sorted(index)}}
+
+
+def _collect_notebooks(converted_files, outfn, relpaths):
+    metadata = [load_notebook_metadata(pth) for pth in converted_files]
+
+    if relpaths:
+        outdir = os.path.realpath(os.path.dirname(outfn) if outfn else os.path.curdir)
+        converted_files = [os.path.relpath(os.path.realpath(pth), outdir)
+                           for pth in converted_files]
+    else:
+        converted_files = list(converted_files)
+
+    notebooks = []
+    for pth, meta in zip(converted_files, metadata):
+        meta = dict(meta)
+        meta['path'] = pth
+        notebooks.append(meta)
+    return converted_files, notebooks
+
+
+def _write_search_index(notebooks, outfn, search_index_fn):
+    search_index_path = os.path.join(os.path.dirname(outfn), search_index_fn)
+    with open(search_index_path, 'w') as f:
+        json.dump(build_search_index(notebooks), f, separators=(',', ':'))
+
 
 def make_html_index(converted_files, html_template, outfn='index.html',
-                    relpaths=True):
+                    relpaths=True, search_index_fn='search_index.json'):
     """
     Generates an html index page for a set of notebooks
 
@@ -14,12 +107,18 @@ def make_html_index(converted_files, html_template, outfn='index.html',
     html_template : str
         A path to the template file to be used for generating the index. The
         template should be in jinja2 format and have a loop over
-        ``notebook_html_paths`` to populate with the links
+        ``notebook_html_paths`` to populate with the links.  The per-notebook
+        metadata is available as ``notebooks`` and the path of the search
+        index as ``search_index_path``.
     outfn : str or None
         the output file name, or None to not write the file
     relpaths : bool
         If True, the paths are all passed in as relative paths with respect to
         ``outfn`` if given or the current directory (if ``outfn`` is None)
+    search_index_fn : str or None
+        The file name of the prebuilt search index, written in the same
+        directory as ``outfn``, or None to not write it.  The search box of
+        the jdat_notebooks index template loads it to search all notebooks.
 
     Returns
     -------
@@ -27,17 +126,133 @@ def make_html_index(converted_files, html_template, outfn='index.html',
         The content of the index file
     """
     path, fn = os.path.split(html_template)
-    env = jinja2.Environment(loader=jinja2.FileSystemLoader(path),
-                             autoescape=jinja2.select_autoescape(['html', 'xml']))
-    templ = env.get_template(fn)
+    templ = _get_environment(path).get_template(fn)
 
-    if relpaths:
-        outdir = os.path.realpath(os.path.dirname(outfn) if outfn else os.path.curdir)
-        converted_files = [os.path.relpath(os.path.realpath(pth), outdir)
-                           for pth in converted_files]
+    converted_files, notebooks = _collect_notebooks(converted_files, outfn,
+                                                    relpaths)
 
-    content = templ.render(notebook_html_paths=converted_files)
+    content = templ.render(notebook_html_paths=converted_files,
+                           notebooks=notebooks,
+                           search_index_path=search_index_fn)
     if outfn:
         with open(outfn, 'w') as f:
             f.write(content)
+
+        if search_index_fn:
+            _write_search_index(notebooks, outfn, search_index_fn)
     return content
+
+
+class HTMLIndexBuilder(object):
+    """
+    Builds the html index for large sets of notebooks.
+
+    Unlike `make_html_index`, the compiled template is cached on disk
+    between runs, each page is streamed straight to its output file rather
+    than rendered into memory, and the index can be split into pages and/or
+    grouped by directory or instrument.
+
+    Parameters
+    ----------
+    html_template : str
+        A path to the jinja2 template file used for each index page.  In
+        addition to the context of `make_html_index`, the template gets
+        ``groups`` (a list of ``(group_name, notebooks)`` pairs, or None if
+        not grouping), ``page_number``, ``page_paths``, ``prev_page_path``
+        and ``next_page_path``.
+    bytecode_cache_dir : str or None
+        Directory in which to cache the compiled template, or None to only
+        cache it in memory.
+    page_size : int or None
+        The maximum number of notebooks per index page, or None to put them
+        all on one page.
+    group_by : str or None
+        ``'directory'`` or ``'instrument'`` to group the notebooks on each
+        page, or None to list them in the given order.
+    """
+    def __init__(self, html_template, bytecode_cache_dir=None, page_size=None,
+                 group_by=None):
+        if group_by not in (None, 'directory', 'instrument'):
+            raise ValueError('group_by has to be None, "directory" or '
+                             '"instrument"')
+        if page_size is not None and page_size < 1:
+            raise ValueError('page_size has to be a positive integer or None')
+
+        path, fn = os.path.split(os.path.abspath(html_template))
+        self.template = _get_environment(path, bytecode_cache_dir).get_template(fn)
+        self.page_size = page_size
+        self.group_by = group_by
+
+    @staticmethod
+    def page_filename(outfn, page_number):
+        """
+        The file name of page ``page_number`` (starting from 1) of the index
+        with first page ``outfn``.
+        """
+        if page_number == 1:
+            return outfn
+        base, ext = os.path.splitext(outfn)
+        return '{0}-{1}{2}'.format(base, page_number, ext)
+
+    def _group(self, notebooks):
+        groups = {}
+        for nb in notebooks:
+            if self.group_by == 'directory':
+                key = os.path.dirname(nb['path'])
+            else:
+                key = nb.get('instrument') or ''
+            groups.setdefault(key, []).append(nb)
+        return sorted(groups.items())
+
+    def build(self, converted_files, outfn='index.html', relpaths=True,
+              search_index_fn='search_index.json'):
+        """
+        Write the index pages (and optionally the search index) for a set of
+        notebooks.
+
+        Parameters
+        ----------
+        converted_files : list
+            The list of paths to the converted notebooks
+        outfn : str
+            The file name of the first index page.  Further pages get a
+            ``-<page number>`` suffix.
+        relpaths : bool
+            If True, the paths are passed to the template relative to the
+            directory of ``outfn``
+        search_index_fn : str or None
+            The file name of the prebuilt search index, or None to not write
+            it.
+
+        Returns
+        -------
+        page_paths : list
+            The paths of the index pages that were written
+        """
+        converted_files, notebooks = _collect_notebooks(converted_files, outfn,
+                                                        relpaths)
+
+        page_size = self.page_size or max(len(notebooks), 1)
+        npages = max((len(notebooks) + page_size - 1) // page_size, 1)
+        page_paths = [self.page_filename(outfn, i + 1) for i in range(npages)]
+        page_links = [os.path.basename(pth) for pth in page_paths]
+
+        for i, page_path in enumerate(page_paths):
+            page = slice(i * page_size, (i + 1) * page_size)
+            page_notebooks = notebooks[page]
+            context = dict(
+                notebook_html_paths=converted_files[page],
+                notebooks=page_notebooks,
+                groups=self._group(page_notebooks) if self.group_by else None,
+                search_index_path=search_index_fn,
+                page_number=i + 1,
+                page_paths=page_links,
+                prev_page_path=page_links[i - 1] if i > 0 else None,
+                next_page_path=page_links[i + 1] if i + 1 < npages else None)
+            with open(page_path, 'w') as f:
+                self.template.stream(**context).dump(f)
+
+        if search_index_fn:
+            _write_search_index(notebooks, outfn, search_index_fn)
+
+        return page_paths
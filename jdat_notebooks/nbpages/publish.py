@@ -0,0 +1,272 @@
+"""
+This module contains functionality to incrementally publish a built notebook
+site to a git branch (normally gh-pages).  Only files whose content changed
+since the last deploy are copied and committed, stale files are removed, and
+precompressed ``.gz`` copies of the html/css/js files are published alongside
+the originals.
+"""
+
+import os
+import sys
+import gzip
+import json
+import shutil
+import hashlib
+import logging
+import argparse
+import tempfile
+import subprocess
+
+__all__ = ['precompress', 'build_manifest', 'publish']
+
+log = logging.getLogger('nbpages')
+
+MANIFEST_NAME = 'nbpages_manifest.json'
+COMPRESS_EXTENSIONS = ('.html', '.css', '.js')
+
+
+def _walk_files(site_dir):
+    # like ``cp -aR site_dir/*``, hidden top-level entries (.git, dotfiles)
+    # are not part of the site
+    for root, dirs, files in os.walk(site_dir):
+        if root == site_dir:
+            dirs[:] = [name for name in dirs if not name.startswith('.')]
+            files = [name for name in files if not name.startswith('.')]
+        if '.git' in dirs:
+            dirs.remove('.git')
+        for name in files:
+            full_path = os.path.join(root, name)
+            relpath = os.path.relpath(full_path, site_dir)
+            if relpath == MANIFEST_NAME:
+                continue
+            yield relpath.replace(os.sep, '/'), full_path
+
+
+def _file_hash(fn, blocksize=1 << 20):
+    h = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _gzip_file(src, dest):
+    # no timestamp in the gzip header, so unchanged files always compress to
+    # identical bytes
+    os.makedirs(os.path.dirname(dest) or os.curdir, exist_ok=True)
+    with open(src, 'rb') as fin, open(dest, 'wb') as fout:
+        with gzip.GzipFile(filename='', mode='wb', fileobj=fout,
+                           mtime=0) as gz:
+            shutil.copyfileobj(fin, gz)
+
+
+def _compressed_names(relpaths, extensions=COMPRESS_EXTENSIONS):
+    # map the name of the ``.gz`` copy of every compressible file to the file
+    return {relpath + '.gz': relpath for relpath in relpaths
+            if relpath.endswith(tuple(extensions))}
+
+
+def precompress(site_dir, out_dir=None, extensions=COMPRESS_EXTENSIONS):
+    """
+    Write a gzipped copy of every file in ``site_dir`` with one of the given
+    ``extensions``, at the same relative path in ``out_dir``.  Copies that
+    are newer than their source are left alone, and ``.gz`` files in
+    ``out_dir`` whose source is no longer in ``site_dir`` are removed.
+
+    Parameters
+    ----------
+    site_dir : str
+        The directory containing the built site.
+    out_dir : str or None
+        Where to write the ``.gz`` copies.  If None, they are written next to
+        their sources in ``site_dir``.
+
+    Returns
+    -------
+    written : list
+        The paths of the ``.gz`` files that were (re)written
+    """
+    if out_dir is None:
+        out_dir = site_dir
+    compressed = _compressed_names([relpath for relpath, full_path
+                                    in _walk_files(site_dir)], extensions)
+
+    written = []
+    for gz_relpath, relpath in sorted(compressed.items()):
+        full_path = os.path.join(site_dir, relpath)
+        gz_path = os.path.join(out_dir, gz_relpath)
+        if (os.path.exists(gz_path) and
+                os.path.getmtime(gz_path) > os.path.getmtime(full_path)):
+            continue
+        _gzip_file(full_path, gz_path)
+        written.append(gz_path)
+
+    for gz_relpath, gz_path in list(_walk_files(out_dir)):
+        if (gz_relpath.endswith('.gz') and gz_relpath not in compressed and
+                gz_relpath[:-3].endswith(tuple(extensions))):
+            log.debug('Removing stale {}'.format(gz_path))
+            os.remove(gz_path)
+    return written
+
+
+def build_manifest(site_dir):
+    """
+    Map the path (relative to ``site_dir``, with ``/`` separators) of every
+    file in ``site_dir`` to the sha256 hash of its content.
+    """
+    return {relpath: _file_hash(full_path)
+            for relpath, full_path in sorted(_walk_files(site_dir))}
+
+
+def _git(args, cwd):
+    log.debug('Running git {} in {}'.format(' '.join(args), cwd))
+    return subprocess.check_output(['git'] + args, cwd=cwd).decode().strip()
+
+
+def _remote_branch_exists(repo_url, branch):
+    # ls-remote patterns match any ref ending in the pattern, so compare the
+    # full ref names
+    ref = 'refs/heads/{}'.format(branch)
+    refs = _git(['ls-remote', '--heads', repo_url, ref], cwd='.')
+    return ref in [line.split()[-1] for line in refs.splitlines()]
+
+
+def publish(workspace, repo_url='.', branch='gh-pages', build_tag='manual build',
+            remote_name='origin', clone_dir=None, compress=True, push=True):
+    """
+    Publish the built site in ``workspace`` to ``branch`` of ``repo_url``.
+
+    The deploy branch carries a manifest of content hashes from the previous
+    publish, so only new or changed files are copied and committed, and files
+    that are no longer in the workspace are removed.  As with
+    ``cp -aR workspace/*``, hidden top-level entries of the workspace are not
+    published.  The ``.gz`` copies are written into the clone, never into the
+    workspace, and are listed in the manifest under the hash of their source
+    (compression is deterministic), so they are rewritten and removed along
+    with it.
+
+    Parameters
+    ----------
+    workspace : str
+        The directory containing the built site.
+    repo_url : str
+        The repository to clone and push to (any url or path git accepts).
+    branch : str
+        The branch to deploy to.  It is created if it does not exist yet.
+    build_tag : str
+        Tag used in the deploy commit message.
+    remote_name : str
+        The remote to push to.
+    clone_dir : str or None
+        Where to clone the deploy branch.  If None, a temporary directory is
+        used and removed afterwards.
+    compress : bool
+        Whether to publish ``.gz`` copies of html/css/js files.
+    push : bool
+        Whether to push the deploy commit.
+
+    Returns
+    -------
+    changes : dict
+        ``changed`` and ``removed`` lists of the published relative paths.
+    """
+    manifest = build_manifest(workspace)
+    compressed = _compressed_names(manifest) if compress else {}
+    for gz_relpath, relpath in compressed.items():
+        manifest[gz_relpath] = manifest[relpath]
+
+    tmpdir = None
+    if clone_dir is None:
+        tmpdir = clone_dir = tempfile.mkdtemp(prefix='nbpages_publish_')
+        clone_dir = os.path.join(clone_dir, 'out')
+
+    try:
+        if _remote_branch_exists(repo_url, branch):
+            _git(['clone', '-q', '-b', branch, '--single-branch',
+                  '--origin', remote_name, repo_url, clone_dir], cwd='.')
+        else:
+            log.info('Branch {} does not exist yet, creating it'.format(branch))
+            _git(['init', '-q', clone_dir], cwd='.')
+            _git(['remote', 'add', remote_name, repo_url], cwd=clone_dir)
+            _git(['checkout', '-q', '--orphan', branch], cwd=clone_dir)
+
+        old_manifest_path = os.path.join(clone_dir, MANIFEST_NAME)
+        if os.path.exists(old_manifest_path):
+            with open(old_manifest_path) as f:
+                old_manifest = json.load(f)
+        else:
+            old_manifest = {}
+
+        changed = [relpath for relpath, digest in sorted(manifest.items())
+                   if old_manifest.get(relpath) != digest]
+        removed = sorted(set(old_manifest) - set(manifest))
+        log.info('Publishing {} changed file(s), removing {} stale '
+                 'file(s)'.format(len(changed), len(removed)))
+
+        if not changed and not removed:
+            return {'changed': changed, 'removed': removed}
+
+        for relpath in changed:
+            dest = os.path.join(clone_dir, relpath)
+            if relpath in compressed:
+                _gzip_file(os.path.join(workspace, compressed[relpath]), dest)
+            else:
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                shutil.copy2(os.path.join(workspace, relpath), dest)
+        for relpath in removed:
+            dest = os.path.join(clone_dir, relpath)
+            if os.path.exists(dest):
+                os.remove(dest)
+
+        with open(old_manifest_path, 'w') as f:
+            json.dump(manifest, f, indent=0, sort_keys=True)
+
+        _git(['add', '-A', '--'] + changed + removed + [MANIFEST_NAME],
+             cwd=clone_dir)
+        _git(['commit', '-q', '-m', 'Automated deployment to GitHub Pages: '
+              '{}'.format(build_tag)], cwd=clone_dir)
+        if push:
+            _git(['push', '-q', remote_name, branch], cwd=clone_dir)
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return {'changed': changed, 'removed': removed}
+
+
+def main():
+    """
+    Call this to programmatically use this as a command-line script
+    """
+    parser = argparse.ArgumentParser(description='Incrementally publish a '
+                                     'built notebook site to a git branch.')
+    parser.add_argument('--workspace', default=os.curdir,
+                        help='Where to copy the built files from.')
+    parser.add_argument('--repo-url', default='.', dest='repo_url',
+                        help='Repo url to clone from and push to.')
+    parser.add_argument('--branch', default='gh-pages',
+                        help='Branch to deploy to.')
+    parser.add_argument('--build-tag', default='manual build', dest='build_tag',
+                        help='Tag for the deploy commit.')
+    parser.add_argument('--remote-name', default='origin', dest='remote_name',
+                        help='Remote to push to.')
+    parser.add_argument('--no-compress', action='store_false', dest='compress',
+                        help='Do not publish precompressed .gz copies.')
+    parser.add_argument('--no-push', action='store_false', dest='push',
+                        help='Commit the deploy but do not push it.')
+    args = parser.parse_args()
+
+    logging.basicConfig()
+    log.setLevel(logging.INFO)
+    try:
+        publish(os.path.abspath(args.workspace), repo_url=args.repo_url,
+                branch=args.branch, build_tag=args.build_tag,
+                remote_name=args.remote_name, compress=args.compress,
+                push=args.push)
+    except subprocess.CalledProcessError as e:
+        log.error('Publishing failed: {}'.format(e))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+import os
+import gzip
+import json
+import subprocess
+
+import pytest
+
+from nbpages.publish import MANIFEST_NAME, precompress, publish
+
+
+def _git(args, cwd):
+    return subprocess.check_output(['git'] + args, cwd=cwd).decode().strip()
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def _branch_files(repo, branch):
+    return sorted(_git(['ls-tree', '-r', '--name-only', branch], cwd=repo).splitlines())
+
+
+@pytest.fixture
+def site(tmp_path):
+    # a bare repo to publish to, and a workspace with a built site
+    repo = str(tmp_path / 'repo.git')
+    _git(['init', '-q', '--bare', repo], cwd=str(tmp_path))
+
+    workspace = str(tmp_path / 'workspace')
+    _write(os.path.join(workspace, 'index.html'), '<html>index</html>')
+    _write(os.path.join(workspace, 'nb', 'nb.html'), '<html>nb</html>')
+    _write(os.path.join(workspace, 'nb', 'data.txt'), 'data')
+    _write(os.path.join(workspace, '.hidden'), 'not published')
+    _write(os.path.join(workspace, '.git', 'config'), 'not published')
+    return repo, workspace
+
+
+@pytest.fixture(autouse=True)
+def git_identity(monkeypatch):
+    for var in ['GIT_AUTHOR_NAME', 'GIT_COMMITTER_NAME']:
+        monkeypatch.setenv(var, 'nbpages')
+    for var in ['GIT_AUTHOR_EMAIL', 'GIT_COMMITTER_EMAIL']:
+        monkeypatch.setenv(var, 'nbpages@example.com')
+
+
+def test_publish_incremental(site):
+    repo, workspace = site
+    changes = publish(workspace, repo_url=repo)
+    expected = ['index.html', 'index.html.gz', 'nb/data.txt', 'nb/nb.html',
+                'nb/nb.html.gz']
+    assert changes == {'changed': expected, 'removed': []}
+    assert _branch_files(repo, 'gh-pages') == sorted(expected + [MANIFEST_NAME])
+    # the .gz copies go to the deploy branch only
+    assert not os.path.exists(os.path.join(workspace, 'index.html.gz'))
+
+    gz_bytes = subprocess.check_output(['git', 'show', 'gh-pages:nb/nb.html.gz'], cwd=repo)
+    assert gzip.decompress(gz_bytes) == b'<html>nb</html>'
+
+    # nothing changed: no new commit
+    head = _git(['rev-parse', 'gh-pages'], cwd=repo)
+    assert publish(workspace, repo_url=repo) == {'changed': [], 'removed': []}
+    assert _git(['rev-parse', 'gh-pages'], cwd=repo) == head
+
+    # a changed and a removed file; the .gz copy of the removed one goes too
+    _write(os.path.join(workspace, 'index.html'), '<html>new index</html>')
+    os.remove(os.path.join(workspace, 'nb', 'nb.html'))
+    changes = publish(workspace, repo_url=repo)
+    assert changes == {'changed': ['index.html', 'index.html.gz'],
+                       'removed': ['nb/nb.html', 'nb/nb.html.gz']}
+    assert _branch_files(repo, 'gh-pages') == sorted(['index.html', 'index.html.gz',
+                                                      'nb/data.txt', MANIFEST_NAME])
+    manifest = json.loads(_git(['show', 'gh-pages:' + MANIFEST_NAME], cwd=repo))
+    assert sorted(manifest) == ['index.html', 'index.html.gz', 'nb/data.txt']
+
+
+def test_publish_branch_name_suffix(site):
+    # an existing 'docs/gh-pages' branch must not be mistaken for 'gh-pages'
+    repo, workspace = site
+    publish(workspace, repo_url=repo, branch='docs/gh-pages')
+    publish(workspace, repo_url=repo, branch='gh-pages')
+    assert _git(['rev-list', '--count', 'gh-pages'], cwd=repo) == '1'
+    assert _branch_files(repo, 'gh-pages') == _branch_files(repo, 'docs/gh-pages')
+
+
+def test_precompress_removes_stale(tmp_path):
+    site_dir = str(tmp_path)
+    _write(os.path.join(site_dir, 'a.html'), 'a')
+    _write(os.path.join(site_dir, 'b.html'), 'b')
+    assert len(precompress(site_dir)) == 2
+    assert precompress(site_dir) == []
+    os.remove(os.path.join(site_dir, 'b.html'))
+    precompress(site_dir)
+    assert sorted(os.listdir(site_dir)) == ['a.html', 'a.html.gz']